@@ -0,0 +1,231 @@
+import asyncio
+import io
+import json
+import tarfile
+import zipfile
+from pathlib import Path
+from typing import (
+    Any,
+    AsyncIterator,
+    BinaryIO,
+    Callable,
+    Iterable,
+    Iterator,
+    NamedTuple,
+)
+
+from calc_plan_cost import calc_plan_costs
+from custom_types import CompiledPlan
+from parse_usage_data import (
+    DEFAULT_PARSE_CHUNK_BYTES,
+    aggregate_usage_csv_range,
+    split_file_ranges,
+)
+from recommendation import (
+    build_recommendation,
+    recommend_usage_csv,
+    recommend_usage_csv_bytes,
+)
+from usage_aggregate import UsageAggregate
+from usage_binary import BINARY_SUFFIX, load_usage_data_binary
+from worker_pool import WorkerPool
+
+
+class BatchItem(NamedTuple):
+    """One customer's usage data in a batch: CSV bytes from an archive, a local
+    path from a manifest, or an error describing why it can't be priced"""
+
+    file_name: str
+    csv_bytes: bytes | None = None
+    path: Path | None = None
+    error: str | None = None
+
+
+def _is_csv(name: str) -> bool:
+    return name.lower().endswith(".csv")
+
+
+def iter_batch_items(batch_file: BinaryIO, manifest_root: Path) -> Iterator[BatchItem]:
+    """Yields the usage files in a zip or tar archive of CSVs, or in an NDJSON
+    manifest with one {"path": ...} object per line. Manifest paths may be CSVs
+    or binary usage files (see usage_binary).
+
+    Manifest paths are resolved relative to manifest_root and must not point
+    outside of it. Archive members that aren't CSVs are skipped.
+    """
+    if zipfile.is_zipfile(batch_file):
+        batch_file.seek(0)
+        with zipfile.ZipFile(batch_file) as archive:
+            for info in archive.infolist():
+                if not info.is_dir() and _is_csv(info.filename):
+                    yield BatchItem(info.filename, csv_bytes=archive.read(info))
+        return
+
+    batch_file.seek(0)
+    if tarfile.is_tarfile(batch_file):
+        batch_file.seek(0)
+        with tarfile.open(fileobj=batch_file, mode="r:*") as archive:
+            for member in archive:
+                member_file = archive.extractfile(member) if member.isfile() else None
+                if member_file is not None and _is_csv(member.name):
+                    yield BatchItem(member.name, csv_bytes=member_file.read())
+        return
+
+    batch_file.seek(0)
+    root = manifest_root.resolve()
+    for line_number, line in enumerate(
+        io.TextIOWrapper(batch_file, encoding="utf-8"), start=1
+    ):
+        if not line.strip():
+            continue
+        try:
+            path = Path(json.loads(line)["path"])
+        except (ValueError, KeyError, TypeError):
+            yield BatchItem(
+                f"line {line_number}",
+                error='Manifest lines must be JSON objects with a "path".',
+            )
+            continue
+        resolved_path = (root / path).resolve()
+        if not resolved_path.is_relative_to(root):
+            yield BatchItem(
+                str(path), error=f"Path is outside of the manifest root {root}."
+            )
+            continue
+        yield BatchItem(str(path), path=resolved_path)
+
+
+def recommend_batch_item(item: BatchItem, compiled_plans: list[CompiledPlan]) -> dict:
+    """Prices a single batch item; runs in a worker process"""
+    if item.path is not None and item.path.suffix == BINARY_SUFFIX:
+        return build_recommendation(
+            item.file_name,
+            calc_plan_costs(compiled_plans, load_usage_data_binary(item.path)),
+        )
+    if item.path is not None:
+        with open(item.path, "rb") as csv_file:
+            return recommend_usage_csv(item.file_name, csv_file, compiled_plans)
+    return recommend_usage_csv_bytes(
+        item.file_name, item.csv_bytes or b"", compiled_plans
+    )
+
+
+def recommend_usage_aggregates(
+    file_name: str,
+    usage_aggregates: list[UsageAggregate],
+    compiled_plans: list[CompiledPlan],
+) -> dict:
+    """Prices a large manifest CSV from its ranges' partial aggregates; runs in
+    a worker process"""
+    return build_recommendation(
+        file_name,
+        calc_plan_costs(compiled_plans, UsageAggregate.merge(usage_aggregates)),
+    )
+
+
+class _ChunkedItem:
+    """A large manifest CSV parsed as several byte ranges on the pool, priced
+    once every range's partial aggregate is back"""
+
+    def __init__(self, file_name: str, chunks: int) -> None:
+        self.file_name = file_name
+        self.chunks_left = chunks
+        self.usage_aggregates: list[UsageAggregate] = []
+        self.error: str | None = None
+
+
+async def run_batch(
+    items: Iterable[BatchItem],
+    compiled_plans: Iterable[CompiledPlan],
+    pricing_pool: WorkerPool,
+    max_in_flight: int,
+    chunk_bytes: int = DEFAULT_PARSE_CHUNK_BYTES,
+) -> AsyncIterator[dict]:
+    """Prices every batch item on the pricing pool, yielding each
+    recommendation as soon as it is ready (so not necessarily in input order).
+
+    The batch is admitted as a whole by the caller, so its jobs skip the
+    pool's capacity check but still count towards it, and other uploads are
+    turned away while it's busy. At most max_in_flight jobs are submitted at
+    once, which bounds how much of a large archive is held in memory, and
+    items are read off the event loop. Manifest CSVs larger than chunk_bytes
+    are split into ranges parsed in parallel (see aggregate_usage_csv_range),
+    so one huge customer doesn't leave the other workers idle. A customer
+    whose usage data can't be priced gets an {"file_name": ..., "error": ...}
+    record instead.
+    """
+    compiled_plans = list(compiled_plans)
+    items = iter(items)
+    in_flight: dict[asyncio.Future, str | _ChunkedItem] = {}
+
+    def submit(owner: str | _ChunkedItem, fn: Callable[..., Any], *args: Any) -> None:
+        job = asyncio.ensure_future(pricing_pool.run(fn, *args, admitted=True))
+        in_flight[job] = owner
+
+    async def collect_finished() -> list[dict]:
+        done, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+        results = []
+        for job in done:
+            owner = in_flight.pop(job)
+            if isinstance(owner, str):
+                try:
+                    results.append(job.result())
+                except Exception as e:
+                    results.append({"file_name": owner, "error": str(e)})
+                continue
+            try:
+                owner.usage_aggregates.append(job.result())
+            except Exception as e:
+                owner.error = owner.error or str(e)
+            owner.chunks_left -= 1
+            if owner.chunks_left:
+                continue
+            if owner.error is not None:
+                results.append({"file_name": owner.file_name, "error": owner.error})
+                continue
+            submit(
+                owner.file_name,
+                recommend_usage_aggregates,
+                owner.file_name,
+                owner.usage_aggregates,
+                compiled_plans,
+            )
+        return results
+
+    try:
+        while (item := await asyncio.to_thread(next, items, None)) is not None:
+            if item.error is not None:
+                yield {"file_name": item.file_name, "error": item.error}
+                continue
+            if item.path is not None and item.path.suffix != BINARY_SUFFIX:
+                try:
+                    size = item.path.stat().st_size
+                except OSError as e:
+                    yield {"file_name": item.file_name, "error": str(e)}
+                    continue
+                if size > chunk_bytes:
+                    ranges = split_file_ranges(size, chunk_bytes)
+                    chunked_item = _ChunkedItem(item.file_name, len(ranges))
+                    for start, end in ranges:
+                        while len(in_flight) >= max_in_flight:
+                            for result in await collect_finished():
+                                yield result
+                        submit(
+                            chunked_item,
+                            aggregate_usage_csv_range,
+                            item.path,
+                            start,
+                            end,
+                        )
+                    continue
+            while len(in_flight) >= max_in_flight:
+                for result in await collect_finished():
+                    yield result
+            submit(item.file_name, recommend_batch_item, item, compiled_plans)
+
+        while in_flight:
+            for result in await collect_finished():
+                yield result
+    finally:
+        for job in in_flight:
+            job.cancel()
@@ -0,0 +1,393 @@
+"""Reproducible benchmarks of parsing, pricing and the /recommend/ endpoint.
+
+Times every stage against the data/*-interval-data.csv fixtures plus generated
+1-minute and multi-year usage files, and writes the results to JSON so runs on
+different commits can be compared:
+
+    python benchmark.py --output before.json
+    git checkout my-branch
+    python benchmark.py --output after.json --compare before.json
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Callable, Iterable, NamedTuple
+
+from calc_plan_cost import calc_plan_cost
+from custom_types import PlanConfig
+from parse_usage_data import aggregate_usage_csv_file, parse_usage_data_csv
+from usage_binary import (
+    BINARY_SUFFIX,
+    load_usage_data_binary,
+    write_usage_data_binary,
+)
+
+DATA_DIR = Path(__file__).parent / "data"
+PLAN_CONFIGS_PATH = Path(__file__).parent / "plan_configs.json"
+
+
+class SyntheticDataset(NamedTuple):
+    name: str
+    days: int
+    interval_seconds: int
+    solar: bool = True
+
+
+SYNTHETIC_DATASETS = (
+    SyntheticDataset("synthetic-1-minute-1-year", days=365, interval_seconds=60),
+    # The same load without generation, to compare pricing buyback against
+    SyntheticDataset(
+        "synthetic-1-minute-1-year-no-solar",
+        days=365,
+        interval_seconds=60,
+        solar=False,
+    ),
+    SyntheticDataset("synthetic-15-minute-5-years", days=5 * 365, interval_seconds=900),
+)
+
+# Priced alongside the catalog, so solar customers' buyback rules are timed too
+BUYBACK_PLAN_CONFIGS = [
+    PlanConfig.from_json(
+        {
+            "name": "Free Nights, Net Metered",
+            "base_rate_per_kwh": 19,
+            "base_monthly_fee": 995,
+            "time_of_day_prices": [
+                {"start_time": "22:00", "end_time": "06:00", "rate_cents_per_kwh": 0}
+            ],
+            "buyback": {
+                "rate_cents_per_kwh": 4,
+                "time_of_day_rates": [
+                    {
+                        "start_time": "16:00",
+                        "end_time": "21:00",
+                        "rate_cents_per_kwh": 12,
+                    }
+                ],
+                "monthly_netting": True,
+                "max_monthly_credit": 1000,
+            },
+        }
+    ),
+]
+
+
+class BenchmarkResult(NamedTuple):
+    name: str  # what was timed, e.g. "parse_usage_data_csv" or "calc_plan_cost[Flat]"
+    dataset: str
+    rows: int
+    repeat: int
+    min_seconds: float
+    median_seconds: float
+    mean_seconds: float
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.median_seconds if self.median_seconds else 0.0
+
+    def to_json(self) -> dict:
+        return {**self._asdict(), "rows_per_second": round(self.rows_per_second)}
+
+
+def write_synthetic_usage_csv(
+    path: Path, days: int, interval_seconds: int, seed: int = 0, solar: bool = True
+) -> int:
+    """Writes a usage data CSV with a day/night load shape and, with solar,
+    some rooftop solar generation. The same seed always produces the same
+    load, with or without solar.
+
+    Returns the number of rows written.
+    """
+    rng = random.Random(seed)
+    # A fixed offset, so every day has the same number of intervals
+    start = datetime(2020, 1, 1, tzinfo=timezone(timedelta(hours=-5)))
+    rows = days * 24 * 60 * 60 // interval_seconds
+    interval_hours = interval_seconds / 3600
+    with open(path, "w", newline="") as csv_file:
+        csv_file.write("datetime,duration,unit,consumption,generation\n")
+        for i in range(rows):
+            interval_start = start + timedelta(seconds=i * interval_seconds)
+            hour = interval_start.hour
+            load_watts = (1500 if 7 <= hour < 22 else 600) * rng.uniform(0.5, 1.5)
+            solar_watts = 3000 * rng.random() if 9 <= hour < 17 else 0
+            if not solar:
+                solar_watts = 0
+            csv_file.write(
+                f"{interval_start.isoformat()},{interval_seconds},Wh,"
+                f"{round(load_watts * interval_hours)},"
+                f"{round(solar_watts * interval_hours)}\n"
+            )
+    return rows
+
+
+def time_call(fn: Callable[[], object], repeat: int) -> list[float]:
+    """Runs fn once to warm up, then repeat more times, returning the timings"""
+    fn()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def summarize(
+    name: str, dataset: str, rows: int, timings: list[float]
+) -> BenchmarkResult:
+    return BenchmarkResult(
+        name=name,
+        dataset=dataset,
+        rows=rows,
+        repeat=len(timings),
+        min_seconds=min(timings),
+        median_seconds=statistics.median(timings),
+        mean_seconds=statistics.fmean(timings),
+    )
+
+
+def benchmark_dataset(
+    dataset: str,
+    path: Path,
+    plan_configs: list[PlanConfig],
+    recommend: Callable[[bytes], None] | None,
+    repeat: int,
+    parse_pools: dict[int, Executor] = {},
+) -> list[BenchmarkResult]:
+    """Times parsing the file, in parallel on each of parse_pools (keyed by
+    their number of workers) too, pricing it with each plan, and optionally
+    the whole /recommend/ request"""
+
+    def parse():
+        with open(path, "rb") as csv_file:
+            return parse_usage_data_csv(csv_file)
+
+    usage_data = parse()
+    rows = len(usage_data)
+    results = [
+        summarize("parse_usage_data_csv", dataset, rows, time_call(parse, repeat))
+    ]
+    # A few ranges per worker, so they finish together
+    chunk_bytes = max(path.stat().st_size // (4 * max(parse_pools, default=1)), 1)
+    for workers, executor in parse_pools.items():
+        results.append(
+            summarize(
+                f"aggregate_usage_csv_file[{workers} workers]",
+                dataset,
+                rows,
+                time_call(
+                    lambda: aggregate_usage_csv_file(path, executor, chunk_bytes),
+                    repeat,
+                ),
+            )
+        )
+    with tempfile.TemporaryDirectory() as binary_dir:
+        binary_path = Path(binary_dir) / f"{dataset}{BINARY_SUFFIX}"
+        with open(binary_path, "wb") as binary_file:
+            write_usage_data_binary(usage_data, binary_file)
+        results.append(
+            summarize(
+                "load_usage_data_binary",
+                dataset,
+                rows,
+                time_call(lambda: load_usage_data_binary(binary_path), repeat),
+            )
+        )
+    for plan_config in plan_configs:
+        results.append(
+            summarize(
+                f"calc_plan_cost[{plan_config.name}]",
+                dataset,
+                rows,
+                time_call(lambda: calc_plan_cost(plan_config, usage_data), repeat),
+            )
+        )
+    if recommend is not None:
+        csv_bytes = path.read_bytes()
+        results.append(
+            summarize(
+                "POST /recommend/",
+                dataset,
+                rows,
+                time_call(lambda: recommend(csv_bytes), repeat),
+            )
+        )
+    return results
+
+
+def run_benchmarks(
+    datasets: dict[str, Path],
+    repeat: int,
+    include_endpoint: bool = True,
+    parse_workers: Iterable[int] = (),
+) -> list[BenchmarkResult]:
+    with open(PLAN_CONFIGS_PATH) as f:
+        plan_configs = [PlanConfig.from_json(plan) for plan in json.load(f)]
+    plan_configs += BUYBACK_PLAN_CONFIGS
+    with contextlib.ExitStack() as stack:
+        parse_pools: dict[int, Executor] = {
+            workers: stack.enter_context(ProcessPoolExecutor(workers))
+            for workers in parse_workers
+        }
+        return _run_benchmarks(
+            datasets, plan_configs, repeat, include_endpoint, parse_pools
+        )
+
+
+def _run_benchmarks(
+    datasets: dict[str, Path],
+    plan_configs: list[PlanConfig],
+    repeat: int,
+    include_endpoint: bool,
+    parse_pools: dict[int, Executor],
+) -> list[BenchmarkResult]:
+    if not include_endpoint:
+        return [
+            result
+            for dataset, path in datasets.items()
+            for result in benchmark_dataset(
+                dataset, path, plan_configs, None, repeat, parse_pools
+            )
+        ]
+
+    from fastapi.testclient import TestClient
+
+    import main as service
+
+    # Every request must be parsed and priced, not answered from the cache
+    service.settings = service.settings._replace(result_cache_max_bytes=0)
+    results = []
+    with TestClient(service.app) as client:
+
+        def recommend(csv_bytes: bytes) -> None:
+            response = client.post(
+                "/recommend/", files={"file": ("usage.csv", csv_bytes)}
+            )
+            response.raise_for_status()
+
+        for dataset, path in datasets.items():
+            results += benchmark_dataset(
+                dataset, path, plan_configs, recommend, repeat, parse_pools
+            )
+    return results
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=Path(__file__).parent,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def find_regressions(baseline: dict, current: dict, threshold: float) -> list[str]:
+    """Describes every benchmark whose median time grew by more than threshold
+    (e.g. 1.2 for 20%) since the baseline run"""
+    baseline_medians = {
+        (result["name"], result["dataset"]): result["median_seconds"]
+        for result in baseline["results"]
+    }
+    regressions = []
+    for result in current["results"]:
+        baseline_median = baseline_medians.get((result["name"], result["dataset"]))
+        if baseline_median and result["median_seconds"] > threshold * baseline_median:
+            regressions.append(
+                f"{result['name']} on {result['dataset']}: "
+                f"{baseline_median * 1000:.1f} ms -> "
+                f"{result['median_seconds'] * 1000:.1f} ms"
+            )
+    return regressions
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--output", type=Path, help="write the results JSON here")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--compare", type=Path, help="results JSON of a baseline run to compare to"
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=1.2,
+        help="fail if a median time grows by more than this factor (default 1.2)",
+    )
+    parser.add_argument(
+        "--no-synthetic", action="store_true", help="only use the data/ fixtures"
+    )
+    parser.add_argument(
+        "--no-endpoint", action="store_true", help="skip timing POST /recommend/"
+    )
+    parser.add_argument(
+        "--parse-workers",
+        type=lambda value: [int(workers) for workers in value.split(",")],
+        default=sorted({1, os.cpu_count() or 1}),
+        help="comma separated worker counts to time parallel parsing with "
+        "(default 1 and the number of CPUs)",
+    )
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as synthetic_dir:
+        datasets = {
+            path.stem: path for path in sorted(DATA_DIR.glob("*-interval-data.csv"))
+        }
+        if not args.no_synthetic:
+            for synthetic in SYNTHETIC_DATASETS:
+                path = Path(synthetic_dir) / f"{synthetic.name}.csv"
+                write_synthetic_usage_csv(
+                    path,
+                    synthetic.days,
+                    synthetic.interval_seconds,
+                    solar=synthetic.solar,
+                )
+                datasets[synthetic.name] = path
+        results = run_benchmarks(
+            datasets,
+            args.repeat,
+            include_endpoint=not args.no_endpoint,
+            parse_workers=args.parse_workers,
+        )
+
+    report = {
+        "commit": git_commit(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "results": [result.to_json() for result in results],
+    }
+    for result in results:
+        print(
+            f"{result.name:<32} {result.dataset:<30} {result.rows:>9,} rows "
+            f"{result.median_seconds * 1000:>10.1f} ms"
+        )
+    if args.output is not None:
+        args.output.write_text(json.dumps(report, indent=2) + "\n")
+
+    if args.compare is not None:
+        regressions = find_regressions(
+            json.loads(args.compare.read_text()), report, args.threshold
+        )
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
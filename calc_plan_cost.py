@@ -1,12 +1,37 @@
+import itertools
+import operator
+from datetime import date, datetime, time
+from fractions import Fraction
+from typing import Iterable, Sequence
+
+import numpy as np
+
 from custom_types import (
+    EPOCH_ORDINAL,
+    MINUTES_PER_DAY,
+    SECONDS_PER_DAY,
+    BandCost,
+    Breakdown,
+    BuybackConfig,
     Cents,
+    MICROCENTS_PER_CENT,
+    MILLICENTS_PER_CENT,
     CentsPerKWh,
+    CompiledPlan,
     CostData,
+    DailyCost,
+    MicroCents,
+    MilliCentsPerKWh,
+    MonthlyCost,
     PlanConfig,
+    TierBreakpoint,
     TieredRate,
+    TimeOfDayPrice,
     UsageData,
+    UsageDataRow,
     WattHourUnit,
 )
+from usage_aggregate import UsageAggregate, sum_by_group
 
 
 def validate_plan_config(plan_config: PlanConfig) -> None:
@@ -20,96 +45,932 @@ def validate_plan_config(plan_config: PlanConfig) -> None:
     plan until requirements are gathered
 
     Raises:
-        ValueError: tiered rates and time of day prices cannot be mixed
+        ValueError: tiered rates and time of day prices cannot be mixed, or a
+            rate isn't a whole number of milli-cents per kWh or a tier size a
+            whole number of Wh
     """
     if plan_config.tiered_rates and plan_config.time_of_day_prices:
         raise ValueError(
             "Cannot mix tiered rates with time of day prices in the same plan."
         )
+    # Pricing is done in integer Wh * milli-cents per kWh, see
+    # calc_aggregate_plan_cost
+    for rate in [
+        plan_config.base_rate_per_kwh,
+        *(tier.rate_cents_per_kwh for tier in plan_config.tiered_rates),
+        *(price.rate_cents_per_kwh for price in plan_config.time_of_day_prices),
+        plan_config.buyback_rate_per_kwh,
+        *(price.rate_cents_per_kwh for price in plan_config.buyback.time_of_day_rates),
+    ]:
+        millicents_per_kwh(rate)
+    for tier in plan_config.tiered_rates:
+        wh_from_kwh(tier.usage_kwh)
+    max_monthly_credit = plan_config.buyback.max_monthly_credit
+    if max_monthly_credit is not None and max_monthly_credit < 0:
+        raise ValueError("The maximum monthly buyback credit can't be negative.")
 
 
-def calc_plan_cost(plan_config: PlanConfig, usage_data: UsageData) -> CostData:
-    """Calculate the cost of a given plan and usage data in cents.
+def _scale_exactly(value: float, scale: int, unit: str) -> int:
+    scaled = round(value * scale)
+    # Allow for the rounding error in e.g. 12.345 * 1000 = 12344.999999999998
+    if abs(value * scale - scaled) > 1e-9 * max(abs(scaled), 1):
+        raise ValueError(f"{value} isn't a whole number of {unit}.")
+    return scaled
 
-    Handles flat rates, tiered rates, monthly fees, and time of day prices.
 
-    Tiered rates and time of day prices are mutually exclusive in a plan as of now;
-    see validate_plan_config for more details on options.
+def millicents_per_kwh(rate: CentsPerKWh) -> MilliCentsPerKWh:
+    """A rate in cents per kWh, e.g. 12.5, as a whole number of milli-cents
+    per kWh
+
+    Raises:
+        ValueError: the rate has more than three decimal places
+    """
+    return MilliCentsPerKWh(
+        _scale_exactly(rate, MILLICENTS_PER_CENT, "milli-cents per kWh")
+    )
+
+
+def wh_from_kwh(kwh: float) -> int:
+    """
+    Raises:
+        ValueError: kwh isn't a whole number of Wh
+    """
+    return _scale_exactly(kwh, 1000, "Wh")
+
+
+def minute_of_day(t: time) -> int:
+    return t.hour * 60 + t.minute
+
+
+def compile_time_of_day_rates(
+    base_rate_per_kwh: CentsPerKWh, time_of_day_prices: list[TimeOfDayPrice]
+) -> tuple[list[MilliCentsPerKWh], list[int], list[int]]:
+    """Per-minute rate and band tables for time of day prices (see
+    CompiledPlan), and the running total of rate * seconds before each
+    minute"""
+    rate_by_minute = [millicents_per_kwh(base_rate_per_kwh)] * MINUTES_PER_DAY
+    band_by_minute = [len(time_of_day_prices)] * MINUTES_PER_DAY
+    # Apply in reverse so the first applicable time of day price wins
+    for band, price in reversed(list(enumerate(time_of_day_prices))):
+        start_minute = minute_of_day(price.start_time)
+        end_minute = minute_of_day(price.end_time)
+        rate = millicents_per_kwh(price.rate_cents_per_kwh)
+        if start_minute < end_minute:
+            rate_by_minute[start_minute:end_minute] = [rate] * (
+                end_minute - start_minute
+            )
+            band_by_minute[start_minute:end_minute] = [band] * (
+                end_minute - start_minute
+            )
+        else:
+            # Wraps past midnight, or covers the whole day if start == end
+            rate_by_minute[start_minute:] = [rate] * (MINUTES_PER_DAY - start_minute)
+            rate_by_minute[:end_minute] = [rate] * end_minute
+            band_by_minute[start_minute:] = [band] * (MINUTES_PER_DAY - start_minute)
+            band_by_minute[:end_minute] = [band] * end_minute
+
+    rate_seconds_before_minute = [
+        0,
+        *itertools.accumulate(rate * 60 for rate in rate_by_minute),
+    ]
+    return rate_by_minute, band_by_minute, rate_seconds_before_minute
+
 
-    Power generation will be bought back at the base rate per kWh.
-    If needed, could be extended to handle variable buyback rates in the future, either
-    via a separate config options for buyback rates or by applying tiered rates
-    and time of day prices to generation as well.
+def compile_plan_config(plan_config: PlanConfig) -> CompiledPlan:
+    """Validates a plan config and precompiles it for pricing.
+
+    Time of day prices become a per-minute rate table, so pricing an interval
+    is a single lookup, and tiered rates become cumulative breakpoints in Wh.
+    Buyback rates by time of day get a rate table of their own.
     """
     validate_plan_config(plan_config)
 
-    total_cost_cents = 0
+    rate_by_minute, band_by_minute, rate_seconds_before_minute = (
+        compile_time_of_day_rates(
+            plan_config.base_rate_per_kwh, plan_config.time_of_day_prices
+        )
+    )
+    buyback_rate_by_minute: list[MilliCentsPerKWh] = []
+    buyback_rate_seconds_before_minute: list[int] = []
+    if plan_config.buyback.time_of_day_rates:
+        buyback_rate_by_minute, _, buyback_rate_seconds_before_minute = (
+            compile_time_of_day_rates(
+                plan_config.buyback_rate_per_kwh,
+                plan_config.buyback.time_of_day_rates,
+            )
+        )
+
+    tier_breakpoints = []
+    tier_start_wh = 0
+    for tier in plan_config.tiered_rates:
+        tier_end_wh = tier_start_wh + wh_from_kwh(tier.usage_kwh)
+        tier_breakpoints.append(
+            TierBreakpoint(
+                start_wh=tier_start_wh,
+                end_wh=tier_end_wh,
+                rate_millicents_per_kwh=millicents_per_kwh(tier.rate_cents_per_kwh),
+            )
+        )
+        tier_start_wh = tier_end_wh
+
+    return CompiledPlan(
+        plan_config=plan_config,
+        rate_by_minute=tuple(rate_by_minute),
+        rate_seconds_before_minute=tuple(rate_seconds_before_minute),
+        tier_breakpoints=tuple(tier_breakpoints),
+        band_by_minute=tuple(band_by_minute),
+        buyback_rate_by_minute=tuple(buyback_rate_by_minute),
+        buyback_rate_seconds_before_minute=tuple(buyback_rate_seconds_before_minute),
+        base_rate_millicents_per_kwh=millicents_per_kwh(plan_config.base_rate_per_kwh),
+        buyback_rate_millicents_per_kwh=millicents_per_kwh(
+            plan_config.buyback_rate_per_kwh
+        ),
+    )
+
+
+def _rate_tables(
+    compiled_plan: CompiledPlan, buyback: bool
+) -> tuple[tuple[MilliCentsPerKWh, ...], tuple[int, ...]]:
+    if buyback:
+        return (
+            compiled_plan.buyback_rate_by_minute,
+            compiled_plan.buyback_rate_seconds_before_minute,
+        )
+    return compiled_plan.rate_by_minute, compiled_plan.rate_seconds_before_minute
+
+
+def _rate_seconds_until(
+    rate_by_minute: tuple[MilliCentsPerKWh, ...],
+    rate_seconds_before_minute: tuple[int, ...],
+    local_seconds: int,
+) -> int:
+    """Integral of the rate table from local midnight to local_seconds, which
+    may run past the end of the day."""
+    days, second_of_day = divmod(local_seconds, SECONDS_PER_DAY)
+    minute, second = divmod(second_of_day, 60)
+    return (
+        days * rate_seconds_before_minute[MINUTES_PER_DAY]
+        + rate_seconds_before_minute[minute]
+        + rate_by_minute[minute] * second
+    )
+
+
+def calc_rate_seconds(
+    compiled_plan: CompiledPlan,
+    second_of_day: int,
+    duration: int,
+    buyback: bool = False,
+) -> int:
+    """Integral of the rate over an interval starting at second_of_day, so its
+    average rate is calc_rate_seconds(...) / duration. With buyback, of the
+    plan's buyback rates by time of day instead.
+
+    Intervals that straddle a rate boundary (e.g. a 30 minute interval across
+    06:00) are split proportionally between the rates they cover. Zero length
+    intervals are priced at the rate of the minute they're in, as if they
+    lasted a second.
+    """
+    rate_by_minute, rate_seconds_before_minute = _rate_tables(compiled_plan, buyback)
+    if duration <= 0:
+        return rate_by_minute[second_of_day // 60]
+    return _rate_seconds_until(
+        rate_by_minute, rate_seconds_before_minute, second_of_day + duration
+    ) - _rate_seconds_until(rate_by_minute, rate_seconds_before_minute, second_of_day)
+
+
+def calc_rate_seconds_array(
+    compiled_plan: CompiledPlan,
+    second_of_day: np.ndarray,
+    duration: np.ndarray,
+    buyback: bool = False,
+) -> np.ndarray:
+    """Vectorized calc_rate_seconds, as int64"""
+    rate_tables = _rate_tables(compiled_plan, buyback)
+    rate_by_minute = np.asarray(rate_tables[0], dtype=np.int64)
+    rate_seconds_before_minute = np.asarray(rate_tables[1], dtype=np.int64)
 
+    def rate_seconds_until(local_seconds: np.ndarray) -> np.ndarray:
+        days, local_second_of_day = np.divmod(local_seconds, SECONDS_PER_DAY)
+        minute, second = np.divmod(local_second_of_day, 60)
+        return (
+            days * rate_seconds_before_minute[MINUTES_PER_DAY]
+            + rate_seconds_before_minute[minute]
+            + rate_by_minute[minute] * second
+        )
+
+    start = np.asarray(second_of_day, dtype=np.int64)
+    duration = np.asarray(duration, dtype=np.int64)
+    return np.where(
+        duration > 0,
+        rate_seconds_until(start + duration) - rate_seconds_until(start),
+        rate_by_minute[start // 60],
+    )
+
+
+def int_dot(a: np.ndarray, b: np.ndarray) -> int:
+    """np.dot of two integer arrays as an exact Python int, falling back to
+    Python ints if the int64 sum could overflow"""
+    if not len(a):
+        return 0
+    a_max = int(np.abs(a).max())
+    b_max = int(np.abs(b).max())
+    if a_max * b_max * len(a) < 2**63:
+        return int(np.dot(a.astype(np.int64), b.astype(np.int64)))
+    return sum(map(operator.mul, a.tolist(), b.tolist()))
+
+
+def calc_time_of_day_cost(
+    compiled_plan: CompiledPlan,
+    second_of_day: np.ndarray,
+    duration: np.ndarray,
+    consumption_wh: np.ndarray,
+) -> Fraction:
+    """Exact energy cost in micro-cents of intervals priced by the plan's rate
+    table, with each interval split between the rates it covers"""
+    rate_seconds = calc_rate_seconds_array(compiled_plan, second_of_day, duration)
+    duration = np.maximum(np.asarray(duration), 1)
+    energy_cost_microcents = Fraction(0)
+    # Only divide once per distinct interval length, usually just one
+    for interval_seconds in np.unique(duration).tolist():
+        in_duration = duration == interval_seconds
+        energy_cost_microcents += Fraction(
+            int_dot(consumption_wh[in_duration], rate_seconds[in_duration]),
+            interval_seconds,
+        )
+    return energy_cost_microcents
+
+
+def calc_monthly_tiered_cost(
+    compiled_plan: CompiledPlan, monthly_consumption_total_wh: int
+) -> MicroCents:
+    """Cost of one month's consumption on a tiered plan, excluding fees"""
+    total_cost_microcents = 0
+    for tier in compiled_plan.tier_breakpoints:
+        if monthly_consumption_total_wh <= tier.start_wh:
+            break
+        total_cost_microcents += (
+            min(monthly_consumption_total_wh, tier.end_wh) - tier.start_wh
+        ) * tier.rate_millicents_per_kwh
+    tiers_end_wh = (
+        compiled_plan.tier_breakpoints[-1].end_wh
+        if compiled_plan.tier_breakpoints
+        else 0
+    )
+    total_cost_microcents += (
+        max(0, monthly_consumption_total_wh - tiers_end_wh)
+        * compiled_plan.base_rate_millicents_per_kwh
+    )
+    return MicroCents(total_cost_microcents)
+
+
+def int_dot_by_group(
+    group: np.ndarray, a: np.ndarray, b: np.ndarray, groups: int
+) -> list[int]:
+    """int_dot of two integer arrays summed by group index instead of
+    overall, as exact Python ints"""
+    if not len(a):
+        return [0] * groups
+    if int(np.abs(a).max()) * int(np.abs(b).max()) * len(a) < 2**63:
+        return sum_by_group(
+            group, a.astype(np.int64) * b.astype(np.int64), groups
+        ).tolist()
+    sums = [0] * groups
+    for index, a_value, b_value in zip(group.tolist(), a.tolist(), b.tolist()):
+        sums[index] += a_value * b_value
+    return sums
+
+
+def calc_monthly_time_of_day_cost(
+    compiled_plan: CompiledPlan,
+    group_month: np.ndarray,
+    num_of_months: int,
+    second_of_day: np.ndarray,
+    duration: np.ndarray,
+    energy_wh: np.ndarray,
+    buyback: bool = False,
+) -> list[Fraction]:
+    """calc_time_of_day_cost summed by month index (into months) rather than
+    overall, or with buyback, the credit for generation at the plan's buyback
+    rates by time of day"""
+    rate_seconds = calc_rate_seconds_array(
+        compiled_plan, second_of_day, duration, buyback
+    )
+    duration = np.maximum(np.asarray(duration), 1)
+    monthly_microcents = [Fraction(0)] * num_of_months
+    for interval_seconds in np.unique(duration).tolist():
+        in_duration = duration == interval_seconds
+        for month, wh_rate_seconds in enumerate(
+            int_dot_by_group(
+                group_month[in_duration],
+                energy_wh[in_duration],
+                rate_seconds[in_duration],
+                num_of_months,
+            )
+        ):
+            monthly_microcents[month] += Fraction(wh_rate_seconds, interval_seconds)
+    return monthly_microcents
+
+
+def calc_monthly_energy_microcents(
+    compiled_plan: CompiledPlan, usage_aggregate: UsageAggregate
+) -> list[int | Fraction]:
+    """Exact energy cost of each month's consumption, excluding fees"""
+    plan_config = compiled_plan.plan_config
+    monthly_consumption_wh = usage_aggregate.monthly_consumption_wh.tolist()
     if plan_config.tiered_rates:
+        return [
+            calc_monthly_tiered_cost(compiled_plan, consumption_wh)
+            for consumption_wh in monthly_consumption_wh
+        ]
+    if plan_config.time_of_day_prices:
+        return list(
+            calc_monthly_time_of_day_cost(
+                compiled_plan,
+                usage_aggregate.group_month,
+                len(monthly_consumption_wh),
+                usage_aggregate.second_of_day,
+                usage_aggregate.duration,
+                usage_aggregate.consumption_wh,
+            )
+        )
+    base_rate = compiled_plan.base_rate_millicents_per_kwh
+    return [consumption_wh * base_rate for consumption_wh in monthly_consumption_wh]
 
-        def calculate_monthly_tiered_cost(
-            monthly_consumption_total_kwh: float,
-        ) -> Cents:
-            total_cost_cents = 0
-            for tier in plan_config.tiered_rates:
-                if monthly_consumption_total_kwh <= 0:
-                    break
-                total_cost_cents += (
-                    min(monthly_consumption_total_kwh, tier.usage_kwh)
-                    * tier.rate_cents_per_kwh
-                )
-                monthly_consumption_total_kwh -= tier.usage_kwh
-            total_cost_cents += (
-                max(0, monthly_consumption_total_kwh) * plan_config.base_rate_per_kwh
+
+def calc_monthly_buyback_credit(
+    compiled_plan: CompiledPlan, usage_aggregate: UsageAggregate
+) -> list[int | Fraction]:
+    """Credit for each month's generation at the plan's buyback rates, before
+    netting and caps"""
+    if compiled_plan.buyback_rate_by_minute:
+        return list(
+            calc_monthly_time_of_day_cost(
+                compiled_plan,
+                usage_aggregate.group_month,
+                len(usage_aggregate.months),
+                usage_aggregate.second_of_day,
+                usage_aggregate.duration,
+                usage_aggregate.generation_wh,
+                buyback=True,
             )
-            return Cents(total_cost_cents)
-
-        monthly_consumption_total_kwh = 0
-        current_month = usage_data[0].datetime.month
-        for row in usage_data:
-            if row.datetime.month != current_month:
-                total_cost_cents += calculate_monthly_tiered_cost(
-                    monthly_consumption_total_kwh
-                )
-                # New month, reset monthly consumption
-                current_month = row.datetime.month
-                monthly_consumption_total_kwh = 0
+        )
+    buyback_rate = compiled_plan.buyback_rate_millicents_per_kwh
+    return [
+        generation_wh * buyback_rate
+        for generation_wh in usage_aggregate.monthly_generation_wh.tolist()
+    ]
 
-            monthly_consumption_total_kwh += row.consumption_kwh
-        # Add the last month's consumption
-        total_cost_cents += calculate_monthly_tiered_cost(monthly_consumption_total_kwh)
-    elif plan_config.time_of_day_prices:
-        for row in usage_data:
-            applicable_time_of_day_prices = [
-                price
-                for price in plan_config.time_of_day_prices
-                if row.datetime.time() >= price.start_time
-                or row.datetime.time() < price.end_time
+
+def limit_buyback_credit(
+    buyback: BuybackConfig,
+    energy_cost_microcents: int | Fraction,
+    credit_microcents: int | Fraction,
+) -> Fraction:
+    """The part of a month's generation credit the plan pays out, after
+    netting it against the month's energy charges and capping the rest"""
+    if buyback.max_monthly_credit is None:
+        return Fraction(credit_microcents)
+    netted_microcents = (
+        min(credit_microcents, max(energy_cost_microcents, 0))
+        if buyback.monthly_netting
+        else 0
+    )
+    return netted_microcents + min(
+        credit_microcents - netted_microcents,
+        Fraction(buyback.max_monthly_credit) * MICROCENTS_PER_CENT,
+    )
+
+
+def prices_buyback_by_month(compiled_plan: CompiledPlan) -> bool:
+    """Whether a plan's buyback needs more than the total generation: it has
+    buyback rates by time of day or caps monthly credit"""
+    return bool(
+        compiled_plan.buyback_rate_by_minute
+        or compiled_plan.plan_config.buyback.max_monthly_credit is not None
+    )
+
+
+def calc_buyback_microcents(
+    compiled_plan: CompiledPlan,
+    usage_aggregate: UsageAggregate,
+    monthly_energy_microcents: Sequence[int | Fraction] | None = None,
+) -> int | Fraction:
+    """Exact credit for all generation in the usage data.
+
+    Generation is priced from the same groups as consumption, so buyback
+    rates by time of day cost about as much as pricing a time of day plan.
+    Each month's energy cost is only needed to net credit against when it's
+    capped, and is worked out from the aggregate if not given.
+    """
+    plan_config = compiled_plan.plan_config
+    buyback = plan_config.buyback
+    if not prices_buyback_by_month(compiled_plan):
+        return (
+            int(usage_aggregate.monthly_generation_wh.sum())
+            * compiled_plan.buyback_rate_millicents_per_kwh
+        )
+    monthly_credit_microcents = calc_monthly_buyback_credit(
+        compiled_plan, usage_aggregate
+    )
+    if buyback.max_monthly_credit is None:
+        return sum(monthly_credit_microcents, Fraction(0))
+    if not buyback.monthly_netting:
+        monthly_energy_microcents = [0] * len(monthly_credit_microcents)
+    elif monthly_energy_microcents is None:
+        monthly_energy_microcents = calc_monthly_energy_microcents(
+            compiled_plan, usage_aggregate
+        )
+    return sum(
+        (
+            limit_buyback_credit(buyback, energy_microcents, credit_microcents)
+            for energy_microcents, credit_microcents in zip(
+                monthly_energy_microcents, monthly_credit_microcents
+            )
+        ),
+        Fraction(0),
+    )
+
+
+def calc_total_cost_microcents(
+    plan_config: PlanConfig,
+    energy_cost_microcents: int | Fraction,
+    num_of_months: int,
+    buyback_microcents: int | Fraction,
+) -> Fraction:
+    """Adds monthly fees to the energy cost and takes off the credit for
+    generated power (see calc_buyback_microcents)"""
+    return (
+        energy_cost_microcents
+        + Fraction(plan_config.base_monthly_fee) * MICROCENTS_PER_CENT * num_of_months
+        - buyback_microcents
+    )
+
+
+def cents_from_microcents(microcents: int | Fraction) -> Cents:
+    """Converts an exact cost to Cents, rounding only once"""
+    return Cents(float(Fraction(microcents) / MICROCENTS_PER_CENT))
+
+
+def build_cost_data(
+    plan_config: PlanConfig, total_cost_microcents: int | Fraction, num_of_months: int
+) -> CostData:
+    return CostData(
+        plan_config=plan_config,
+        total_cost=cents_from_microcents(total_cost_microcents),
+        monthly_average_cost=cents_from_microcents(
+            Fraction(total_cost_microcents) / num_of_months
+        ),
+    )
+
+
+class PlanCostAccumulator:
+    """Accumulates the cost of a single plan one usage row at a time.
+
+    Only running totals are kept (the consumption and generation in each
+    month, and for time of day prices, rate * Wh by month), so memory use
+    does not grow with the number of rows. Months are told apart by year as
+    well, and tiers and buyback limits are only applied once every row is
+    in, so rows may come in any order.
+    """
+
+    def __init__(self, plan: PlanConfig | CompiledPlan) -> None:
+        if isinstance(plan, PlanConfig):
+            plan = compile_plan_config(plan)
+        self.compiled_plan = plan
+        self.plan_config = plan.plan_config
+        # (month index, duration) -> Wh * rate seconds of time of day priced
+        # intervals, to be divided by the duration once at the end
+        self.wh_rate_seconds: dict[tuple[int, int], int] = {}
+        # The same for generation at buyback rates by time of day
+        self.generation_wh_rate_seconds: dict[tuple[int, int], int] = {}
+        # month index (year * 12 + (month - 1)) -> consumption Wh
+        self.monthly_consumption_wh: dict[int, int] = {}
+        # month index -> generation Wh
+        self.monthly_generation_wh: dict[int, int] = {}
+
+    def add_row(self, row: UsageDataRow) -> None:
+        self.add(row.datetime, row.duration, row.consumption_wh, row.generation_wh)
+
+    def add(
+        self,
+        row_datetime: datetime,
+        duration: int,
+        consumption_wh: int,
+        generation_wh: int,
+    ) -> None:
+        """Adds a single usage interval whose energy has already been
+        normalized to Wh."""
+        plan_config = self.plan_config
+        month_index = row_datetime.year * 12 + row_datetime.month - 1
+        self.monthly_consumption_wh[month_index] = (
+            self.monthly_consumption_wh.get(month_index, 0) + consumption_wh
+        )
+        self.monthly_generation_wh[month_index] = (
+            self.monthly_generation_wh.get(month_index, 0) + generation_wh
+        )
+
+        # Tiered and flat rate plans, and flat buyback rates, are priced from
+        # the monthly totals
+        if not (
+            plan_config.time_of_day_prices or self.compiled_plan.buyback_rate_by_minute
+        ):
+            return
+        second_of_day = (
+            row_datetime.hour * 3600 + row_datetime.minute * 60 + row_datetime.second
+        )
+        key = (month_index, max(duration, 1))
+        if plan_config.time_of_day_prices:
+            self.wh_rate_seconds[key] = self.wh_rate_seconds.get(
+                key, 0
+            ) + consumption_wh * calc_rate_seconds(
+                self.compiled_plan, second_of_day, duration
+            )
+        if self.compiled_plan.buyback_rate_by_minute:
+            self.generation_wh_rate_seconds[key] = self.generation_wh_rate_seconds.get(
+                key, 0
+            ) + generation_wh * calc_rate_seconds(
+                self.compiled_plan, second_of_day, duration, buyback=True
+            )
+
+    def result(self) -> CostData:
+        plan_config = self.plan_config
+        months = list(self.monthly_consumption_wh)
+
+        def by_month(wh_rate_seconds: dict[tuple[int, int], int]) -> list[Fraction]:
+            monthly_microcents = dict.fromkeys(months, Fraction(0))
+            for (month_index, duration), value in wh_rate_seconds.items():
+                monthly_microcents[month_index] += Fraction(value, duration)
+            return list(monthly_microcents.values())
+
+        monthly_energy_microcents: list[int | Fraction]
+        if plan_config.tiered_rates:
+            # Tiers reset every month
+            monthly_energy_microcents = [
+                calc_monthly_tiered_cost(self.compiled_plan, consumption_wh)
+                for consumption_wh in self.monthly_consumption_wh.values()
             ]
-            if not applicable_time_of_day_prices:
-                # If no time of day price applies, use the base rate
-                total_cost_cents += row.consumption_kwh * plan_config.base_rate_per_kwh
-            else:
-                # Use the first applicable time of day price
-                total_cost_cents += (
-                    row.consumption_kwh
-                    * applicable_time_of_day_prices[0].rate_cents_per_kwh
+        elif plan_config.time_of_day_prices:
+            monthly_energy_microcents = list(by_month(self.wh_rate_seconds))
+        else:
+            # Flat rate plan
+            monthly_energy_microcents = [
+                consumption_wh * self.compiled_plan.base_rate_millicents_per_kwh
+                for consumption_wh in self.monthly_consumption_wh.values()
+            ]
+
+        monthly_credit_microcents: list[int | Fraction]
+        if self.compiled_plan.buyback_rate_by_minute:
+            monthly_credit_microcents = list(by_month(self.generation_wh_rate_seconds))
+        else:
+            monthly_credit_microcents = [
+                self.monthly_generation_wh[month_index]
+                * self.compiled_plan.buyback_rate_millicents_per_kwh
+                for month_index in months
+            ]
+
+        num_of_months = len(months)
+        return build_cost_data(
+            plan_config,
+            calc_total_cost_microcents(
+                plan_config,
+                sum(monthly_energy_microcents, Fraction(0)),
+                num_of_months,
+                sum(
+                    (
+                        limit_buyback_credit(
+                            plan_config.buyback, energy_microcents, credit_microcents
+                        )
+                        for energy_microcents, credit_microcents in zip(
+                            monthly_energy_microcents, monthly_credit_microcents
+                        )
+                    ),
+                    Fraction(0),
+                ),
+            ),
+            num_of_months,
+        )
+
+
+def calc_plan_costs_by_row(
+    plan_configs: Iterable[PlanConfig | CompiledPlan],
+    usage_rows: Iterable[UsageDataRow],
+) -> list[CostData]:
+    """Reference implementation of calc_plan_costs: every plan accumulates its
+    cost row by row. Much slower, but simple enough to check the other
+    pricing paths against.
+    """
+    accumulators = [PlanCostAccumulator(plan_config) for plan_config in plan_configs]
+    for row in usage_rows:
+        # Normalize once per row rather than once per plan
+        consumption_wh = row.consumption_wh
+        generation_wh = row.generation_wh
+        for accumulator in accumulators:
+            accumulator.add(row.datetime, row.duration, consumption_wh, generation_wh)
+    return [accumulator.result() for accumulator in accumulators]
+
+
+def band_names(plan_config: PlanConfig) -> list[str]:
+    """Names of the bands a plan's energy cost is broken down into: its tiers
+    or time of day prices, then the base rate"""
+    if plan_config.tiered_rates:
+        names = [f"Tier {tier}" for tier in range(1, len(plan_config.tiered_rates) + 1)]
+    else:
+        names = [
+            f"{price.start_time:%H:%M}-{price.end_time:%H:%M}"
+            for price in plan_config.time_of_day_prices
+        ]
+    return [*names, "Base rate"]
+
+
+def calc_monthly_band_costs(
+    compiled_plan: CompiledPlan, usage_aggregate: UsageAggregate
+) -> list[list[tuple[Fraction, Fraction]]]:
+    """Exact (Wh, micro-cents) of each month's consumption priced in each of
+    the plan's bands (see band_names), excluding fees and buyback"""
+    plan_config = compiled_plan.plan_config
+    base_rate = compiled_plan.base_rate_millicents_per_kwh
+    monthly_band_costs = []
+    if plan_config.time_of_day_prices:
+        band_by_minute = np.asarray(compiled_plan.band_by_minute, dtype=np.intp)
+        rate_by_minute = np.asarray(compiled_plan.rate_by_minute, dtype=np.int64)
+        bands = len(plan_config.time_of_day_prices) + 1
+        for month in range(len(usage_aggregate.months)):
+            band_wh = [Fraction(0)] * bands
+            band_microcents = [Fraction(0)] * bands
+            for (
+                duration,
+                wh_seconds,
+            ) in usage_aggregate.consumption_wh_seconds_by_minute(month).items():
+                wh_seconds_by_band = sum_by_group(band_by_minute, wh_seconds, bands)
+                rate_wh_seconds_by_band = sum_by_group(
+                    band_by_minute, wh_seconds * rate_by_minute, bands
                 )
+                for band in range(bands):
+                    band_wh[band] += Fraction(int(wh_seconds_by_band[band]), duration)
+                    band_microcents[band] += Fraction(
+                        int(rate_wh_seconds_by_band[band]), duration
+                    )
+            monthly_band_costs.append(list(zip(band_wh, band_microcents)))
+        return monthly_band_costs
+
+    tiers_end_wh = (
+        compiled_plan.tier_breakpoints[-1].end_wh
+        if compiled_plan.tier_breakpoints
+        else 0
+    )
+    for consumption_wh in usage_aggregate.monthly_consumption_wh.tolist():
+        band_costs = []
+        for tier in compiled_plan.tier_breakpoints:
+            tier_wh = min(
+                max(consumption_wh - tier.start_wh, 0), tier.end_wh - tier.start_wh
+            )
+            band_costs.append(
+                (Fraction(tier_wh), Fraction(tier_wh * tier.rate_millicents_per_kwh))
+            )
+        base_wh = max(consumption_wh - tiers_end_wh, 0)
+        band_costs.append((Fraction(base_wh), Fraction(base_wh * base_rate)))
+        monthly_band_costs.append(band_costs)
+    return monthly_band_costs
+
+
+def calc_cost_breakdown(
+    compiled_plan: CompiledPlan,
+    usage_aggregate: UsageAggregate,
+    breakdown: Breakdown = "monthly",
+) -> CostData:
+    """calc_aggregate_plan_cost, pricing each month's bill by band on the way.
+
+    The total is the sum of the monthly bills, which are exact, so it's the
+    same as pricing without a breakdown. The daily series is downsampled from
+    the monthly bills rather than priced separately: each day gets its
+    month's energy cost in proportion to its consumption (exact for flat
+    plans), an even share of the month's fees, and its month's buyback credit
+    in proportion to its generation.
+
+    Raises:
+        ValueError: a daily breakdown was asked for from an aggregate without
+            daily totals
+    """
+    plan_config = compiled_plan.plan_config
+    fee_microcents = Fraction(plan_config.base_monthly_fee) * MICROCENTS_PER_CENT
+    names = band_names(plan_config)
+
+    monthly_costs = []
+    monthly_energy_microcents = []
+    monthly_buyback_microcents = []
+    total_cost_microcents = Fraction(0)
+    for (
+        month_index,
+        consumption_wh,
+        generation_wh,
+        band_costs,
+        credit_microcents,
+    ) in zip(
+        usage_aggregate.months.tolist(),
+        usage_aggregate.monthly_consumption_wh.tolist(),
+        usage_aggregate.monthly_generation_wh.tolist(),
+        calc_monthly_band_costs(compiled_plan, usage_aggregate),
+        calc_monthly_buyback_credit(compiled_plan, usage_aggregate),
+    ):
+        energy_microcents = sum(
+            (band_microcents for _, band_microcents in band_costs), Fraction(0)
+        )
+        buyback_microcents = limit_buyback_credit(
+            plan_config.buyback, energy_microcents, credit_microcents
+        )
+        month_total_microcents = energy_microcents + fee_microcents - buyback_microcents
+        monthly_energy_microcents.append(energy_microcents)
+        monthly_buyback_microcents.append(buyback_microcents)
+        total_cost_microcents += month_total_microcents
+        year, month = divmod(month_index, 12)
+        monthly_costs.append(
+            MonthlyCost(
+                month=f"{year:04d}-{month + 1:02d}",
+                consumption_kwh=consumption_wh / 1000,
+                generation_kwh=generation_wh / 1000,
+                energy_cost=cents_from_microcents(energy_microcents),
+                fees=cents_from_microcents(fee_microcents),
+                buyback=cents_from_microcents(buyback_microcents),
+                total_cost=cents_from_microcents(month_total_microcents),
+                bands=tuple(
+                    BandCost(
+                        band=name,
+                        consumption_kwh=float(band_wh / 1000),
+                        cost=cents_from_microcents(band_microcents),
+                    )
+                    for name, (band_wh, band_microcents) in zip(names, band_costs)
+                ),
+            )
+        )
+
+    cost_data = build_cost_data(
+        plan_config, total_cost_microcents, len(monthly_costs)
+    )._replace(monthly_costs=tuple(monthly_costs))
+    if breakdown != "daily":
+        return cost_data
+    if not len(usage_aggregate.days):
+        raise ValueError("Usage data has no daily totals to break down.")
+
+    day_months = (
+        usage_aggregate.days.astype("datetime64[D]")
+        .astype("datetime64[M]")
+        .astype(np.int64)
+        + 1970 * 12
+    )
+    day_month = np.searchsorted(usage_aggregate.months, day_months).tolist()
+    days_in_month = np.bincount(day_month, minlength=len(monthly_costs)).tolist()
+    monthly_consumption_wh = usage_aggregate.monthly_consumption_wh.tolist()
+    monthly_generation_wh = usage_aggregate.monthly_generation_wh.tolist()
+
+    def share(amount: Fraction, part: int, whole: int) -> Fraction:
+        return amount * part / whole if whole else Fraction(0)
+
+    daily_costs = []
+    for day, month, consumption_wh, generation_wh in zip(
+        usage_aggregate.days.tolist(),
+        day_month,
+        usage_aggregate.daily_consumption_wh.tolist(),
+        usage_aggregate.daily_generation_wh.tolist(),
+    ):
+        daily_costs.append(
+            DailyCost(
+                date=date.fromordinal(day + EPOCH_ORDINAL).isoformat(),
+                consumption_kwh=consumption_wh / 1000,
+                generation_kwh=generation_wh / 1000,
+                total_cost=cents_from_microcents(
+                    share(
+                        monthly_energy_microcents[month],
+                        consumption_wh,
+                        monthly_consumption_wh[month],
+                    )
+                    + fee_microcents / days_in_month[month]
+                    - share(
+                        monthly_buyback_microcents[month],
+                        generation_wh,
+                        monthly_generation_wh[month],
+                    )
+                ),
+            )
+        )
+    return cost_data._replace(daily_costs=tuple(daily_costs))
+
+
+def calc_aggregate_plan_cost(
+    plan: PlanConfig | CompiledPlan,
+    usage_aggregate: UsageAggregate,
+    breakdown: Breakdown | None = None,
+) -> CostData:
+    """Calculate the cost of a plan from usage data that has already been
+    reduced to a UsageAggregate, without looking at individual rows.
+
+    Energy is priced exactly, in integer Wh * milli-cents per kWh (micro-cents), and
+    only converted to Cents at the end, so the result doesn't depend on how
+    the usage data was ordered or split up before it was aggregated.
+
+    With a breakdown, the cost is priced month by month instead and each
+    month's bill, and optionally a cost for each day, are returned with it
+    (see calc_cost_breakdown).
+
+    Raises:
+        ValueError: the usage data is empty
+    """
+    compiled_plan = compile_plan_config(plan) if isinstance(plan, PlanConfig) else plan
+    plan_config = compiled_plan.plan_config
+    num_of_months = len(usage_aggregate.months)
+    if not num_of_months:
+        raise ValueError("Usage data is empty.")
+    if breakdown is not None:
+        return calc_cost_breakdown(compiled_plan, usage_aggregate, breakdown)
+
+    buyback = plan_config.buyback
+    monthly_energy_microcents: list[int | Fraction] | None = None
+    if plan_config.tiered_rates or (
+        # Capped credit is netted against each month's energy cost
+        buyback.monthly_netting
+        and buyback.max_monthly_credit is not None
+    ):
+        monthly_energy_microcents = calc_monthly_energy_microcents(
+            compiled_plan, usage_aggregate
+        )
+        energy_cost_microcents: int | Fraction = sum(
+            monthly_energy_microcents, Fraction(0)
+        )
+    elif plan_config.time_of_day_prices:
+        energy_cost_microcents = calc_time_of_day_cost(
+            compiled_plan,
+            usage_aggregate.second_of_day,
+            usage_aggregate.duration,
+            usage_aggregate.consumption_wh,
+        )
     else:
         # Flat rate plan
-        total_consumption_kwh = sum(row.consumption_kwh for row in usage_data)
-        total_cost_cents += total_consumption_kwh * plan_config.base_rate_per_kwh
+        energy_cost_microcents = (
+            int(usage_aggregate.monthly_consumption_wh.sum())
+            * compiled_plan.base_rate_millicents_per_kwh
+        )
 
-    num_of_months = len(set(row.datetime.strftime("%Y-%m") for row in usage_data))
-    total_cost_cents += plan_config.base_monthly_fee * num_of_months
+    return build_cost_data(
+        plan_config,
+        calc_total_cost_microcents(
+            plan_config,
+            energy_cost_microcents,
+            num_of_months,
+            calc_buyback_microcents(
+                compiled_plan, usage_aggregate, monthly_energy_microcents
+            ),
+        ),
+        num_of_months,
+    )
 
-    # Buy back any generated power at the base rate
-    # TODO: variable buyback rates
-    total_generation_kwh = sum(row.generation_kwh for row in usage_data)
-    total_cost_cents -= total_generation_kwh * plan_config.base_rate_per_kwh
 
-    return CostData(
-        plan_config=plan_config,
-        total_cost=Cents(total_cost_cents),
-        monthly_average_cost=Cents(total_cost_cents / num_of_months),
-    )
+def calc_plan_costs(
+    plan_configs: Iterable[PlanConfig | CompiledPlan],
+    usage_rows: Iterable[UsageDataRow] | UsageAggregate,
+    breakdown: Breakdown | None = None,
+) -> list[CostData]:
+    """Calculate the cost of every plan with a single pass over the usage rows.
+
+    The rows are first reduced to a UsageAggregate, which every plan is then
+    priced from, so adding plans barely adds to the cost. usage_rows may be a
+    generator (see iter_usage_data_csv), in which case the usage data is never
+    held in memory all at once, or an already reduced UsageAggregate.
+
+    Plans may be given precompiled (see compile_plan_config and PlanCatalog)
+    to skip validating and compiling them on every call. breakdown adds each
+    plan's monthly bills, and daily costs, see calc_cost_breakdown.
+    """
+    compiled_plans = [
+        compile_plan_config(plan) if isinstance(plan, PlanConfig) else plan
+        for plan in plan_configs
+    ]
+    if isinstance(usage_rows, UsageAggregate):
+        usage_aggregate = usage_rows
+    elif isinstance(usage_rows, UsageData):
+        usage_aggregate = UsageAggregate.from_usage_data(usage_rows)
+    else:
+        usage_aggregate = UsageAggregate.from_usage_rows(usage_rows)
+    return [
+        calc_aggregate_plan_cost(compiled_plan, usage_aggregate, breakdown)
+        for compiled_plan in compiled_plans
+    ]
+
+
+def calc_plan_cost(
+    plan_config: PlanConfig,
+    usage_data: UsageData,
+    breakdown: Breakdown | None = None,
+) -> CostData:
+    """Calculate the cost of a given plan and usage data in cents.
+
+    Handles flat rates, tiered rates, monthly fees, and time of day prices.
+
+    Tiered rates and time of day prices are mutually exclusive in a plan as of now;
+    see validate_plan_config for more details on options.
+
+    Power generation is bought back at the plan's buyback rates, the base rate
+    per kWh unless configured otherwise, see BuybackConfig.
+
+    breakdown adds the bill for each month, split into energy by tier or time
+    of day price, fees and buyback, or those and a cost for each day.
+    """
+    return calc_plan_costs([plan_config], usage_data, breakdown)[0]
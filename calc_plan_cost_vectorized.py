@@ -0,0 +1,106 @@
+from typing import BinaryIO, Iterable
+
+import numpy as np
+
+from calc_plan_cost import (
+    build_cost_data,
+    calc_buyback_microcents,
+    calc_time_of_day_cost,
+    calc_total_cost_microcents,
+    compile_plan_config,
+    prices_buyback_by_month,
+)
+from custom_types import CompiledPlan, CostData, PlanConfig
+from parse_usage_data import parse_usage_data_csv
+from usage_aggregate import UsageAggregate, UsageColumns, sum_by_group
+
+
+def parse_usage_columns_csv(csv_file: BinaryIO) -> UsageColumns:
+    """Parses a CSV file into UsageColumns"""
+    return UsageColumns.from_usage_data(parse_usage_data_csv(csv_file))
+
+
+def calc_plan_cost_vectorized(
+    plan: PlanConfig | CompiledPlan, usage_columns: UsageColumns
+) -> CostData:
+    """Calculate the cost of a given plan with array reductions instead of a
+    Python loop over every row.
+
+    Mirrors calc_plan_cost, which remains the reference implementation, except
+    that tiered months are grouped by (year, month) rather than by detecting
+    month changes between consecutive rows.
+
+    Raises:
+        ValueError: the usage data is empty
+    """
+    compiled_plan = compile_plan_config(plan) if isinstance(plan, PlanConfig) else plan
+    plan_config = compiled_plan.plan_config
+
+    months, row_month = np.unique(usage_columns.month_index, return_inverse=True)
+    num_of_months = len(months)
+    if not num_of_months:
+        raise ValueError("Usage data is empty.")
+
+    if plan_config.tiered_rates:
+        monthly_wh = sum_by_group(
+            row_month, usage_columns.consumption_wh, num_of_months
+        )
+        energy_cost_microcents = 0
+        for tier in compiled_plan.tier_breakpoints:
+            energy_cost_microcents += (
+                int(
+                    np.clip(
+                        monthly_wh - tier.start_wh, 0, tier.end_wh - tier.start_wh
+                    ).sum()
+                )
+                * tier.rate_millicents_per_kwh
+            )
+        energy_cost_microcents += (
+            int(
+                np.maximum(
+                    monthly_wh - compiled_plan.tier_breakpoints[-1].end_wh, 0
+                ).sum()
+            )
+            * compiled_plan.base_rate_millicents_per_kwh
+        )
+    elif plan_config.time_of_day_prices:
+        energy_cost_microcents = calc_time_of_day_cost(
+            compiled_plan,
+            usage_columns.second_of_day,
+            usage_columns.duration,
+            usage_columns.consumption_wh,
+        )
+    else:
+        # Flat rate plan
+        energy_cost_microcents = (
+            int(usage_columns.consumption_wh.sum())
+            * compiled_plan.base_rate_millicents_per_kwh
+        )
+
+    if prices_buyback_by_month(compiled_plan):
+        buyback_microcents = calc_buyback_microcents(
+            compiled_plan, UsageAggregate.from_usage_columns(usage_columns)
+        )
+    else:
+        buyback_microcents = (
+            int(usage_columns.generation_wh.sum())
+            * compiled_plan.buyback_rate_millicents_per_kwh
+        )
+
+    return build_cost_data(
+        plan_config,
+        calc_total_cost_microcents(
+            plan_config, energy_cost_microcents, num_of_months, buyback_microcents
+        ),
+        num_of_months,
+    )
+
+
+def calc_plan_costs_vectorized(
+    plan_configs: Iterable[PlanConfig | CompiledPlan], usage_columns: UsageColumns
+) -> list[CostData]:
+    """Calculate the cost of every plan against the same columnar usage data"""
+    return [
+        calc_plan_cost_vectorized(plan_config, usage_columns)
+        for plan_config in plan_configs
+    ]
@@ -1,8 +1,23 @@
-from typing import Literal, NamedTuple, NewType
-from datetime import datetime, time
+from array import array
+from collections.abc import Iterable, Iterator, Sequence
+from typing import Literal, NamedTuple, NewType, overload
+from datetime import date, datetime, time, timedelta, timezone
 
-CentsPerKWh = NewType("CentsPerKWh", int)
+import numpy as np
+
+MINUTES_PER_DAY = 24 * 60
+SECONDS_PER_DAY = MINUTES_PER_DAY * 60
+# Local days are counted from 1970-01-01, like numpy's datetime64[D]
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+CentsPerKWh = NewType("CentsPerKWh", float)
 Cents = NewType("Cents", float)
+# Rates are compiled to whole milli-cents per kWh (see compile_plan_config)
+MilliCentsPerKWh = NewType("MilliCentsPerKWh", int)
+MILLICENTS_PER_CENT = 1000
+# Wh * milli-cents per kWh, the exact unit energy is priced in
+MicroCents = NewType("MicroCents", int)
+MICROCENTS_PER_CENT = 1_000_000
 Seconds = NewType("Seconds", int)
 WattHourUnit = Literal["Wh", "kWh"]
 
@@ -14,6 +29,14 @@ class UsageDataRow(NamedTuple):
     consumption: int = 0
     generation: int = 0
 
+    @property
+    def consumption_wh(self) -> int:
+        return self.consumption * WATT_HOURS_PER_UNIT[self.unit]
+
+    @property
+    def generation_wh(self) -> int:
+        return self.generation * WATT_HOURS_PER_UNIT[self.unit]
+
     @property
     def consumption_kwh(self) -> float:
         match self.unit:
@@ -35,7 +58,203 @@ class UsageDataRow(NamedTuple):
                 raise ValueError(f"Unsupported unit: {self.unit}")
 
 
-UsageData = list[UsageDataRow]
+WATT_HOURS_PER_UNIT: dict[WattHourUnit, int] = {"Wh": 1, "kWh": 1000}
+
+
+def _timezone_for_offset(
+    offset_seconds: int, _cache: dict[int, timezone] = {}
+) -> timezone:
+    tz = _cache.get(offset_seconds)
+    if tz is None:
+        tz = _cache[offset_seconds] = timezone(timedelta(seconds=offset_seconds))
+    return tz
+
+
+class MonthRange(NamedTuple):
+    """Rows [start, stop) of a UsageData, which all fall in the same local
+    calendar month"""
+
+    start: int
+    stop: int
+    month_index: int  # year * 12 + (month - 1)
+
+    @property
+    def year(self) -> int:
+        return self.month_index // 12
+
+    @property
+    def month(self) -> int:
+        return self.month_index % 12 + 1
+
+
+class UsageData(Sequence[UsageDataRow]):
+    """Compact, array-backed sequence of UsageDataRows.
+
+    Each row is stored as five machine integers (epoch seconds, UTC offset,
+    duration, and consumption/generation normalized to Wh) instead of a
+    NamedTuple holding a datetime and a unit string. Indexing and iterating
+    build UsageDataRow views on demand, so code written against a list of
+    rows keeps working; rows always come back with a "Wh" unit.
+
+    The columns may be any buffers of the right item type (array.array or a
+    memoryview cast to "q"/"i"), which lets callers hand in zero-copy views.
+    Naive datetimes are stored as UTC and sub-second precision is dropped.
+
+    Alongside the columns, appending keeps a month index: where each run of
+    rows in the same local calendar month starts (see month_ranges), so
+    pricing never has to work out rows' months again.
+    """
+
+    COLUMNS = ("epoch_seconds", "utc_offset", "duration", "consumption", "generation")
+    __slots__ = (*COLUMNS, "_month_starts", "_month_indexes")
+
+    def __init__(self, rows: Iterable[UsageDataRow] = ()) -> None:
+        self.epoch_seconds: Sequence[int] = array("q")
+        self.utc_offset: Sequence[int] = array("i")
+        self.duration: Sequence[int] = array("i")
+        self.consumption: Sequence[int] = array("q")
+        self.generation: Sequence[int] = array("q")
+        self._month_starts: array | None = array("q")
+        self._month_indexes: array | None = array("i")
+        self.extend(rows)
+
+    @classmethod
+    def from_columns(
+        cls,
+        epoch_seconds: Sequence[int],
+        utc_offset: Sequence[int],
+        duration: Sequence[int],
+        consumption: Sequence[int],
+        generation: Sequence[int],
+    ) -> "UsageData":
+        """Wraps existing Wh columns without copying them."""
+        if not (
+            len(epoch_seconds)
+            == len(utc_offset)
+            == len(duration)
+            == len(consumption)
+            == len(generation)
+        ):
+            raise ValueError("All usage data columns must be the same length.")
+        usage_data = cls.__new__(cls)
+        usage_data.epoch_seconds = epoch_seconds
+        usage_data.utc_offset = utc_offset
+        usage_data.duration = duration
+        usage_data.consumption = consumption
+        usage_data.generation = generation
+        # Built from the columns the first time it's needed
+        usage_data._month_starts = usage_data._month_indexes = None
+        return usage_data
+
+    def append(self, row: UsageDataRow) -> None:
+        row_datetime = row.datetime
+        utc_offset = row_datetime.utcoffset()
+        if utc_offset is None:
+            row_datetime = row_datetime.replace(tzinfo=timezone.utc)
+            utc_offset = timedelta(0)
+        watt_hours_per_unit = WATT_HOURS_PER_UNIT[row.unit]
+        if self._month_starts is not None and self._month_indexes is not None:
+            month_index = row_datetime.year * 12 + row_datetime.month - 1
+            if not self._month_indexes or self._month_indexes[-1] != month_index:
+                self._month_starts.append(len(self))
+                self._month_indexes.append(month_index)
+        self.epoch_seconds.append(int(row_datetime.timestamp()))
+        self.utc_offset.append(int(utc_offset.total_seconds()))
+        self.duration.append(row.duration)
+        self.consumption.append(row.consumption * watt_hours_per_unit)
+        self.generation.append(row.generation * watt_hours_per_unit)
+
+    def extend(self, rows: Iterable[UsageDataRow]) -> None:
+        for row in rows:
+            self.append(row)
+
+    def _build_month_index(self) -> tuple[array, array]:
+        if self._month_starts is None or self._month_indexes is None:
+            local_seconds = np.asarray(self.epoch_seconds, dtype=np.int64) + np.asarray(
+                self.utc_offset, dtype=np.int64
+            )
+            month_index = local_seconds.astype("datetime64[s]").astype(
+                "datetime64[M]"
+            ).astype(np.int64) + (1970 * 12)
+            starts = np.flatnonzero(np.diff(month_index, prepend=-1))
+            self._month_starts = array("q", starts.tolist())
+            self._month_indexes = array("i", month_index[starts].tolist())
+        return self._month_starts, self._month_indexes
+
+    @property
+    def month_ranges(self) -> list[MonthRange]:
+        """Consecutive runs of rows in the same local calendar month, in row
+        order. Unsorted data can have several runs for the same month."""
+        starts, month_indexes = self._build_month_index()
+        stops = [*starts[1:], len(self)]
+        return [
+            MonthRange(start, stop, month_index)
+            for start, stop, month_index in zip(starts, stops, month_indexes)
+        ]
+
+    @property
+    def months(self) -> set[int]:
+        """The month indexes (year * 12 + (month - 1)) with any rows"""
+        return set(self._build_month_index()[1])
+
+    def row_month_indexes(self) -> np.ndarray:
+        """Every row's month index, expanded from the month ranges"""
+        starts, month_indexes = self._build_month_index()
+        return np.repeat(
+            np.asarray(month_indexes, dtype=np.int32),
+            np.diff(np.asarray(starts, dtype=np.int64), append=len(self)),
+        )
+
+    def row(self, index: int) -> UsageDataRow:
+        return UsageDataRow(
+            datetime=datetime.fromtimestamp(
+                self.epoch_seconds[index],
+                _timezone_for_offset(self.utc_offset[index]),
+            ),
+            duration=Seconds(self.duration[index]),
+            unit="Wh",
+            consumption=self.consumption[index],
+            generation=self.generation[index],
+        )
+
+    def __len__(self) -> int:
+        return len(self.epoch_seconds)
+
+    @overload
+    def __getitem__(self, index: int) -> UsageDataRow: ...
+
+    @overload
+    def __getitem__(self, index: slice) -> "UsageData": ...
+
+    def __getitem__(self, index: int | slice) -> "UsageDataRow | UsageData":
+        if isinstance(index, slice):
+            return UsageData.from_columns(
+                self.epoch_seconds[index],
+                self.utc_offset[index],
+                self.duration[index],
+                self.consumption[index],
+                self.generation[index],
+            )
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("UsageData index out of range")
+        return self.row(index)
+
+    def __iter__(self) -> Iterator[UsageDataRow]:
+        for index in range(len(self)):
+            yield self.row(index)
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, UsageData):
+            return NotImplemented
+        return all(
+            list(getattr(self, column)) == list(getattr(other, column))
+            for column in self.COLUMNS
+        )
+
+    def __repr__(self) -> str:
+        return f"UsageData({list(self)!r})"
 
 
 def format_currency(amount: Cents | CentsPerKWh) -> str:
@@ -56,7 +275,7 @@ class TimeOfDayPrice(NamedTuple):
 
 
 class TieredRate(NamedTuple):
-    usage_kwh: int
+    usage_kwh: float
     rate_cents_per_kwh: CentsPerKWh
 
     def to_api_json(self) -> dict:
@@ -66,15 +285,100 @@ class TieredRate(NamedTuple):
         }
 
 
+def _time_of_day_prices_from_json(data: list[dict]) -> list[TimeOfDayPrice]:
+    return [
+        TimeOfDayPrice(
+            start_time=time.fromisoformat(todp["start_time"]),
+            end_time=time.fromisoformat(todp["end_time"]),
+            rate_cents_per_kwh=CentsPerKWh(todp["rate_cents_per_kwh"]),
+        )
+        for todp in data
+    ]
+
+
+def _time_of_day_prices_to_json(prices: list[TimeOfDayPrice]) -> list[dict]:
+    return [
+        {
+            "start_time": todp.start_time.strftime("%H:%M"),
+            "end_time": todp.end_time.strftime("%H:%M"),
+            "rate_cents_per_kwh": todp.rate_cents_per_kwh,
+        }
+        for todp in prices
+    ]
+
+
+class BuybackConfig(NamedTuple):
+    """How a plan credits generation. By default it's bought back at the
+    plan's base rate, in full."""
+
+    rate_cents_per_kwh: CentsPerKWh | None = None  # the plan's base rate if None
+    # Optional buyback rates by time of day, the first applicable one wins
+    time_of_day_rates: list[TimeOfDayPrice] = []
+    # Each month's credit first offsets that month's energy charges, and only
+    # the excess counts towards max_monthly_credit
+    monthly_netting: bool = False
+    max_monthly_credit: Cents | None = None  # Optional cap on credit per month
+
+    def to_api_json(self) -> dict:
+        return {
+            "rate_cents_per_kwh": (
+                None
+                if self.rate_cents_per_kwh is None
+                else format_currency(self.rate_cents_per_kwh)
+            ),
+            "time_of_day_rates": [
+                todp.to_api_json() for todp in self.time_of_day_rates
+            ],
+            "monthly_netting": self.monthly_netting,
+            "max_monthly_credit": (
+                None
+                if self.max_monthly_credit is None
+                else format_currency(self.max_monthly_credit)
+            ),
+        }
+
+    @classmethod
+    def from_json(cls, data: dict) -> "BuybackConfig":
+        rate = data.get("rate_cents_per_kwh")
+        max_monthly_credit = data.get("max_monthly_credit")
+        return cls(
+            rate_cents_per_kwh=None if rate is None else CentsPerKWh(rate),
+            time_of_day_rates=_time_of_day_prices_from_json(
+                data.get("time_of_day_rates", [])
+            ),
+            monthly_netting=bool(data.get("monthly_netting", False)),
+            max_monthly_credit=(
+                None if max_monthly_credit is None else Cents(max_monthly_credit)
+            ),
+        )
+
+    def to_json(self) -> dict:
+        return {
+            "rate_cents_per_kwh": self.rate_cents_per_kwh,
+            "time_of_day_rates": _time_of_day_prices_to_json(self.time_of_day_rates),
+            "monthly_netting": self.monthly_netting,
+            "max_monthly_credit": self.max_monthly_credit,
+        }
+
+
 class PlanConfig(NamedTuple):
     name: str
     base_rate_per_kwh: CentsPerKWh
     base_monthly_fee: Cents = Cents(0)  # Optional monthly fee
     tiered_rates: list[TieredRate] = []  # Optional ordered tiered rates
     time_of_day_prices: list[TimeOfDayPrice] = []
+    buyback: BuybackConfig = BuybackConfig()
+
+    @property
+    def buyback_rate_per_kwh(self) -> CentsPerKWh:
+        """Rate generation is bought back at outside any buyback time of day
+        rates"""
+        if self.buyback.rate_cents_per_kwh is None:
+            return self.base_rate_per_kwh
+        return self.buyback.rate_cents_per_kwh
 
     def to_api_json(self) -> dict:
-        return {
+        api_json = {
             "plan_name": self.name,
             "plan_base_rate": format_currency(self.base_rate_per_kwh),
             "plan_base_monthly_fee": format_currency(self.base_monthly_fee),
@@ -85,6 +389,9 @@ class PlanConfig(NamedTuple):
                 todp.to_api_json() for todp in self.time_of_day_prices
             ],
         }
+        if self.buyback != BuybackConfig():
+            api_json["plan_buyback"] = self.buyback.to_api_json()
+        return api_json
 
     @classmethod
     def from_json(cls, data: dict) -> "PlanConfig":
@@ -99,25 +406,142 @@ class PlanConfig(NamedTuple):
                 )
                 for tr in data.get("tiered_rates", [])
             ],
-            time_of_day_prices=[
-                TimeOfDayPrice(
-                    start_time=time.fromisoformat(todp["start_time"]),
-                    end_time=time.fromisoformat(todp["end_time"]),
-                    rate_cents_per_kwh=CentsPerKWh(todp["rate_cents_per_kwh"]),
-                )
-                for todp in data.get("time_of_day_prices", [])
-            ],
+            time_of_day_prices=_time_of_day_prices_from_json(
+                data.get("time_of_day_prices", [])
+            ),
+            buyback=BuybackConfig.from_json(data.get("buyback", {})),
         )
 
+    def to_json(self) -> dict:
+        """The plan in the plan_configs.json format, the inverse of from_json"""
+        return {
+            "name": self.name,
+            "base_rate_per_kwh": self.base_rate_per_kwh,
+            "base_monthly_fee": self.base_monthly_fee,
+            "tiered_rates": [
+                {
+                    "usage_kwh": tiered_rate.usage_kwh,
+                    "rate_cents_per_kwh": tiered_rate.rate_cents_per_kwh,
+                }
+                for tiered_rate in self.tiered_rates
+            ],
+            "time_of_day_prices": _time_of_day_prices_to_json(self.time_of_day_prices),
+            "buyback": self.buyback.to_json(),
+        }
+
+
+class TierBreakpoint(NamedTuple):
+    """A tier's cumulative monthly usage range, start_wh < usage <= end_wh"""
+
+    start_wh: int
+    end_wh: int
+    rate_millicents_per_kwh: MilliCentsPerKWh
+
+
+class CompiledPlan(NamedTuple):
+    """A PlanConfig precompiled into the lookup tables the pricing engine uses"""
+
+    plan_config: PlanConfig
+    # Rates are in milli-cents per kWh, indexed by local minute of day
+    rate_by_minute: tuple[MilliCentsPerKWh, ...]
+    # Running total of rate * seconds from midnight up to the start of each
+    # minute (MINUTES_PER_DAY + 1 entries), for pricing intervals that span
+    # several minutes in constant time
+    rate_seconds_before_minute: tuple[int, ...]
+    tier_breakpoints: tuple[TierBreakpoint, ...] = ()
+    # Index of the time of day price each local minute of day is priced by,
+    # len(time_of_day_prices) for the base rate
+    band_by_minute: tuple[int, ...] = ()
+    # Like rate_by_minute and rate_seconds_before_minute, for plans with
+    # buyback rates by time of day
+    buyback_rate_by_minute: tuple[MilliCentsPerKWh, ...] = ()
+    buyback_rate_seconds_before_minute: tuple[int, ...] = ()
+    base_rate_millicents_per_kwh: MilliCentsPerKWh = MilliCentsPerKWh(0)
+    buyback_rate_millicents_per_kwh: MilliCentsPerKWh = MilliCentsPerKWh(0)
+
+
+# How much detail to price usage in: monthly bills, or monthly bills and a
+# cost for each day
+Breakdown = Literal["monthly", "daily"]
+
+
+class BandCost(NamedTuple):
+    """Consumption priced in one tier or time of day price, or the base rate"""
+
+    band: str
+    consumption_kwh: float
+    cost: Cents
+
+    def to_api_json(self) -> dict:
+        return {
+            "band": self.band,
+            "consumption_kwh": round(self.consumption_kwh, 3),
+            "cost": format_currency(self.cost),
+        }
+
+
+class MonthlyCost(NamedTuple):
+    """One calendar month's bill: energy_cost + fees - buyback = total_cost"""
+
+    month: str  # YYYY-MM
+    consumption_kwh: float
+    generation_kwh: float
+    energy_cost: Cents
+    fees: Cents
+    buyback: Cents  # credit for generation, after netting and caps
+    total_cost: Cents
+    bands: tuple[BandCost, ...]
+
+    def to_api_json(self) -> dict:
+        return {
+            "month": self.month,
+            "consumption_kwh": round(self.consumption_kwh, 3),
+            "generation_kwh": round(self.generation_kwh, 3),
+            "energy_cost": format_currency(self.energy_cost),
+            "fees": format_currency(self.fees),
+            "buyback": format_currency(self.buyback),
+            "total_cost": format_currency(self.total_cost),
+            "bands": [band.to_api_json() for band in self.bands],
+        }
+
+
+class DailyCost(NamedTuple):
+    """One local day's share of its month's bill"""
+
+    date: str  # YYYY-MM-DD
+    consumption_kwh: float
+    generation_kwh: float
+    total_cost: Cents
+
+    def to_api_json(self) -> dict:
+        return {
+            "date": self.date,
+            "consumption_kwh": round(self.consumption_kwh, 3),
+            "generation_kwh": round(self.generation_kwh, 3),
+            "total_cost": format_currency(self.total_cost),
+        }
+
 
 class CostData(NamedTuple):
     plan_config: PlanConfig
     total_cost: Cents
     monthly_average_cost: Cents
+    # Only priced when asked for, see calc_aggregate_plan_cost
+    monthly_costs: tuple[MonthlyCost, ...] | None = None
+    daily_costs: tuple[DailyCost, ...] | None = None
 
     def to_api_json(self) -> dict:
-        return {
+        api_json = {
             "plan": self.plan_config.to_api_json(),
             "total_cost": format_currency(self.total_cost),
             "monthly_average_cost": format_currency(self.monthly_average_cost),
         }
+        if self.monthly_costs is not None:
+            api_json["monthly_costs"] = [
+                monthly_cost.to_api_json() for monthly_cost in self.monthly_costs
+            ]
+        if self.daily_costs is not None:
+            api_json["daily_costs"] = [
+                daily_cost.to_api_json() for daily_cost in self.daily_costs
+            ]
+        return api_json
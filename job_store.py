@@ -0,0 +1,196 @@
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Callable, Literal, NamedTuple
+
+JobStatus = Literal["queued", "running", "succeeded", "failed"]
+
+
+class Job(NamedTuple):
+    """A usage data upload being priced in the background, and how far along
+    it is"""
+
+    job_id: str
+    status: JobStatus
+    file_name: str | None
+    # Bytes of the (decompressed) usage data CSV
+    total_bytes: int
+    bytes_read: int = 0
+    # Rows in the blocks parsed so far
+    rows_processed: int = 0
+    # The /recommend/ response, once the job has succeeded
+    result: dict | None = None
+    # {"status_code": ..., "detail": ...} of the error /recommend/ would have
+    # responded with, once the job has failed
+    error: dict | None = None
+
+    def to_api_json(self) -> dict:
+        api_json = {
+            "job_id": self.job_id,
+            "status": self.status,
+            "file_name": self.file_name,
+            "progress": {
+                "bytes_read": self.bytes_read,
+                "total_bytes": self.total_bytes,
+                "rows_processed": self.rows_processed,
+            },
+        }
+        if self.result is not None:
+            api_json["result"] = self.result
+        if self.error is not None:
+            api_json["error"] = self.error
+        return api_json
+
+
+class JobStore:
+    """Jobs persisted in SQLite, or in an in-memory SQLite database when no
+    sqlite_path is given.
+
+    Finished jobs are evicted ttl_seconds after they were last updated, and
+    queued or running jobs are kept however long they wait for their turn.
+    Jobs still queued or running when the store is opened were interrupted by
+    a restart, and their uploads are gone, so they're marked failed.
+    """
+
+    def __init__(
+        self,
+        sqlite_path: Path | None = None,
+        ttl_seconds: float = 3600,
+        clock: Callable[[], float] = time.time,
+    ) -> None:
+        self.ttl_seconds = ttl_seconds
+        self._clock = clock
+        self._db = sqlite3.connect(sqlite_path or ":memory:", check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs (job_id TEXT PRIMARY KEY, "
+            "status TEXT NOT NULL, file_name TEXT, total_bytes INTEGER NOT NULL, "
+            "bytes_read INTEGER NOT NULL, rows_processed INTEGER NOT NULL, "
+            "result TEXT, error TEXT, updated_at REAL NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS jobs_updated_at ON jobs (updated_at)"
+        )
+        self._db.execute(
+            "UPDATE jobs SET status = 'failed', error = ? "
+            "WHERE status IN ('queued', 'running')",
+            (
+                json.dumps(
+                    {
+                        "status_code": 503,
+                        "detail": "The job was interrupted, please upload again.",
+                    }
+                ),
+            ),
+        )
+        self._db.commit()
+        self._lock = threading.Lock()
+
+    def create(self, file_name: str | None, total_bytes: int) -> Job:
+        job = Job(uuid.uuid4().hex, "queued", file_name, total_bytes)
+        with self._lock, self._db:
+            self._evict_expired()
+            self._db.execute(
+                "INSERT INTO jobs (job_id, status, file_name, total_bytes, "
+                "bytes_read, rows_processed, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    job.job_id,
+                    job.status,
+                    job.file_name,
+                    job.total_bytes,
+                    job.bytes_read,
+                    job.rows_processed,
+                    self._clock(),
+                ),
+            )
+        return job
+
+    def get(self, job_id: str) -> Job | None:
+        with self._lock, self._db:
+            self._evict_expired()
+            row = self._db.execute(
+                "SELECT job_id, status, file_name, total_bytes, bytes_read, "
+                "rows_processed, result, error FROM jobs WHERE job_id = ?",
+                (job_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        *fields, result, error = row
+        return Job(
+            *fields,
+            result=None if result is None else json.loads(result),
+            error=None if error is None else json.loads(error),
+        )
+
+    def start(self, job_id: str) -> None:
+        """Marks the job running, once it has its turn to be parsed"""
+        self._update(job_id, status="running", bytes_read=None, rows_processed=None)
+
+    def update_progress(
+        self, job_id: str, bytes_read: int, rows_processed: int
+    ) -> None:
+        """Marks the job running, with how much of its upload has been read and
+        parsed"""
+        self._update(
+            job_id,
+            status="running",
+            bytes_read=bytes_read,
+            rows_processed=rows_processed,
+        )
+
+    def succeed(self, job_id: str, result: dict) -> None:
+        self._update(
+            job_id,
+            status="succeeded",
+            bytes_read=None,
+            rows_processed=None,
+            result=json.dumps(result),
+        )
+
+    def fail(self, job_id: str, status_code: int, detail: str | dict) -> None:
+        self._update(
+            job_id,
+            status="failed",
+            bytes_read=None,
+            rows_processed=None,
+            error=json.dumps({"status_code": status_code, "detail": detail}),
+        )
+
+    def _update(
+        self,
+        job_id: str,
+        status: JobStatus,
+        bytes_read: int | None,
+        rows_processed: int | None,
+        result: str | None = None,
+        error: str | None = None,
+    ) -> None:
+        # Progress left as None keeps its last value. Evicted jobs stay evicted.
+        with self._lock, self._db:
+            self._db.execute(
+                "UPDATE jobs SET status = ?, "
+                "bytes_read = COALESCE(?, bytes_read), "
+                "rows_processed = COALESCE(?, rows_processed), "
+                "result = ?, error = ?, updated_at = ? WHERE job_id = ?",
+                (
+                    status,
+                    bytes_read,
+                    rows_processed,
+                    result,
+                    error,
+                    self._clock(),
+                    job_id,
+                ),
+            )
+
+    def _evict_expired(self) -> None:
+        self._db.execute(
+            "DELETE FROM jobs WHERE status IN ('succeeded', 'failed') "
+            "AND updated_at < ?",
+            (self._clock() - self.ttl_seconds,),
+        )
+
+    def close(self) -> None:
+        self._db.close()
@@ -0,0 +1,324 @@
+import json
+import sqlite3
+import threading
+from fractions import Fraction
+from pathlib import Path
+from typing import Iterable
+
+import numpy as np
+
+from calc_plan_cost import (
+    build_cost_data,
+    calc_buyback_microcents,
+    calc_monthly_tiered_cost,
+    calc_rate_seconds,
+    calc_time_of_day_cost,
+    calc_total_cost_microcents,
+    prices_buyback_by_month,
+)
+from custom_types import CompiledPlan, CostData, UsageDataRow
+from usage_aggregate import UsageAggregate
+
+# (month index, duration, local second of day) -> [consumption Wh, generation Wh]
+GroupKey = tuple[int, int, int]
+
+
+class CustomerLedger:
+    """A customer's running cost on every plan, updated as new intervals are
+    appended rather than recomputed from their whole history.
+
+    Alongside each plan's energy cost so far, the ledger keeps the monthly
+    consumption and generation totals, so appending rows only reprices the
+    months they fall in (tiers reset every month), and the usage grouped by
+    month, duration and time of day, so every plan can be repriced if the
+    plan catalog changes. All of these are bounded by the number of months,
+    not the number of rows.
+
+    Rows starting before the end of the latest interval already recorded are
+    skipped, so meters can safely resend overlapping data.
+    """
+
+    def __init__(
+        self,
+        customer_id: str,
+        compiled_plans: Iterable[CompiledPlan],
+        catalog_version: str,
+    ) -> None:
+        self.customer_id = customer_id
+        self.compiled_plans = list(compiled_plans)
+        self.catalog_version = catalog_version
+        self.rows = 0
+        self.last_interval_end: float | None = None  # epoch seconds
+        self.monthly_consumption_wh: dict[int, int] = {}
+        self.monthly_generation_wh: dict[int, int] = {}
+        self.groups: dict[GroupKey, list[int]] = {}
+        # Per plan, exactly: consumption priced by time of day (or at the flat
+        # rate), or for tiered plans the sum of every month's tiered cost
+        self.energy_cost_microcents = [Fraction(0)] * len(self.compiled_plans)
+
+    def append(self, rows: Iterable[UsageDataRow]) -> tuple[int, int]:
+        """Adds new intervals, in O(rows * plans), returning how many rows
+        were appended and how many were skipped as already recorded"""
+        appended = skipped = 0
+        touched_months: dict[int, int] = {}  # month -> consumption before
+        for row in sorted(rows, key=lambda row: row.datetime):
+            start = row.datetime.timestamp()
+            if self.last_interval_end is not None and start < self.last_interval_end:
+                skipped += 1
+                continue
+            self.last_interval_end = start + row.duration
+            appended += 1
+
+            row_datetime = row.datetime
+            month = row_datetime.year * 12 + row_datetime.month - 1
+            second_of_day = (
+                row_datetime.hour * 3600
+                + row_datetime.minute * 60
+                + row_datetime.second
+            )
+            consumption_wh = row.consumption_wh
+            generation_wh = row.generation_wh
+            previous_consumption_wh = self.monthly_consumption_wh.get(month, 0)
+            touched_months.setdefault(month, previous_consumption_wh)
+            self.monthly_consumption_wh[month] = (
+                previous_consumption_wh + consumption_wh
+            )
+            self.monthly_generation_wh[month] = (
+                self.monthly_generation_wh.get(month, 0) + generation_wh
+            )
+            group = self.groups.setdefault((month, row.duration, second_of_day), [0, 0])
+            group[0] += consumption_wh
+            group[1] += generation_wh
+            for i, compiled_plan in enumerate(self.compiled_plans):
+                if not compiled_plan.plan_config.tiered_rates:
+                    self.energy_cost_microcents[i] += Fraction(
+                        consumption_wh
+                        * calc_rate_seconds(compiled_plan, second_of_day, row.duration),
+                        max(row.duration, 1),
+                    )
+
+        # A month's tiered cost isn't additive, so replace it for each month
+        # the new rows fell in
+        for i, compiled_plan in enumerate(self.compiled_plans):
+            if compiled_plan.plan_config.tiered_rates:
+                for month, previous_consumption_wh in touched_months.items():
+                    self.energy_cost_microcents[i] += calc_monthly_tiered_cost(
+                        compiled_plan, self.monthly_consumption_wh[month]
+                    ) - calc_monthly_tiered_cost(compiled_plan, previous_consumption_wh)
+        self.rows += appended
+        return appended, skipped
+
+    def reprice(
+        self, compiled_plans: Iterable[CompiledPlan], catalog_version: str
+    ) -> None:
+        """Switches to a new plan catalog, repricing from the grouped usage"""
+        self.compiled_plans = list(compiled_plans)
+        self.catalog_version = catalog_version
+        group_keys = np.array(list(self.groups), dtype=np.int64).reshape(-1, 3)
+        group_consumption_wh = np.array(
+            [consumption_wh for consumption_wh, _ in self.groups.values()],
+            dtype=np.int64,
+        )
+        self.energy_cost_microcents = []
+        for compiled_plan in self.compiled_plans:
+            if compiled_plan.plan_config.tiered_rates:
+                energy_cost_microcents = Fraction(
+                    sum(
+                        calc_monthly_tiered_cost(compiled_plan, consumption_wh)
+                        for consumption_wh in self.monthly_consumption_wh.values()
+                    )
+                )
+            else:
+                energy_cost_microcents = calc_time_of_day_cost(
+                    compiled_plan,
+                    group_keys[:, 2],
+                    group_keys[:, 1],
+                    group_consumption_wh,
+                )
+            self.energy_cost_microcents.append(energy_cost_microcents)
+
+    def plan_costs(self) -> list[CostData]:
+        """The cost of every plan for all usage so far
+
+        Raises:
+            ValueError: no usage has been recorded yet
+        """
+        num_of_months = len(self.monthly_consumption_wh)
+        if not num_of_months:
+            raise ValueError("Usage data is empty.")
+        total_generation_wh = sum(self.monthly_generation_wh.values())
+        usage_aggregate: UsageAggregate | None = None
+        plan_costs = []
+        for compiled_plan, energy_cost_microcents in zip(
+            self.compiled_plans, self.energy_cost_microcents
+        ):
+            plan_config = compiled_plan.plan_config
+            if prices_buyback_by_month(compiled_plan):
+                # Priced from the grouped usage, which is bounded by months
+                if usage_aggregate is None:
+                    usage_aggregate = self.usage_aggregate()
+                buyback_microcents = calc_buyback_microcents(
+                    compiled_plan, usage_aggregate
+                )
+            else:
+                buyback_microcents = (
+                    total_generation_wh * compiled_plan.buyback_rate_millicents_per_kwh
+                )
+            plan_costs.append(
+                build_cost_data(
+                    plan_config,
+                    calc_total_cost_microcents(
+                        plan_config,
+                        energy_cost_microcents,
+                        num_of_months,
+                        buyback_microcents,
+                    ),
+                    num_of_months,
+                )
+            )
+        return plan_costs
+
+    def usage_aggregate(self) -> UsageAggregate:
+        """The usage recorded so far as a UsageAggregate, without daily
+        totals"""
+        group_keys = np.array(list(self.groups), dtype=np.int64).reshape(-1, 3)
+        group_totals = np.array(list(self.groups.values()), dtype=np.int64).reshape(
+            -1, 2
+        )
+        return UsageAggregate.from_groups(
+            month_index=group_keys[:, 0],
+            duration=group_keys[:, 1],
+            second_of_day=group_keys[:, 2],
+            consumption_wh=group_totals[:, 0],
+            generation_wh=group_totals[:, 1],
+        )
+
+    def to_json(self) -> dict:
+        return {
+            "catalog_version": self.catalog_version,
+            "rows": self.rows,
+            "last_interval_end": self.last_interval_end,
+            "monthly_consumption_wh": list(self.monthly_consumption_wh.items()),
+            "monthly_generation_wh": list(self.monthly_generation_wh.items()),
+            "groups": [[*key, *totals] for key, totals in self.groups.items()],
+            # Exact fractions of a micro-cent, e.g. "1234567/3"
+            "energy_cost_microcents": [
+                str(energy_cost_microcents)
+                for energy_cost_microcents in self.energy_cost_microcents
+            ],
+        }
+
+    @classmethod
+    def from_json(
+        cls,
+        customer_id: str,
+        data: dict,
+        compiled_plans: Iterable[CompiledPlan],
+        catalog_version: str,
+    ) -> "CustomerLedger":
+        """Restores a saved ledger, repricing it if it was saved against a
+        different plan catalog version"""
+        ledger = cls(customer_id, compiled_plans, catalog_version)
+        ledger.rows = data["rows"]
+        ledger.last_interval_end = data["last_interval_end"]
+        ledger.monthly_consumption_wh = dict(data["monthly_consumption_wh"])
+        ledger.monthly_generation_wh = dict(data["monthly_generation_wh"])
+        ledger.groups = {
+            (month, duration, second_of_day): [consumption_wh, generation_wh]
+            for month, duration, second_of_day, consumption_wh, generation_wh in data[
+                "groups"
+            ]
+        }
+        if data["catalog_version"] == catalog_version:
+            ledger.energy_cost_microcents = [
+                Fraction(energy_cost_microcents)
+                for energy_cost_microcents in data["energy_cost_microcents"]
+            ]
+        else:
+            ledger.reprice(compiled_plans, catalog_version)
+        return ledger
+
+
+class LedgerStore:
+    """Customer ledgers persisted in SQLite, or in an in-memory SQLite database
+    when no sqlite_path is given.
+
+    Every read-modify-write of a ledger holds a lock, so concurrent appends for
+    the same customer can't lose rows.
+    """
+
+    def __init__(self, sqlite_path: Path | None = None) -> None:
+        self._db = sqlite3.connect(sqlite_path or ":memory:", check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS ledgers "
+            "(customer_id TEXT PRIMARY KEY, state TEXT NOT NULL)"
+        )
+        self._db.commit()
+        self._lock = threading.Lock()
+
+    def _load(
+        self,
+        customer_id: str,
+        compiled_plans: Iterable[CompiledPlan],
+        catalog_version: str,
+    ) -> tuple[CustomerLedger | None, bool]:
+        """The saved ledger, if any, and whether it was repriced against a
+        different catalog version than it was saved with"""
+        row = self._db.execute(
+            "SELECT state FROM ledgers WHERE customer_id = ?", (customer_id,)
+        ).fetchone()
+        if row is None:
+            return None, False
+        data = json.loads(row[0])
+        ledger = CustomerLedger.from_json(
+            customer_id, data, compiled_plans, catalog_version
+        )
+        return ledger, data["catalog_version"] != catalog_version
+
+    def _save(self, ledger: CustomerLedger) -> None:
+        with self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO ledgers (customer_id, state) VALUES (?, ?)",
+                (ledger.customer_id, json.dumps(ledger.to_json())),
+            )
+
+    def get(
+        self,
+        customer_id: str,
+        compiled_plans: Iterable[CompiledPlan],
+        catalog_version: str,
+    ) -> CustomerLedger | None:
+        """A customer's ledger, or None if nothing has been recorded for them.
+        A ledger repriced against a new catalog version is saved, so it's
+        only repriced once."""
+        with self._lock:
+            ledger, repriced = self._load(customer_id, compiled_plans, catalog_version)
+            if repriced:
+                self._save(ledger)
+            return ledger
+
+    def append(
+        self,
+        customer_id: str,
+        rows: Iterable[UsageDataRow],
+        compiled_plans: Iterable[CompiledPlan],
+        catalog_version: str,
+    ) -> tuple[CustomerLedger, int, int]:
+        """Appends rows to a customer's ledger, creating it if needed, and
+        saves it. Returns the ledger and the appended and skipped row counts.
+
+        A new ledger is only saved once it has rows, so appending no rows for
+        an unknown customer leaves them unknown.
+        """
+        compiled_plans = list(compiled_plans)
+        with self._lock:
+            ledger, repriced = self._load(customer_id, compiled_plans, catalog_version)
+            if ledger is None:
+                ledger = CustomerLedger(customer_id, compiled_plans, catalog_version)
+            appended, skipped = ledger.append(rows)
+            if appended or repriced:
+                self._save(ledger)
+        return ledger, appended, skipped
+
+    def close(self) -> None:
+        self._db.close()
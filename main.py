@@ -1,46 +1,981 @@
+import asyncio
+import cProfile
+import io
 import json
+import logging
+import math
+import multiprocessing
+import os
+import random
+import tempfile
+import time as timer
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
 from datetime import time
-from typing import Annotated
+from pathlib import Path
+from typing import IO, AsyncIterator, Awaitable, Callable, Iterable, NoReturn
 
-from fastapi import FastAPI, File, UploadFile
-from fastapi.responses import HTMLResponse
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import (
+    HTMLResponse,
+    JSONResponse,
+    PlainTextResponse,
+    Response,
+    StreamingResponse,
+)
 
-from calc_plan_cost import calc_plan_cost
+from batch import iter_batch_items, run_batch
+from calc_plan_cost import calc_plan_costs
 from custom_types import (
+    Breakdown,
     Cents,
     CentsPerKWh,
+    CompiledPlan,
     CostData,
     PlanConfig,
     TieredRate,
     TimeOfDayPrice,
 )
+from job_store import JobStore
+from ledger import CustomerLedger, LedgerStore
+from metrics import (
+    BYTES_READ,
+    PLANS_PRICED,
+    REGISTRY,
+    REQUEST_SECONDS,
+    RESULT_CACHE_LOOKUPS,
+    ROWS_PARSED,
+    StageTimer,
+    timed_call,
+)
 from parse_usage_data import parse_usage_data_csv
+from plan_catalog import PlanCatalog, PlanCatalogVersion
+from plan_search import PlanGrid, optimize_usage_csv_bytes
+from portfolio import PlanScenario, SummaryCache, analyze_portfolio, scan_portfolio
+from recommendation import (
+    NDJSON_MEDIA_TYPE,
+    build_recommendation,
+    encode_json,
+    encode_ndjson_line,
+    iter_recommendation_ndjson,
+    iter_recommendation_ndjson_from_result,
+)
+from result_cache import ResultCache
+from settings import Settings
+from upload_ingestion import (
+    CsvBlockSplitter,
+    UploadFormatError,
+    UploadTooLargeError,
+    UsageUploadReader,
+)
+from usage_aggregate import UsageAggregate
+from usage_validation import (
+    DataQualityError,
+    DataQualityReport,
+    ValidationPolicy,
+    aggregate_validated_usage_csv_block,
+    check_data_quality,
+    last_line,
+)
+from worker_pool import WorkerPool
+
+logger = logging.getLogger(__name__)
+
+settings = Settings.from_env()
+
+# Loaded and compiled once at startup, then hot-reloaded when the file changes
+plan_catalog = PlanCatalog(Path(__file__).parent / "plan_configs.json")
+
+# Blocks of one upload queued or being parsed at once, so a large upload takes
+# turns with the others for the pricing pool's workers
+MAX_PARSING_BLOCKS_PER_UPLOAD = 4
+
+# Requests with this header are profiled, if PLAN_OPTIMIZER_PROFILE_DIR is set
+PROFILE_HEADER = "X-Profile"
+# Only one request is profiled at a time, profiles can't be nested
+profile_lock = asyncio.Lock()
+
+
+def create_process_pool(max_workers: int) -> ProcessPoolExecutor:
+    # Spawned rather than forked so workers don't inherit the server's threads
+    return ProcessPoolExecutor(
+        max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")
+    )
+
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    plan_catalog.start_watching()
+    pricing_workers = settings.pricing_workers or os.cpu_count() or 1
+    batch_workers = settings.batch_workers or os.cpu_count() or 1
+    with (
+        create_process_pool(pricing_workers) as pricing_executor,
+        create_process_pool(batch_workers) as batch_executor,
+    ):
+        app.state.pricing_pool = WorkerPool(
+            pricing_executor,
+            max_workers=pricing_workers,
+            max_queue_depth=settings.pricing_queue_depth,
+        )
+        app.state.batch_executor = batch_executor
+        app.state.result_cache = ResultCache(
+            max_bytes=settings.result_cache_max_bytes,
+            sqlite_path=settings.result_cache_path,
+        )
+        app.state.ledger_store = LedgerStore(settings.ledger_path)
+        app.state.portfolio_cache = SummaryCache(settings.portfolio_cache_path)
+        app.state.job_store = JobStore(
+            settings.job_store_path, ttl_seconds=settings.job_ttl_seconds
+        )
+        app.state.job_slots = asyncio.Semaphore(settings.max_running_jobs)
+        # Held so running jobs aren't garbage collected, and cancelled on shutdown
+        app.state.job_tasks = set()
+        yield
+        for job_task in app.state.job_tasks:
+            job_task.cancel()
+        await asyncio.gather(*app.state.job_tasks, return_exceptions=True)
+        app.state.result_cache.close()
+        app.state.ledger_store.close()
+        app.state.portfolio_cache.close()
+        app.state.job_store.close()
+    plan_catalog.stop_watching()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+def should_profile(request: Request) -> bool:
+    return (
+        settings.profile_dir is not None
+        and PROFILE_HEADER in request.headers
+        and not profile_lock.locked()
+        and random.random() < settings.profile_sample_rate
+    )
+
+
+@app.middleware("http")
+async def instrument(request: Request, call_next):
+    """Records request and per-stage durations for /metrics, adds them to a
+    Server-Timing header if enabled, and profiles requests that ask for it.
+
+    Profiles cover the event loop thread, so they include any other requests
+    handled at the same time, but not work done in the worker processes.
+    """
+    start = timer.perf_counter()
+    stage_timer = request.state.stage_timer = StageTimer()
+    profile_path = None
+    if should_profile(request):
+        async with profile_lock:
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                response = await call_next(request)
+            finally:
+                profiler.disable()
+            profile_path = settings.profile_dir / f"request-{timer.time_ns()}.prof"
+            profiler.dump_stats(profile_path)
+    else:
+        response = await call_next(request)
+    total_seconds = timer.perf_counter() - start
+
+    route = request.scope.get("route")
+    endpoint = route.path if route is not None else "unmatched"
+    REQUEST_SECONDS.observe(
+        total_seconds, endpoint=endpoint, status=str(response.status_code)
+    )
+    stage_timer.observe(endpoint)
+    if settings.server_timing:
+        stage_timer.add("total", total_seconds)
+        response.headers["Server-Timing"] = stage_timer.server_timing()
+    if profile_path is not None:
+        response.headers["X-Profile-File"] = profile_path.name
+    return response
 
 
 @app.post("/recommend/")
-async def recommend(file: UploadFile):
-    """returns the cheapest of three tariffs for the supplied usage data CSV"""
-    usage_data = parse_usage_data_csv(file.file)
-    with open("plan_configs.json", "r") as f:
-        plan_configs_data = json.load(f)
-    plan_configs: list[PlanConfig] = [
-        PlanConfig.from_json(plan_config) for plan_config in plan_configs_data
-    ]
-    plan_costs: list[CostData] = [
-        calc_plan_cost(usage_data=usage_data, plan_config=plan_config)
-        for plan_config in plan_configs
+async def recommend(
+    request: Request,
+    policy: ValidationPolicy = "strict",
+    stream: bool = False,
+    breakdown: Breakdown | None = None,
+):
+    """returns the cheapest of three tariffs for the supplied usage data CSV
+
+    Accepts a multipart form with the CSV in its "file" field, or a raw
+    text/csv body, optionally with Content-Encoding: gzip. The CSV is hashed
+    and parsed in blocks on the pricing pool while the rest of the upload is
+    still arriving, so large files are never held in memory or spooled to disk
+    whole. Repeated uploads are answered from the result cache, throwing away
+    the blocks parsed so far, and otherwise priced on the pricing pool.
+
+    Rows are validated as they're parsed, and the response includes a
+    data_quality report. policy decides what happens to rows that can't be
+    priced: strict (the default) rejects the file, skip leaves them out, and
+    interpolate also fills gaps in the data from the intervals either side.
+
+    With ?stream=true or Accept: application/x-ndjson the response is NDJSON
+    instead: a line with each plan's cost as soon as it's priced, then a line
+    with the winner and data_quality.
+
+    ?breakdown=monthly adds each plan's bill for every month, split into
+    energy by tier or time of day price, fees and buyback, and
+    ?breakdown=daily adds a cost for each day as well.
+    """
+    stream = stream or NDJSON_MEDIA_TYPE in request.headers.get("accept", "")
+    pricing_pool: WorkerPool = request.app.state.pricing_pool
+    result_cache: ResultCache = request.app.state.result_cache
+    stage_timer: StageTimer = request.state.stage_timer
+    catalog_version = plan_catalog.current
+    if pricing_pool.is_full:
+        raise_pool_full()
+    upload = open_usage_upload(request)
+    parser = UploadBlockParser(pricing_pool, policy)
+
+    try:
+        with stage_timer.stage("upload"):
+            async for chunk in request.stream():
+                await parser.feed(upload.feed(chunk))
+            await parser.feed(upload.finish())
+        BYTES_READ.inc(upload.body_bytes, endpoint="/recommend/")
+
+        # Re-uploads of the same file against the same plans skip pricing, and
+        # the blocks parsed while the upload arrived are thrown away
+        cache_key = ResultCache.key(
+            upload.csv_sha256.hexdigest(),
+            f"{catalog_version.version}:{policy}:{breakdown}",
+        )
+        cached_result = result_cache.get(cache_key)
+        RESULT_CACHE_LOOKUPS.inc(result="miss" if cached_result is None else "hit")
+        if cached_result is not None:
+            cached_result = {**cached_result, "file_name": upload.file_name}
+            if stream:
+                return StreamingResponse(
+                    iter_recommendation_ndjson_from_result(cached_result),
+                    media_type=NDJSON_MEDIA_TYPE,
+                )
+            return Response(encode_json(cached_result), media_type="application/json")
+
+        with stage_timer.stage("parse_wait"):
+            parsed_blocks = await parser.finish()
+        ROWS_PARSED.inc(
+            sum(report.rows for (_, report), _ in parsed_blocks),
+            endpoint="/recommend/",
+        )
+        # Summed over blocks parsed in parallel, so can exceed the request time
+        stage_timer.add("parse", sum(seconds for _, seconds in parsed_blocks))
+        with stage_timer.stage("merge"):
+            data_quality = DataQualityReport.merge(
+                report for (_, report), _ in parsed_blocks
+            )
+            check_data_quality(data_quality, policy)
+            usage_aggregate = UsageAggregate.merge(
+                usage_aggregate for (usage_aggregate, _), _ in parsed_blocks
+            )
+        if stream:
+            if not len(usage_aggregate.months):
+                raise ValueError("Usage data is empty.")
+            compiled_plans = catalog_version.compiled_plans
+            PLANS_PRICED.inc(len(compiled_plans), endpoint="/recommend/")
+            return StreamingResponse(
+                iter_recommendation_ndjson(
+                    upload.file_name,
+                    price_plans_in_chunks(
+                        pricing_pool, list(compiled_plans), usage_aggregate, breakdown
+                    ),
+                    {"data_quality": data_quality.to_api_json()},
+                    on_result=lambda result: result_cache.put(cache_key, result),
+                ),
+                media_type=NDJSON_MEDIA_TYPE,
+            )
+        with stage_timer.stage("price"):
+            plan_costs = await pricing_pool.run(
+                calc_plan_costs,
+                list(catalog_version.compiled_plans),
+                usage_aggregate,
+                breakdown,
+                admitted=True,
+            )
+        PLANS_PRICED.inc(len(plan_costs), endpoint="/recommend/")
+    except UploadTooLargeError:
+        raise_upload_too_large()
+    except DataQualityError as e:
+        raise HTTPException(
+            status_code=400,
+            detail={
+                "message": f"Invalid usage data: {e}",
+                "data_quality": e.report.to_api_json(),
+            },
+        )
+    except (UploadFormatError, ValueError, KeyError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid usage data: {e}")
+    finally:
+        parser.cancel()
+
+    with stage_timer.stage("respond"):
+        result = {
+            **build_recommendation(upload.file_name, plan_costs),
+            "data_quality": data_quality.to_api_json(),
+        }
+        result_cache.put(cache_key, result)
+        return Response(encode_json(result), media_type="application/json")
+
+
+async def price_plans_in_chunks(
+    pricing_pool: WorkerPool,
+    compiled_plans: list[CompiledPlan],
+    usage_aggregate: UsageAggregate,
+    breakdown: Breakdown | None,
+) -> AsyncIterator[CostData]:
+    """Prices the plans on the pricing pool in a chunk per worker, all at
+    once, yielding each plan's cost in catalog order as soon as its chunk is
+    priced, so streamed responses only serialize on the event loop"""
+    chunk_size = math.ceil(len(compiled_plans) / pricing_pool.max_workers)
+    chunk_jobs = [
+        asyncio.ensure_future(
+            pricing_pool.run(
+                calc_plan_costs,
+                compiled_plans[start : start + chunk_size],
+                usage_aggregate,
+                breakdown,
+                admitted=True,
+            )
+        )
+        for start in range(0, len(compiled_plans), chunk_size)
     ]
-    plan_costs.sort(key=lambda cost_data: cost_data.total_cost)
+    try:
+        for chunk_job in chunk_jobs:
+            for cost_data in await chunk_job:
+                yield cost_data
+    finally:
+        for chunk_job in chunk_jobs:
+            chunk_job.cancel()
+
+
+def check_content_length(request: Request) -> None:
+    """Rejects a request whose Content-Length is malformed (400) or over the
+    upload limit (413) before any of its body is read"""
+    content_length = request.headers.get("content-length")
+    if content_length is None:
+        return
+    try:
+        body_bytes = int(content_length)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid Content-Length header.")
+    if body_bytes > settings.max_upload_bytes:
+        raise_upload_too_large()
+
+
+def open_usage_upload(
+    request: Request, form_field_names: Iterable[str] = ()
+) -> UsageUploadReader:
+    """A reader for the usage data CSV in a request's body, after checking its
+    Content-Length against the upload limit"""
+    check_content_length(request)
+    try:
+        return UsageUploadReader(
+            request.headers.get("content-type", ""),
+            request.headers.get("content-encoding"),
+            max_bytes=settings.max_upload_bytes,
+            form_field_names=form_field_names,
+        )
+    except UploadFormatError as e:
+        raise HTTPException(status_code=415, detail=str(e))
+
+
+async def spool_upload(
+    request: Request, upload: UsageUploadReader, csv_file: IO[bytes]
+) -> int:
+    """Copies the usage data CSV out of the request body into csv_file,
+    hashing it on the way, rewinds csv_file and returns the CSV's size, for
+    /jobs uploads that are parsed after the response has been sent
+
+    Raises:
+        UploadFormatError: the body isn't a usage data upload
+        UploadTooLargeError: the decompressed body is over max_upload_bytes
+    """
+    # Writes to a temporary file only reach memory or the page cache, so are
+    # quick enough to make on the event loop
+    async for chunk in request.stream():
+        csv_file.write(upload.feed(chunk))
+    csv_file.write(upload.finish())
+    csv_bytes = csv_file.tell()
+    csv_file.seek(0)
+    return csv_bytes
+
+
+ParsedBlock = tuple[tuple[UsageAggregate, DataQualityReport], float]
+
+
+class UploadBlockParser:
+    """Parses a usage data CSV in blocks on the pricing pool as its bytes come
+    in, each block as soon as it's complete.
+
+    At most MAX_PARSING_BLOCKS_PER_UPLOAD blocks are queued or being parsed at
+    once, and feed waits for one of them to finish before sending another, so
+    only a few blocks of an upload are ever held in memory and a large upload
+    takes turns with the others for the workers rather than holding on to
+    them until it's done. on_progress is awaited with the bytes fed and rows
+    parsed so far as blocks finish.
+
+    Blocks still being parsed are cancelled by cancel, e.g. when the upload
+    turns out to have been priced already.
+    """
+
+    def __init__(
+        self,
+        pricing_pool: WorkerPool,
+        policy: ValidationPolicy,
+        on_progress: Callable[[int, int], Awaitable[None]] | None = None,
+    ) -> None:
+        self.pricing_pool = pricing_pool
+        self.policy = policy
+        self.on_progress = on_progress
+        self.bytes_fed = 0
+        self._splitter = CsvBlockSplitter(settings.upload_block_bytes)
+        self._block_jobs: list[asyncio.Task[ParsedBlock]] = []
+        self._previous_line = b""
+
+    async def feed(self, csv_bytes: bytes) -> None:
+        """
+        Raises:
+            UploadTooLargeError: the CSV has more than max_upload_rows rows
+        """
+        self.bytes_fed += len(csv_bytes)
+        await self._parse_blocks(self._splitter.feed(csv_bytes))
+
+    async def finish(self) -> list[ParsedBlock]:
+        """Each block's aggregate and data quality report, and the seconds it
+        took to parse, once every block has been parsed
+
+        Raises:
+            UploadTooLargeError: the CSV has more than max_upload_rows rows
+        """
+        await self._parse_blocks(self._splitter.finish())
+        parsed_blocks = await asyncio.gather(*self._block_jobs)
+        await self._report_progress()
+        return parsed_blocks
+
+    def cancel(self) -> None:
+        for job in self._block_jobs:
+            job.cancel()
+
+    async def _report_progress(self) -> None:
+        if self.on_progress is not None:
+            parsed = (job.result() for job in self._block_jobs if job.done())
+            await self.on_progress(
+                self.bytes_fed, sum(report.rows for (_, report), _ in parsed)
+            )
+
+    async def _parse_blocks(self, blocks: list[bytes]) -> None:
+        for block in blocks:
+            parsing = [job for job in self._block_jobs if not job.done()]
+            if len(parsing) >= MAX_PARSING_BLOCKS_PER_UPLOAD:
+                await asyncio.wait(parsing, return_when=asyncio.FIRST_COMPLETED)
+                await self._report_progress()
+            self._block_jobs.append(
+                asyncio.create_task(
+                    self.pricing_pool.run(
+                        timed_call,
+                        aggregate_validated_usage_csv_block,
+                        self._splitter.header,
+                        block,
+                        self.policy,
+                        self._previous_line,
+                        admitted=True,
+                    )
+                )
+            )
+            self._previous_line = last_line(block)
+        if self._splitter.rows > settings.max_upload_rows:
+            raise UploadTooLargeError()
 
+
+async def parse_spooled_csv(
+    pricing_pool: WorkerPool,
+    csv_file: IO[bytes],
+    policy: ValidationPolicy,
+    on_progress: Callable[[int, int], Awaitable[None]] | None = None,
+) -> list[ParsedBlock]:
+    """Parses a spooled usage data CSV in blocks on the pricing pool (see
+    UploadBlockParser)
+
+    Raises:
+        UploadTooLargeError: the CSV has more than max_upload_rows rows
+    """
+    parser = UploadBlockParser(pricing_pool, policy, on_progress)
+    try:
+        while chunk := await run_in_threadpool(
+            csv_file.read, settings.upload_block_bytes
+        ):
+            await parser.feed(chunk)
+        return await parser.finish()
+    finally:
+        parser.cancel()
+
+
+def raise_upload_too_large() -> NoReturn:
+    raise HTTPException(
+        status_code=413,
+        detail=(
+            f"Usage data uploads are limited to {settings.max_upload_bytes:,} bytes "
+            f"and {settings.max_upload_rows:,} rows."
+        ),
+    )
+
+
+def raise_pool_full() -> NoReturn:
+    raise HTTPException(
+        status_code=429,
+        detail="Too many usage files are being priced, please retry shortly.",
+        headers={"Retry-After": str(settings.retry_after_seconds)},
+    )
+
+
+def job_queue_is_full(app: FastAPI) -> bool:
+    # Every unfinished job either holds one of the max_running_jobs slots or
+    # is queued waiting for one
+    return len(app.state.job_tasks) >= (
+        settings.max_running_jobs + settings.max_queued_jobs
+    )
+
+
+def raise_job_queue_full() -> NoReturn:
+    raise HTTPException(
+        status_code=429,
+        detail="Too many jobs are waiting to be priced, please retry shortly.",
+        headers={"Retry-After": str(settings.retry_after_seconds)},
+    )
+
+
+@app.post("/jobs", status_code=202)
+async def create_job(
+    request: Request,
+    policy: ValidationPolicy = "strict",
+    breakdown: Breakdown | None = None,
+):
+    """Accepts a usage data upload to be priced in the background and responds
+    with its job straight away, for files too large to price before a load
+    balancer gives up on the request.
+
+    Takes the same body and query parameters as /recommend/. The upload is
+    spooled to a temporary file, then parsed block by block on the pricing
+    pool, taking turns with every other upload, and priced. GET
+    /jobs/{job_id} reports its progress and, once it's done, the /recommend/
+    response or the error it failed with.
+    """
+    pricing_pool: WorkerPool = request.app.state.pricing_pool
+    result_cache: ResultCache = request.app.state.result_cache
+    job_store: JobStore = request.app.state.job_store
+    catalog_version = plan_catalog.current
+    if pricing_pool.is_full:
+        raise_pool_full()
+    if job_queue_is_full(request.app):
+        raise_job_queue_full()
+    upload = open_usage_upload(request)
+    csv_file = tempfile.TemporaryFile()
+    try:
+        total_bytes = await spool_upload(request, upload, csv_file)
+    except UploadTooLargeError:
+        csv_file.close()
+        raise_upload_too_large()
+    except UploadFormatError as e:
+        csv_file.close()
+        raise HTTPException(status_code=400, detail=f"Invalid usage data: {e}")
+    except BaseException:
+        csv_file.close()
+        raise
+    BYTES_READ.inc(upload.body_bytes, endpoint="/jobs")
+
+    cache_key = ResultCache.key(
+        upload.csv_sha256.hexdigest(),
+        f"{catalog_version.version}:{policy}:{breakdown}",
+    )
+    cached_result = result_cache.get(cache_key)
+    RESULT_CACHE_LOOKUPS.inc(result="miss" if cached_result is None else "hit")
+    # Other jobs may have been queued while the upload was spooled
+    if cached_result is None and job_queue_is_full(request.app):
+        csv_file.close()
+        raise_job_queue_full()
+    job = await run_in_threadpool(job_store.create, upload.file_name, total_bytes)
+    if cached_result is not None:
+        csv_file.close()
+        rows_processed = cached_result["data_quality"]["rows"]
+        await run_in_threadpool(
+            job_store.update_progress, job.job_id, total_bytes, rows_processed
+        )
+        await run_in_threadpool(
+            job_store.succeed,
+            job.job_id,
+            {**cached_result, "file_name": upload.file_name},
+        )
+    else:
+        job_task = asyncio.create_task(
+            run_job(
+                request.app,
+                job.job_id,
+                csv_file,
+                upload.file_name,
+                policy,
+                breakdown,
+                catalog_version,
+                cache_key,
+            )
+        )
+        request.app.state.job_tasks.add(job_task)
+        job_task.add_done_callback(request.app.state.job_tasks.discard)
+    return JSONResponse(
+        (await run_in_threadpool(job_store.get, job.job_id) or job).to_api_json(),
+        status_code=202,
+        headers={"Location": f"/jobs/{job.job_id}"},
+    )
+
+
+async def run_job(
+    app: FastAPI,
+    job_id: str,
+    csv_file: IO[bytes],
+    file_name: str | None,
+    policy: ValidationPolicy,
+    breakdown: Breakdown | None,
+    catalog_version: PlanCatalogVersion,
+    cache_key: str,
+) -> None:
+    """Prices a /jobs upload, waiting for one of the max_running_jobs slots,
+    and records the result or the error /recommend/ would have responded
+    with"""
+    job_store: JobStore = app.state.job_store
+    try:
+        with csv_file:
+            async with app.state.job_slots:
+                await run_in_threadpool(job_store.start, job_id)
+                result = await price_job_upload(
+                    app, job_id, csv_file, file_name, policy, breakdown, catalog_version
+                )
+    except HTTPException as e:
+        await run_in_threadpool(job_store.fail, job_id, e.status_code, e.detail)
+        return
+    except Exception:
+        logger.exception("Pricing job %s failed", job_id)
+        await run_in_threadpool(
+            job_store.fail, job_id, 500, "Pricing the usage data failed."
+        )
+        return
+    app.state.result_cache.put(cache_key, result)
+    await run_in_threadpool(job_store.succeed, job_id, result)
+
+
+async def price_job_upload(
+    app: FastAPI,
+    job_id: str,
+    csv_file: IO[bytes],
+    file_name: str | None,
+    policy: ValidationPolicy,
+    breakdown: Breakdown | None,
+    catalog_version: PlanCatalogVersion,
+) -> dict:
+    """Parses a spooled /jobs upload in blocks and prices it on the pricing
+    pool, like /recommend/, recording its progress as blocks are parsed"""
+    pricing_pool: WorkerPool = app.state.pricing_pool
+    job_store: JobStore = app.state.job_store
+
+    async def record_progress(bytes_read: int, rows_processed: int) -> None:
+        await run_in_threadpool(
+            job_store.update_progress, job_id, bytes_read, rows_processed
+        )
+
+    try:
+        parsed_blocks = await parse_spooled_csv(
+            pricing_pool, csv_file, policy, on_progress=record_progress
+        )
+        ROWS_PARSED.inc(
+            sum(report.rows for (_, report), _ in parsed_blocks), endpoint="/jobs"
+        )
+
+        data_quality = DataQualityReport.merge(
+            report for (_, report), _ in parsed_blocks
+        )
+        check_data_quality(data_quality, policy)
+        usage_aggregate = UsageAggregate.merge(
+            usage_aggregate for (usage_aggregate, _), _ in parsed_blocks
+        )
+        compiled_plans = list(catalog_version.compiled_plans)
+        plan_costs = await pricing_pool.run(
+            calc_plan_costs, compiled_plans, usage_aggregate, breakdown, admitted=True
+        )
+        PLANS_PRICED.inc(len(plan_costs), endpoint="/jobs")
+    except UploadTooLargeError:
+        raise_upload_too_large()
+    except DataQualityError as e:
+        raise HTTPException(
+            status_code=400,
+            detail={
+                "message": f"Invalid usage data: {e}",
+                "data_quality": e.report.to_api_json(),
+            },
+        )
+    except (UploadFormatError, ValueError, KeyError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid usage data: {e}")
+    return {
+        **build_recommendation(file_name, plan_costs),
+        "data_quality": data_quality.to_api_json(),
+    }
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, request: Request):
+    """A /jobs upload's status and progress: the rows parsed and bytes read
+    so far, and once it's done the /recommend/ response or the error it
+    failed with"""
+    job_store: JobStore = request.app.state.job_store
+    job = await run_in_threadpool(job_store.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job.")
+    return Response(encode_json(job.to_api_json()), media_type="application/json")
+
+
+@app.get("/health")
+async def health(request: Request):
     return {
-        "file_name": file.filename,
-        "winner": plan_costs[0].to_api_json(),
-        "all_plan_costs": [cost_data.to_api_json() for cost_data in plan_costs],
+        "status": "ok",
+        "plan_catalog_version": plan_catalog.current.version,
+        "pricing_pool": request.app.state.pricing_pool.usage(),
+        "result_cache": request.app.state.result_cache.stats(),
     }
 
 
+@app.post("/optimize")
+async def optimize(request: Request):
+    """Searches families of plans for the cheapest ones for a usage data CSV.
+
+    The body is a multipart form with the usage data CSV in its "file" field,
+    plan_grids and optionally top (10 by default), read as it arrives like a
+    /recommend/ upload. plan_grids is a JSON list of plan configs where any
+    number or time can be a list of values to try (see PlanGrid). Responds
+    with the top cheapest candidates, and for each grid where its best
+    candidate would break even with the cheapest plan in the catalog.
+    """
+    pricing_pool: WorkerPool = request.app.state.pricing_pool
+    if pricing_pool.is_full:
+        raise_pool_full()
+    upload = open_usage_upload(request, form_field_names=("plan_grids", "top"))
+    csv_chunks = []
+    try:
+        async for chunk in request.stream():
+            csv_chunks.append(upload.feed(chunk))
+        csv_chunks.append(upload.finish())
+    except UploadTooLargeError:
+        raise_upload_too_large()
+    except UploadFormatError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid usage data: {e}")
+    BYTES_READ.inc(upload.body_bytes, endpoint="/optimize")
+
+    try:
+        grids_json = json.loads(upload.form_fields["plan_grids"])
+        plan_grids_list = [
+            PlanGrid.from_json(grid)
+            for grid in (grids_json if isinstance(grids_json, list) else [grids_json])
+        ]
+    except KeyError:
+        raise HTTPException(status_code=400, detail="plan_grids is required.")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid plan grids: {e}")
+    try:
+        top = int(upload.form_fields.get("top", 10))
+        if top < 1:
+            raise ValueError()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="top must be a positive integer.")
+    candidates = sum(len(plan_grid) for plan_grid in plan_grids_list)
+    if not candidates or candidates > settings.max_optimize_candidates:
+        raise HTTPException(
+            status_code=400,
+            detail=(
+                f"Plan grids must have between 1 and "
+                f"{settings.max_optimize_candidates:,} candidates, not {candidates:,}."
+            ),
+        )
+
+    try:
+        result = await pricing_pool.run(
+            optimize_usage_csv_bytes,
+            upload.file_name,
+            b"".join(csv_chunks),
+            plan_grids_list,
+            list(plan_catalog.current.compiled_plans),
+            top,
+            admitted=True,
+        )
+    except (ValueError, KeyError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    PLANS_PRICED.inc(result["candidates"], endpoint="/optimize")
+    return result
+
+
+def build_ledger_response(ledger: CustomerLedger, **row_counts: int) -> dict:
+    recommendation = build_recommendation(None, ledger.plan_costs())
+    return {
+        "customer_id": ledger.customer_id,
+        "rows": ledger.rows,
+        **row_counts,
+        "winner": recommendation["winner"],
+        "all_plan_costs": recommendation["all_plan_costs"],
+    }
+
+
+@app.patch("/customers/{customer_id}/usage")
+async def append_customer_usage(customer_id: str, request: Request):
+    """Appends new intervals to a customer's ledger and returns their updated
+    cost on every plan, without repricing the intervals already recorded.
+
+    The body is a usage data CSV, raw or in a multipart "file" field, like
+    /recommend/. Intervals overlapping ones already recorded are skipped.
+    """
+    ledger_store: LedgerStore = request.app.state.ledger_store
+    catalog_version = plan_catalog.current
+    try:
+        upload = UsageUploadReader(
+            request.headers.get("content-type", ""),
+            request.headers.get("content-encoding"),
+            max_bytes=settings.max_upload_bytes,
+        )
+    except UploadFormatError as e:
+        raise HTTPException(status_code=415, detail=str(e))
+    try:
+        csv_chunks = [upload.feed(chunk) async for chunk in request.stream()]
+        csv_chunks.append(upload.finish())
+        usage_data = await run_in_threadpool(
+            parse_usage_data_csv, io.BytesIO(b"".join(csv_chunks))
+        )
+        ledger, appended, skipped = await run_in_threadpool(
+            ledger_store.append,
+            customer_id,
+            usage_data,
+            catalog_version.compiled_plans,
+            catalog_version.version,
+        )
+        ROWS_PARSED.inc(len(usage_data), endpoint="/customers/{customer_id}/usage")
+        return build_ledger_response(
+            ledger, appended_rows=appended, skipped_rows=skipped
+        )
+    except UploadTooLargeError:
+        raise_upload_too_large()
+    except (UploadFormatError, ValueError, KeyError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid usage data: {e}")
+
+
+@app.get("/customers/{customer_id}")
+async def get_customer(customer_id: str, request: Request):
+    """A customer's current cost on every plan, from their ledger"""
+    ledger_store: LedgerStore = request.app.state.ledger_store
+    catalog_version = plan_catalog.current
+    ledger = await run_in_threadpool(
+        ledger_store.get,
+        customer_id,
+        catalog_version.compiled_plans,
+        catalog_version.version,
+    )
+    # A ledger without any rows has no costs to report
+    if ledger is None or not ledger.rows:
+        raise HTTPException(status_code=404, detail="Unknown customer.")
+    return build_ledger_response(ledger)
+
+
+@app.get("/metrics")
+async def metrics():
+    """Request and per-stage durations, rows parsed, bytes read and plans
+    priced, in the Prometheus text format"""
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.post("/recommend/batch")
+async def recommend_batch(request: Request):
+    """Recommends a plan for every customer in a zip or tar of usage data CSVs,
+    or in an NDJSON manifest of local CSV paths, uploaded in a multipart
+    form's "file" field. Streams back one NDJSON line per customer, in the
+    same shape as /recommend/, as each one is priced on the pricing pool.
+
+    The upload is spooled to a temporary file, since archives can't be read
+    front to back, and is limited to max_upload_bytes like /recommend/.
+    """
+    pricing_pool: WorkerPool = request.app.state.pricing_pool
+    if pricing_pool.is_full:
+        raise_pool_full()
+    upload = open_usage_upload(request)
+    batch_file = tempfile.TemporaryFile()
+    try:
+        await spool_upload(request, upload, batch_file)
+    except UploadTooLargeError:
+        batch_file.close()
+        raise_upload_too_large()
+    except UploadFormatError as e:
+        batch_file.close()
+        raise HTTPException(status_code=400, detail=f"Invalid batch upload: {e}")
+    except BaseException:
+        batch_file.close()
+        raise
+    BYTES_READ.inc(upload.body_bytes, endpoint="/recommend/batch")
+    compiled_plans = plan_catalog.current.compiled_plans
+
+    async def stream_results():
+        with batch_file:
+            async for result in run_batch(
+                iter_batch_items(batch_file, settings.batch_manifest_root),
+                compiled_plans,
+                pricing_pool,
+                # Keep every worker busy without reading the whole archive
+                # into memory
+                max_in_flight=2 * pricing_pool.max_workers,
+                chunk_bytes=settings.parse_chunk_bytes,
+            ):
+                if "error" not in result:
+                    PLANS_PRICED.inc(len(compiled_plans), endpoint="/recommend/batch")
+                yield encode_ndjson_line(result)
+
+    return StreamingResponse(stream_results(), media_type=NDJSON_MEDIA_TYPE)
+
+
+@app.post("/portfolio")
+async def portfolio(request: Request):
+    """Which plan every customer in a directory of usage data CSVs would pick
+    and the revenue each plan brings in, and the same for what-if scenarios.
+
+    The body is a JSON object: {"directory": ..., "scenarios": [...]}, where
+    the directory is relative to the batch manifest root and scenarios are
+    optional changes to the plan catalog (see PlanScenario). CSVs are only
+    parsed the first time they're seen or after they change.
+    """
+    batch_executor: ProcessPoolExecutor = request.app.state.batch_executor
+    portfolio_cache: SummaryCache = request.app.state.portfolio_cache
+    compiled_plans = list(plan_catalog.current.compiled_plans)
+    try:
+        body = await request.json()
+        scenarios = [
+            PlanScenario.from_json(scenario) for scenario in body.get("scenarios", [])
+        ]
+        root = settings.batch_manifest_root.resolve()
+        directory = (root / body["directory"]).resolve()
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid portfolio request: {e}")
+    if not directory.is_relative_to(root) or not directory.is_dir():
+        raise HTTPException(
+            status_code=400,
+            detail=f"The directory must be a directory inside {root}.",
+        )
+
+    customer_portfolio = await run_in_threadpool(
+        scan_portfolio, directory, portfolio_cache, batch_executor
+    )
+    try:
+        result = await run_in_threadpool(
+            analyze_portfolio, customer_portfolio, compiled_plans, scenarios
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    PLANS_PRICED.inc(result["customers"] * len(compiled_plans), endpoint="/portfolio")
+    return result
+
+
 @app.get("/")
 async def main():
     content = """
@@ -0,0 +1,199 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator, TypeVar
+
+T = TypeVar("T")
+
+# Upper bounds in seconds, from a cache hit up to pricing years of 1-minute data
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+LabelValues = tuple[str, ...]
+
+
+def _format_labels(names: tuple[str, ...], values: LabelValues, **extra: str) -> str:
+    labels = [*zip(names, values), *extra.items()]
+    if not labels:
+        return ""
+    escaped = (
+        (name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Counter:
+    """A monotonically increasing count, e.g. rows parsed"""
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values: dict[LabelValues, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(tuple(labels[name] for name in self.labelnames), 0)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                labels = _format_labels(self.labelnames, key)
+                lines.append(f"{self.name}{labels} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    """Counts of observations (e.g. durations in seconds) in cumulative buckets"""
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(sorted(buckets))
+        # Per label values: a count per bucket (plus +Inf), then the sum
+        self._values: dict[LabelValues, tuple[list[int], float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            bucket_counts, total = self._values.get(
+                key, ([0] * (len(self.buckets) + 1), 0.0)
+            )
+            for i, upper_bound in enumerate(self.buckets):
+                if value <= upper_bound:
+                    bucket_counts[i] += 1
+                    break
+            else:
+                bucket_counts[-1] += 1
+            self._values[key] = (bucket_counts, total + value)
+
+    def count(self, **labels: str) -> int:
+        key = tuple(labels[name] for name in self.labelnames)
+        return sum(self._values[key][0]) if key in self._values else 0
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (bucket_counts, total) in sorted(self._values.items()):
+                cumulative = 0
+                for upper_bound, bucket_count in zip(
+                    [*map(_format_value, self.buckets), "+Inf"], bucket_counts
+                ):
+                    cumulative += bucket_count
+                    labels = _format_labels(self.labelnames, key, le=upper_bound)
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = _format_labels(self.labelnames, key)
+                lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+                lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """The metrics exposed on /metrics, in the Prometheus text format"""
+
+    def __init__(self) -> None:
+        self.metrics: list[Counter | Histogram] = []
+
+    def counter(self, name: str, help: str, labelnames=()) -> Counter:
+        counter = Counter(name, help, tuple(labelnames))
+        self.metrics.append(counter)
+        return counter
+
+    def histogram(self, name: str, help: str, labelnames=(), **kwargs) -> Histogram:
+        histogram = Histogram(name, help, tuple(labelnames), **kwargs)
+        self.metrics.append(histogram)
+        return histogram
+
+    def render(self) -> str:
+        return "".join(
+            line + "\n" for metric in self.metrics for line in metric.render()
+        )
+
+
+REGISTRY = MetricsRegistry()
+
+REQUEST_SECONDS = REGISTRY.histogram(
+    "plan_optimizer_request_seconds",
+    "Time until the response starts, by endpoint and status code",
+    ["endpoint", "status"],
+)
+STAGE_SECONDS = REGISTRY.histogram(
+    "plan_optimizer_stage_seconds",
+    "Time spent in each stage of handling a request",
+    ["endpoint", "stage"],
+)
+ROWS_PARSED = REGISTRY.counter(
+    "plan_optimizer_rows_parsed_total", "Usage data rows parsed", ["endpoint"]
+)
+BYTES_READ = REGISTRY.counter(
+    "plan_optimizer_bytes_read_total",
+    "Request body bytes read, as received before decompression",
+    ["endpoint"],
+)
+PLANS_PRICED = REGISTRY.counter(
+    "plan_optimizer_plans_priced_total",
+    "Plans priced against a customer's usage data",
+    ["endpoint"],
+)
+RESULT_CACHE_LOOKUPS = REGISTRY.counter(
+    "plan_optimizer_result_cache_lookups_total",
+    "Result cache lookups, by whether they hit",
+    ["result"],
+)
+
+
+class StageTimer:
+    """Collects how long each stage of one request took, for the stage
+    histogram and the Server-Timing header. A stage timed more than once, e.g.
+    parsing each block of an upload, accumulates."""
+
+    def __init__(self) -> None:
+        self.seconds: dict[str, float] = {}
+
+    def add(self, stage: str, seconds: float) -> None:
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+
+    @contextmanager
+    def stage(self, stage: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def observe(self, endpoint: str) -> None:
+        for stage, seconds in self.seconds.items():
+            STAGE_SECONDS.observe(seconds, endpoint=endpoint, stage=stage)
+
+    def server_timing(self) -> str:
+        return ", ".join(
+            f"{stage};dur={seconds * 1000:.1f}"
+            for stage, seconds in self.seconds.items()
+        )
+
+
+def timed_call(fn: Callable[..., T], *args: Any) -> tuple[T, float]:
+    """Returns fn(*args) and how many seconds it took. Submitted to worker
+    processes in place of fn, so time spent queued for a worker or pickling the
+    result isn't counted."""
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
@@ -1,11 +1,57 @@
+from concurrent.futures import Executor
+from datetime import datetime
 from dateutil.parser import parse as parse_date
 from pathlib import Path
 import csv
+import logging
+import os
 
 from custom_types import Seconds, UsageData, UsageDataRow, WattHourUnit
-from typing import BinaryIO
+from usage_aggregate import UsageAggregate
+from typing import BinaryIO, Iterator
 import io
 
+logger = logging.getLogger(__name__)
+
+# Length of the fixed "YYYY-MM-DDTHH:MM:SS±HH:MM" format our meters emit
+ISO_TIMESTAMP_LENGTH = 25
+# Size of the byte ranges a usage data file is split into to parse in parallel
+DEFAULT_PARSE_CHUNK_BYTES = 16 * 1024 * 1024
+
+
+class ParseStats:
+    """Counters describing how a usage data file was parsed"""
+
+    def __init__(self) -> None:
+        self.rows_parsed = 0
+        self.slow_path_rows = 0
+
+
+def is_fixed_iso_timestamp(value: str) -> bool:
+    """Cheap shape check for the fixed "YYYY-MM-DDTHH:MM:SS±HH:MM" format."""
+    return (
+        len(value) == ISO_TIMESTAMP_LENGTH
+        and value[10] == "T"
+        and value[19] in "+-"
+        and value[22] == ":"
+    )
+
+
+def parse_timestamp(value: str, stats: ParseStats | None = None) -> datetime:
+    """Parses a usage timestamp, using datetime.fromisoformat for the fixed
+    format our meters emit and falling back to dateutil for anything else.
+
+    Rows that take the slow dateutil path are counted in stats.
+    """
+    if is_fixed_iso_timestamp(value):
+        try:
+            return datetime.fromisoformat(value)
+        except ValueError:
+            pass
+    if stats is not None:
+        stats.slow_path_rows += 1
+    return parse_date(value)
+
 
 def validate_watt_hour_unit(unit: str) -> WattHourUnit:
     """Validates the unit of wattage."""
@@ -15,18 +61,119 @@ def validate_watt_hour_unit(unit: str) -> WattHourUnit:
     return unit
 
 
-def parse_usage_data_csv(csv_file: BinaryIO) -> UsageData:
-    """Parses a CSV file into typed and validated energy UsageData"""
-    usage_data: UsageData = []
+def iter_usage_data_csv(
+    csv_file: BinaryIO, stats: ParseStats | None = None
+) -> Iterator[UsageDataRow]:
+    """Lazily parses a CSV file into typed and validated energy UsageDataRows
+
+    Rows are yielded as they are read, so callers can process arbitrarily
+    large files without holding all of the usage data in memory.
+
+    Pass a ParseStats to find out how many rows were parsed and how many
+    timestamps were not in the expected fixed ISO 8601 format.
+
+    Raises:
+        ValueError: a row is missing fields or has an invalid value
+    """
+    if stats is None:
+        stats = ParseStats()
     for row in csv.DictReader(io.TextIOWrapper(csv_file, encoding="utf-8")):
-        usage_data.append(
-            UsageDataRow(
-                datetime=parse_date(row["datetime"]),
-                duration=Seconds(int(row["duration"])),
-                unit=validate_watt_hour_unit(row["unit"]),
-                consumption=int(row["consumption"]),
-                generation=int(row["generation"]),
-            )
+        stats.rows_parsed += 1
+        # DictReader fills the fields missing from a short row with None
+        if None in row.values():
+            raise ValueError(f"Row {stats.rows_parsed} is missing fields.")
+        yield UsageDataRow(
+            datetime=parse_timestamp(row["datetime"], stats),
+            duration=Seconds(int(row["duration"])),
+            unit=validate_watt_hour_unit(row["unit"]),
+            consumption=int(row["consumption"]),
+            generation=int(row["generation"]),
         )
 
-    return usage_data
+    if stats.slow_path_rows:
+        logger.warning(
+            "%d of %d usage rows had non-standard timestamps and were parsed "
+            "with dateutil",
+            stats.slow_path_rows,
+            stats.rows_parsed,
+        )
+
+
+def parse_usage_data_csv(
+    csv_file: BinaryIO, stats: ParseStats | None = None
+) -> UsageData:
+    """Parses a CSV file into typed and validated energy UsageData"""
+    return UsageData(iter_usage_data_csv(csv_file, stats))
+
+
+def aggregate_usage_csv_block(header: bytes, block: bytes) -> UsageAggregate:
+    """Parses a block of whole CSV lines, from anywhere in a usage data file,
+    straight into a UsageAggregate. header is the file's header line.
+
+    Blocks can be parsed independently (e.g. on a process pool as they are
+    uploaded) and combined with UsageAggregate.merge.
+    """
+    return UsageAggregate.from_usage_rows(
+        iter_usage_data_csv(io.BytesIO(header + block))
+    )
+
+
+def split_file_ranges(size: int, chunk_bytes: int) -> list[tuple[int, int]]:
+    """Byte ranges of roughly chunk_bytes covering a file of size bytes"""
+    return [
+        (start, min(start + chunk_bytes, size)) for start in range(0, size, chunk_bytes)
+    ] or [(0, 0)]
+
+
+def aggregate_usage_csv_range(csv_path: Path, start: int, end: int) -> UsageAggregate:
+    """Parses the lines of a usage data CSV that start within the byte range
+    [start, end) into a UsageAggregate.
+
+    A line running over either end of the range belongs to the range it starts
+    in, so ranges covering a file can be parsed independently (e.g. in
+    different processes, each reading just its own part of the file) and the
+    results combined with UsageAggregate.merge. Chunks may split a month, or a
+    tier's worth of usage, anywhere: tiers are only priced from the merged
+    monthly totals.
+    """
+    with open(csv_path, "rb") as csv_file:
+        header = csv_file.readline()
+        if start <= len(header):
+            csv_file.seek(len(header))
+        else:
+            # Skip the rest of the line that started in the previous range
+            csv_file.seek(start - 1)
+            csv_file.readline()
+        block_start = csv_file.tell()
+        if end > block_start:
+            csv_file.seek(end - 1)
+            csv_file.readline()
+            block_end = csv_file.tell()
+        else:
+            block_end = block_start
+        csv_file.seek(block_start)
+        block = csv_file.read(block_end - block_start)
+    return aggregate_usage_csv_block(header, block)
+
+
+def aggregate_usage_csv_file(
+    csv_path: Path,
+    executor: Executor | None = None,
+    chunk_bytes: int = DEFAULT_PARSE_CHUNK_BYTES,
+) -> UsageAggregate:
+    """Parses a usage data CSV into a UsageAggregate, splitting it into
+    chunk_bytes ranges parsed in parallel on executor (a process pool).
+
+    Only the path and byte offsets are sent to the workers, which read their
+    own ranges, so parsing scales with the number of workers rather than
+    being bound by copying the file between processes. Without an executor
+    the file is parsed in a single pass on this process.
+    """
+    if executor is None:
+        with open(csv_path, "rb") as csv_file:
+            return UsageAggregate.from_usage_rows(iter_usage_data_csv(csv_file))
+    futures = [
+        executor.submit(aggregate_usage_csv_range, csv_path, start, end)
+        for start, end in split_file_ranges(os.path.getsize(csv_path), chunk_bytes)
+    ]
+    return UsageAggregate.merge(future.result() for future in futures)
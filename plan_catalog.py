@@ -0,0 +1,127 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import NamedTuple
+
+from calc_plan_cost import compile_plan_config
+from custom_types import CompiledPlan, PlanConfig
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+PLAN_CATALOG_LOAD_SECONDS = REGISTRY.histogram(
+    "plan_optimizer_plan_catalog_load_seconds",
+    "Time to read, validate and compile the plan configs file",
+)
+
+
+class PlanCatalogVersion(NamedTuple):
+    version: str  # hash of the plan configs file contents
+    mtime_ns: int
+    compiled_plans: tuple[CompiledPlan, ...]
+
+
+def load_plan_catalog(path: Path) -> PlanCatalogVersion:
+    """Reads, validates and compiles every plan config in a plan configs file
+
+    Raises:
+        OSError: the file could not be read
+        ValueError: the file is not valid JSON or contains an invalid plan
+    """
+    mtime_ns = os.stat(path).st_mtime_ns
+    with open(path, "rb") as f:
+        contents = f.read()
+    try:
+        plan_configs = [
+            PlanConfig.from_json(plan_config) for plan_config in json.loads(contents)
+        ]
+    except (KeyError, TypeError) as e:
+        raise ValueError(f"Malformed plan config in {path}: {e!r}") from e
+    return PlanCatalogVersion(
+        version=hashlib.sha256(contents).hexdigest()[:16],
+        mtime_ns=mtime_ns,
+        compiled_plans=tuple(
+            compile_plan_config(plan_config) for plan_config in plan_configs
+        ),
+    )
+
+
+class PlanCatalog:
+    """The compiled plan configs, loaded once and hot-reloaded on change.
+
+    Requests read `current`, which never touches the file system. A background
+    thread polls the file's mtime and swaps in a new PlanCatalogVersion in a
+    single assignment, so readers see either the old or the new catalog and
+    never a partially loaded one. A file that fails to load or validate is
+    logged and the previous version is kept.
+    """
+
+    def __init__(self, path: Path, poll_interval_seconds: float = 2.0) -> None:
+        self.path = Path(path)
+        self.poll_interval_seconds = poll_interval_seconds
+        self._current = self._load()
+        self._failed_mtime_ns: int | None = None
+        self._stop_watching = threading.Event()
+        self._watcher: threading.Thread | None = None
+
+    def _load(self) -> PlanCatalogVersion:
+        start = time.perf_counter()
+        try:
+            return load_plan_catalog(self.path)
+        finally:
+            PLAN_CATALOG_LOAD_SECONDS.observe(time.perf_counter() - start)
+
+    @property
+    def current(self) -> PlanCatalogVersion:
+        return self._current
+
+    def reload_if_changed(self) -> bool:
+        """Reloads the catalog if the file's mtime changed, returning whether a
+        new version was swapped in."""
+        try:
+            mtime_ns = os.stat(self.path).st_mtime_ns
+        except OSError:
+            logger.exception("Could not stat plan configs file %s", self.path)
+            return False
+        if mtime_ns in (self._current.mtime_ns, self._failed_mtime_ns):
+            return False
+
+        try:
+            new_version = self._load()
+        except (OSError, ValueError):
+            self._failed_mtime_ns = mtime_ns
+            logger.exception(
+                "Could not reload %s, keeping plan catalog version %s",
+                self.path,
+                self._current.version,
+            )
+            return False
+
+        self._current = new_version
+        self._failed_mtime_ns = None
+        logger.info("Loaded plan catalog version %s", new_version.version)
+        return True
+
+    def _watch(self) -> None:
+        while not self._stop_watching.wait(self.poll_interval_seconds):
+            self.reload_if_changed()
+
+    def start_watching(self) -> None:
+        if self._watcher is not None:
+            return
+        self._stop_watching.clear()
+        self._watcher = threading.Thread(
+            target=self._watch, name="plan-catalog-watcher", daemon=True
+        )
+        self._watcher.start()
+
+    def stop_watching(self) -> None:
+        if self._watcher is None:
+            return
+        self._stop_watching.set()
+        self._watcher.join()
+        self._watcher = None
@@ -0,0 +1,302 @@
+import copy
+import io
+import itertools
+import math
+from fractions import Fraction
+from typing import Any, Iterator, NamedTuple
+
+import numpy as np
+
+from calc_plan_cost import (
+    calc_buyback_microcents,
+    calc_total_cost_microcents,
+    cents_from_microcents,
+    compile_plan_config,
+    int_dot,
+)
+from custom_types import Cents, CompiledPlan, CostData, PlanConfig
+from parse_usage_data import iter_usage_data_csv
+from usage_aggregate import UsageAggregate
+
+# Path to a value in a plan grid, e.g. ("tiered_rates", 0, "usage_kwh")
+GridPath = tuple[str | int, ...]
+# Plan config fields holding lists of objects, which may be empty
+OBJECT_LIST_FIELDS = {"tiered_rates", "time_of_day_prices", "time_of_day_rates"}
+
+
+class GridAxis(NamedTuple):
+    """A plan config parameter swept over a list of values"""
+
+    path: GridPath
+    values: list[Any]
+
+    @property
+    def name(self) -> str:
+        return "".join(
+            f"[{step}]" if isinstance(step, int) else f".{step}" for step in self.path
+        ).lstrip(".")
+
+
+class PlanGrid(NamedTuple):
+    """A family of plans: a plan config in the plan_configs.json format where
+    any number or time can instead be a list of values to try, e.g.
+
+        {"name": "Tiered", "base_rate_per_kwh": 14,
+         "base_monthly_fee": [0, 500, 1000],
+         "tiered_rates": [{"usage_kwh": [300, 500, 1000], "rate_cents_per_kwh": 9}]}
+
+    is a grid of 9 candidate plans.
+    """
+
+    template: dict
+    axes: tuple[GridAxis, ...]
+
+    @classmethod
+    def from_json(cls, data: dict) -> "PlanGrid":
+        """
+        Raises:
+            ValueError: the grid isn't a JSON object, or has an empty list of
+                values to try
+        """
+        if not isinstance(data, dict):
+            raise ValueError("A plan grid must be a JSON object.")
+        return cls(template=data, axes=tuple(_find_axes(data, ())))
+
+    @property
+    def shape(self) -> tuple[int, ...]:
+        return tuple(len(axis.values) for axis in self.axes)
+
+    def __len__(self) -> int:
+        return math.prod(self.shape)
+
+    def iter_candidates(self) -> Iterator[tuple[PlanConfig, dict[str, Any]]]:
+        """Yields every candidate plan and the swept parameter values it was
+        built from, in row-major order over the axes
+
+        Raises:
+            ValueError: a candidate isn't a valid plan config
+        """
+        name = self.template.get("name", "No Name")
+        for number, values in enumerate(
+            itertools.product(*(axis.values for axis in self.axes)), start=1
+        ):
+            plan_json = copy.deepcopy(self.template)
+            for axis, value in zip(self.axes, values):
+                _set_path(plan_json, axis.path, value)
+            plan_json["name"] = f"{name} #{number}"
+            try:
+                plan_config = PlanConfig.from_json(plan_json)
+            except (KeyError, TypeError, ValueError) as e:
+                raise ValueError(f"Invalid plan in grid: {e!r}") from e
+            yield plan_config, {
+                axis.name: value for axis, value in zip(self.axes, values)
+            }
+
+
+def _find_axes(value: Any, path: GridPath) -> Iterator[GridAxis]:
+    if isinstance(value, dict):
+        for key, child in value.items():
+            yield from _find_axes(child, (*path, key))
+    elif isinstance(value, list):
+        # Lists of objects are tiers or time of day prices, anything else is
+        # a list of values to sweep
+        if not value and (not path or path[-1] not in OBJECT_LIST_FIELDS):
+            raise ValueError(f"{GridAxis(path, value).name} has no values to try.")
+        if all(isinstance(child, dict) for child in value):
+            for i, child in enumerate(value):
+                yield from _find_axes(child, (*path, i))
+        else:
+            yield GridAxis(path, value)
+
+
+def _set_path(data: Any, path: GridPath, value: Any) -> None:
+    for step in path[:-1]:
+        data = data[step]
+    data[path[-1]] = value
+
+
+def calc_plan_costs_swept(
+    compiled_plans: list[CompiledPlan], usage_aggregate: UsageAggregate
+) -> np.ndarray:
+    """Total cost in cents of every plan, for pricing thousands of candidate
+    plans against one customer.
+
+    Gives the same costs as calc_aggregate_plan_cost, but everything that only
+    depends on the usage (monthly totals and consumption by minute of day) is
+    computed once up front, leaving a dot product per interval duration per
+    time of day plan and a few array operations over the months per tiered
+    plan. Costs are exact until the final conversion to cents.
+
+    Raises:
+        ValueError: the usage data is empty
+    """
+    num_of_months = len(usage_aggregate.months)
+    if not num_of_months:
+        raise ValueError("Usage data is empty.")
+    monthly_consumption_wh = usage_aggregate.monthly_consumption_wh
+    total_consumption_wh = int(monthly_consumption_wh.sum())
+    wh_seconds_by_minute: dict[int, np.ndarray] | None = None
+
+    total_costs = np.empty(len(compiled_plans))
+    for i, compiled_plan in enumerate(compiled_plans):
+        plan_config = compiled_plan.plan_config
+        if plan_config.tiered_rates:
+            tiers_end_wh = 0
+            energy_cost_microcents: int | Fraction = 0
+            for tier in compiled_plan.tier_breakpoints:
+                energy_cost_microcents += tier.rate_millicents_per_kwh * int(
+                    np.clip(
+                        monthly_consumption_wh - tier.start_wh,
+                        0,
+                        tier.end_wh - tier.start_wh,
+                    ).sum()
+                )
+                tiers_end_wh = tier.end_wh
+            energy_cost_microcents += compiled_plan.base_rate_millicents_per_kwh * int(
+                np.maximum(monthly_consumption_wh - tiers_end_wh, 0).sum()
+            )
+        elif plan_config.time_of_day_prices:
+            if wh_seconds_by_minute is None:
+                wh_seconds_by_minute = (
+                    usage_aggregate.consumption_wh_seconds_by_minute()
+                )
+            rate_by_minute = np.asarray(compiled_plan.rate_by_minute, dtype=np.int64)
+            energy_cost_microcents = sum(
+                (
+                    Fraction(int_dot(rate_by_minute, wh_seconds), duration)
+                    for duration, wh_seconds in wh_seconds_by_minute.items()
+                ),
+                Fraction(0),
+            )
+        else:
+            energy_cost_microcents = (
+                total_consumption_wh * compiled_plan.base_rate_millicents_per_kwh
+            )
+        total_costs[i] = cents_from_microcents(
+            calc_total_cost_microcents(
+                plan_config,
+                energy_cost_microcents,
+                num_of_months,
+                calc_buyback_microcents(compiled_plan, usage_aggregate),
+            )
+        )
+    return total_costs
+
+
+class BreakEven(NamedTuple):
+    """Where the best plan would cost the same as the reference plan if one
+    parameter were changed and the others kept"""
+
+    parameter: str
+    value: float
+
+    def to_api_json(self) -> dict:
+        return {"parameter": self.parameter, "value": round(self.value, 4)}
+
+
+def find_break_evens(
+    plan_grid: PlanGrid, total_costs: np.ndarray, reference_cost: float
+) -> list[BreakEven]:
+    """Sweeps each numeric parameter on its own, keeping the others at the best
+    candidate's values, and interpolates where the cost crosses reference_cost"""
+    costs = total_costs.reshape(plan_grid.shape)
+    best = np.unravel_index(int(np.argmin(costs)), costs.shape)
+    break_evens = []
+    for axis_number, axis in enumerate(plan_grid.axes):
+        if not all(isinstance(value, (int, float)) for value in axis.values):
+            continue
+        line = costs[(*best[:axis_number], slice(None), *best[axis_number + 1 :])]
+        order = np.argsort(axis.values, kind="stable")
+        values = np.asarray(axis.values, dtype=np.float64)[order]
+        over = line[order] - reference_cost
+        for j in range(len(values) - 1):
+            if over[j] == 0:
+                break_evens.append(BreakEven(axis.name, float(values[j])))
+            elif over[j] * over[j + 1] < 0:
+                fraction = over[j] / (over[j] - over[j + 1])
+                value = values[j] + fraction * (values[j + 1] - values[j])
+                break_evens.append(BreakEven(axis.name, float(value)))
+        if len(values) and over[-1] == 0:
+            break_evens.append(BreakEven(axis.name, float(values[-1])))
+    return break_evens
+
+
+def optimize_plans(
+    plan_grids: list[PlanGrid],
+    usage_aggregate: UsageAggregate,
+    reference_plans: list[CompiledPlan],
+    top: int,
+) -> dict:
+    """Prices every candidate in the plan grids against one customer's usage,
+    returning the top cheapest candidates and, for each grid, where its best
+    candidate breaks even with the cheapest reference plan (e.g. the plan
+    catalog).
+
+    Raises:
+        ValueError: the usage data is empty or a candidate is invalid
+    """
+    num_of_months = len(usage_aggregate.months)
+    reference_costs = calc_plan_costs_swept(reference_plans, usage_aggregate)
+    cheapest_reference = int(np.argmin(reference_costs))
+    reference_cost = float(reference_costs[cheapest_reference])
+
+    candidates: list[tuple[float, PlanConfig, dict]] = []
+    grids = []
+    for plan_grid in plan_grids:
+        plan_configs, parameters = zip(*plan_grid.iter_candidates())
+        total_costs = calc_plan_costs_swept(
+            [compile_plan_config(plan_config) for plan_config in plan_configs],
+            usage_aggregate,
+        )
+        candidates.extend(zip(total_costs.tolist(), plan_configs, parameters))
+        grids.append(
+            {
+                "name": plan_grid.template.get("name", "No Name"),
+                "candidates": len(plan_grid),
+                "break_even": [
+                    break_even.to_api_json()
+                    for break_even in find_break_evens(
+                        plan_grid, total_costs, reference_cost
+                    )
+                ],
+            }
+        )
+
+    def to_api_json(total_cost: float, plan_config: PlanConfig) -> dict:
+        return CostData(
+            plan_config=plan_config,
+            total_cost=Cents(total_cost),
+            monthly_average_cost=Cents(total_cost / num_of_months),
+        ).to_api_json()
+
+    cheapest = sorted(candidates, key=lambda candidate: candidate[0])[:top]
+    return {
+        "candidates": len(candidates),
+        "reference": to_api_json(
+            reference_cost, reference_plans[cheapest_reference].plan_config
+        ),
+        "best": [
+            {**to_api_json(total_cost, plan_config), "parameters": parameters}
+            for total_cost, plan_config, parameters in cheapest
+        ],
+        "grids": grids,
+    }
+
+
+def optimize_usage_csv_bytes(
+    file_name: str | None,
+    csv_bytes: bytes,
+    plan_grids: list[PlanGrid],
+    reference_plans: list[CompiledPlan],
+    top: int,
+) -> dict:
+    """The /optimize response for an uploaded usage data CSV; the CSV is parsed
+    and reduced once, however many candidates are priced. Runs in a worker
+    process."""
+    usage_aggregate = UsageAggregate.from_usage_rows(
+        iter_usage_data_csv(io.BytesIO(csv_bytes))
+    )
+    return {
+        "file_name": file_name,
+        **optimize_plans(plan_grids, usage_aggregate, reference_plans, top),
+    }
@@ -0,0 +1,612 @@
+"""Which plan every customer in a directory of usage data CSVs would pick, the
+revenue each plan brings in, and how that moves under what-if changes to the
+plans, for tariff design:
+
+    python portfolio.py customers/ --scenarios scenarios.json
+
+Each CSV is reduced once to a CustomerSummary, cached on disk by path, size
+and mtime, so later runs only parse new or changed files. Every plan is then
+priced against every customer at once with array operations.
+"""
+
+import argparse
+import json
+import math
+import os
+import sqlite3
+import sys
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor
+from fractions import Fraction
+from pathlib import Path
+from typing import Any, Hashable, Iterable, NamedTuple
+
+import numpy as np
+
+from calc_plan_cost import compile_plan_config, prices_buyback_by_month
+from custom_types import (
+    MICROCENTS_PER_CENT,
+    MINUTES_PER_DAY,
+    Cents,
+    CompiledPlan,
+    PlanConfig,
+    format_currency,
+)
+from parse_usage_data import aggregate_usage_csv_file
+from plan_catalog import load_plan_catalog
+from usage_aggregate import UsageAggregate, sum_by_group
+
+DEFAULT_PLAN_CONFIGS_PATH = Path(__file__).parent / "plan_configs.json"
+
+
+class CustomerSummary(NamedTuple):
+    """Everything needed to price any plan for one customer: consumption by
+    month for tiers and fees, generation for the buyback, and consumption by
+    local minute of day for time of day prices"""
+
+    monthly_consumption_wh: np.ndarray  # int64 per month with usage
+    generation_wh: int
+    # Wh * seconds of consumption falling in each minute of the day, over
+    # seconds_denominator, so a time of day plan's exact energy cost in
+    # micro-cents is np.dot(rate_by_minute, wh_seconds_by_minute) /
+    # seconds_denominator (see UsageAggregate.consumption_wh_seconds_by_minute)
+    wh_seconds_by_minute: np.ndarray  # int64[MINUTES_PER_DAY]
+    # The least common multiple of the interval durations, usually just the one
+    seconds_denominator: int
+
+    @classmethod
+    def from_usage_aggregate(cls, usage_aggregate: UsageAggregate) -> "CustomerSummary":
+        by_duration = usage_aggregate.consumption_wh_seconds_by_minute()
+        seconds_denominator = math.lcm(*by_duration)
+        wh_seconds_by_minute = np.zeros(MINUTES_PER_DAY, dtype=np.int64)
+        for duration, wh_seconds in by_duration.items():
+            wh_seconds_by_minute += wh_seconds * (seconds_denominator // duration)
+        return cls(
+            monthly_consumption_wh=usage_aggregate.monthly_consumption_wh.astype(
+                np.int64
+            ),
+            generation_wh=int(usage_aggregate.monthly_generation_wh.sum()),
+            wh_seconds_by_minute=wh_seconds_by_minute,
+            seconds_denominator=seconds_denominator,
+        )
+
+    def to_bytes(self) -> bytes:
+        return (
+            np.array(
+                [
+                    len(self.monthly_consumption_wh),
+                    self.generation_wh,
+                    self.seconds_denominator,
+                ],
+                dtype="<i8",
+            ).tobytes()
+            + self.monthly_consumption_wh.astype("<i8").tobytes()
+            + self.wh_seconds_by_minute.astype("<i8").tobytes()
+        )
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "CustomerSummary":
+        num_of_months, generation_wh, seconds_denominator = np.frombuffer(
+            data, dtype="<i8", count=3
+        )
+        return cls(
+            monthly_consumption_wh=np.frombuffer(
+                data, dtype="<i8", count=num_of_months, offset=24
+            ).astype(np.int64),
+            generation_wh=int(generation_wh),
+            wh_seconds_by_minute=np.frombuffer(
+                data, dtype="<i8", offset=24 + 8 * int(num_of_months)
+            ).astype(np.int64),
+            seconds_denominator=int(seconds_denominator),
+        )
+
+
+def summarize_usage_csv(csv_path: Path) -> CustomerSummary:
+    """Parses and reduces one customer's usage data CSV; runs in a worker
+    process
+
+    Raises:
+        ValueError: the usage data is empty or invalid
+    """
+    summary = CustomerSummary.from_usage_aggregate(aggregate_usage_csv_file(csv_path))
+    if not len(summary.monthly_consumption_wh):
+        raise ValueError("Usage data is empty.")
+    return summary
+
+
+class SummaryCache:
+    """Customer summaries persisted in SQLite, or in an in-memory SQLite
+    database when no sqlite_path is given, keyed by the CSV's path. A summary
+    is only used while the file's size and mtime are unchanged.
+
+    The last Portfolio scanned is also kept in memory, as long as none of its
+    files have been added, removed or changed, so repeated scans of the same
+    directory don't restack every summary.
+    """
+
+    def __init__(self, sqlite_path: Path | None = None) -> None:
+        self._db = sqlite3.connect(sqlite_path or ":memory:", check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS customer_summaries (path TEXT PRIMARY KEY, "
+            "size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, summary BLOB NOT NULL)"
+        )
+        self._db.commit()
+        self._lock = threading.Lock()
+        self._portfolio: tuple[Hashable, "Portfolio"] | None = None
+
+    def get(self, path: str, size: int, mtime_ns: int) -> CustomerSummary | None:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT summary FROM customer_summaries "
+                "WHERE path = ? AND size = ? AND mtime_ns = ?",
+                (path, size, mtime_ns),
+            ).fetchone()
+        return None if row is None else CustomerSummary.from_bytes(row[0])
+
+    def put_many(
+        self, summaries: Iterable[tuple[str, int, int, CustomerSummary]]
+    ) -> None:
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO customer_summaries "
+                "(path, size, mtime_ns, summary) VALUES (?, ?, ?, ?)",
+                (
+                    (path, size, mtime_ns, summary.to_bytes())
+                    for path, size, mtime_ns, summary in summaries
+                ),
+            )
+
+    def get_portfolio(self, scan_key: Hashable) -> "Portfolio | None":
+        """The last Portfolio put, if it was scanned from the same files"""
+        with self._lock:
+            if self._portfolio is None or self._portfolio[0] != scan_key:
+                return None
+            return self._portfolio[1]
+
+    def put_portfolio(self, scan_key: Hashable, portfolio: "Portfolio") -> None:
+        with self._lock:
+            self._portfolio = (scan_key, portfolio)
+
+    def close(self) -> None:
+        self._db.close()
+
+
+class Portfolio(NamedTuple):
+    """Every customer's summary, stacked into arrays so plans can be priced
+    against all of them at once. Customer-months are flattened into
+    month_customer and monthly_consumption_wh.
+
+    wh_seconds_by_minute takes MINUTES_PER_DAY int64s per customer, about
+    1.2 GB for 100k customers.
+    """
+
+    customers: list[str]
+    num_of_months: np.ndarray  # int64 per customer
+    consumption_wh: np.ndarray  # int64 per customer
+    generation_wh: np.ndarray  # int64 per customer
+    month_customer: np.ndarray  # int64 customer index per customer-month
+    monthly_consumption_wh: np.ndarray  # int64 per customer-month
+    wh_seconds_by_minute: np.ndarray  # int64[customers, MINUTES_PER_DAY]
+    seconds_denominator: np.ndarray  # int64 per customer
+    # {"customer": ..., "error": ...} for files that couldn't be summarized
+    errors: list[dict] = []
+
+    @classmethod
+    def from_summaries(
+        cls,
+        summaries: list[tuple[str, CustomerSummary]],
+        errors: list[dict] | None = None,
+    ) -> "Portfolio":
+        customers = [customer for customer, _ in summaries]
+        customer_summaries = [summary for _, summary in summaries]
+        num_of_months = np.array(
+            [len(summary.monthly_consumption_wh) for summary in customer_summaries],
+            dtype=np.int64,
+        )
+        monthly_consumption_wh = (
+            np.concatenate(
+                [summary.monthly_consumption_wh for summary in customer_summaries]
+            )
+            if customer_summaries
+            else np.zeros(0, dtype=np.int64)
+        )
+        month_customer = np.repeat(np.arange(len(customers)), num_of_months)
+        return cls(
+            customers=customers,
+            num_of_months=num_of_months,
+            consumption_wh=sum_by_group(
+                month_customer, monthly_consumption_wh, len(customers)
+            ),
+            generation_wh=np.array(
+                [summary.generation_wh for summary in customer_summaries],
+                dtype=np.int64,
+            ),
+            month_customer=month_customer,
+            monthly_consumption_wh=monthly_consumption_wh,
+            wh_seconds_by_minute=np.array(
+                [summary.wh_seconds_by_minute for summary in customer_summaries],
+                dtype=np.int64,
+            ).reshape(-1, MINUTES_PER_DAY),
+            seconds_denominator=np.array(
+                [summary.seconds_denominator for summary in customer_summaries],
+                dtype=np.int64,
+            ),
+            errors=errors or [],
+        )
+
+
+def _is_csv(path: Path) -> bool:
+    return path.suffix.lower() == ".csv"
+
+
+def scan_portfolio(
+    directory: Path, cache: SummaryCache, executor: Executor | None = None
+) -> Portfolio:
+    """Summarizes every usage data CSV under directory, taking unchanged files
+    from the cache and parsing the rest on executor (a process pool), or on
+    this process without one. Customers are named by their path relative to
+    directory.
+
+    If no file has been added, removed or changed since the cache's last scan
+    of directory, its Portfolio is returned as it was.
+    """
+    files = []
+    for path in sorted(directory.rglob("*")):
+        if not path.is_file() or not _is_csv(path):
+            continue
+        stat = path.stat()
+        files.append(
+            (path.relative_to(directory).as_posix(), stat.st_size, stat.st_mtime_ns)
+        )
+    scan_key = (str(directory.resolve()), tuple(files))
+    cached_portfolio = cache.get_portfolio(scan_key)
+    if cached_portfolio is not None:
+        return cached_portfolio
+
+    summaries: dict[str, CustomerSummary] = {}
+    errors = []
+    to_parse: list[tuple[str, Path, int, int]] = []
+    for customer, size, mtime_ns in files:
+        summary = cache.get(customer, size, mtime_ns)
+        if summary is None:
+            to_parse.append((customer, directory / customer, size, mtime_ns))
+        else:
+            summaries[customer] = summary
+
+    if executor is None:
+        parsed = map(_try_summarize_usage_csv, (path for _, path, _, _ in to_parse))
+    else:
+        parsed = executor.map(
+            _try_summarize_usage_csv,
+            (path for _, path, _, _ in to_parse),
+            chunksize=16,
+        )
+    new_summaries = []
+    for (customer, _, size, mtime_ns), result in zip(to_parse, parsed):
+        if isinstance(result, str):
+            errors.append({"customer": customer, "error": result})
+            continue
+        summaries[customer] = result
+        new_summaries.append((customer, size, mtime_ns, result))
+    cache.put_many(new_summaries)
+    portfolio = Portfolio.from_summaries(sorted(summaries.items()), errors)
+    cache.put_portfolio(scan_key, portfolio)
+    return portfolio
+
+
+def _try_summarize_usage_csv(csv_path: Path) -> CustomerSummary | str:
+    try:
+        return summarize_usage_csv(csv_path)
+    except (OSError, ValueError, KeyError) as e:
+        return str(e)
+
+
+def int_matmul(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """a @ b of two int64 matrices, exactly: in int64, falling back to Python
+    ints if the sums could overflow, like int_dot"""
+    if not a.size or not b.size:
+        return np.zeros((a.shape[0], b.shape[1]), dtype=np.int64)
+    a_max = max(int(a.max()), -int(a.min()))
+    b_max = max(int(b.max()), -int(b.min()))
+    if a_max * b_max * a.shape[1] < 2**63:
+        return a @ b
+    return a.astype(object) @ b.astype(object)
+
+
+def price_portfolio(
+    portfolio: Portfolio, compiled_plans: list[CompiledPlan]
+) -> np.ndarray:
+    """Total cost in cents of every plan (columns) for every customer (rows).
+
+    Time of day plans are priced together in one matrix product over the
+    minutes of the day, and tiered plans with a few array operations over
+    every customer-month. Energy and buyback are summed exactly, in integer
+    micro-cents over each customer's seconds_denominator, and rounded to
+    cents once, so customers pick the same plans as with calc_plan_costs.
+
+    Raises:
+        ValueError: a plan has buyback rates by time of day or caps monthly
+            credit, which customer summaries don't keep enough detail for
+    """
+    for compiled_plan in compiled_plans:
+        if prices_buyback_by_month(compiled_plan):
+            raise ValueError(
+                f"{compiled_plan.plan_config.name!r} can't be priced across a "
+                "portfolio: only flat buyback rates are supported."
+            )
+    customers = len(portfolio.customers)
+    time_of_day = [
+        i
+        for i, compiled_plan in enumerate(compiled_plans)
+        if compiled_plan.plan_config.time_of_day_prices
+    ]
+    time_of_day_microcents = int_matmul(
+        portfolio.wh_seconds_by_minute,
+        np.array(
+            [compiled_plans[i].rate_by_minute for i in time_of_day], dtype=np.int64
+        )
+        .reshape(-1, MINUTES_PER_DAY)
+        .T,
+    )
+    # Micro-cents times each customer's seconds_denominator
+    numerators = np.zeros(
+        (customers, len(compiled_plans)), dtype=time_of_day_microcents.dtype
+    )
+    numerators[:, time_of_day] = time_of_day_microcents
+    denominators = portfolio.seconds_denominator
+    fees_cents = np.zeros((customers, len(compiled_plans)))
+
+    for i, compiled_plan in enumerate(compiled_plans):
+        plan_config = compiled_plan.plan_config
+        if plan_config.tiered_rates:
+            monthly_microcents = np.zeros(
+                len(portfolio.monthly_consumption_wh), dtype=np.int64
+            )
+            for tier in compiled_plan.tier_breakpoints:
+                monthly_microcents += tier.rate_millicents_per_kwh * np.clip(
+                    portfolio.monthly_consumption_wh - tier.start_wh,
+                    0,
+                    tier.end_wh - tier.start_wh,
+                )
+            monthly_microcents += (
+                compiled_plan.base_rate_millicents_per_kwh
+                * np.maximum(
+                    portfolio.monthly_consumption_wh
+                    - compiled_plan.tier_breakpoints[-1].end_wh,
+                    0,
+                )
+            )
+            energy_microcents = sum_by_group(
+                portfolio.month_customer, monthly_microcents, customers
+            )
+        elif plan_config.time_of_day_prices:
+            energy_microcents = np.zeros(customers, dtype=np.int64)
+        else:
+            energy_microcents = (
+                portfolio.consumption_wh * compiled_plan.base_rate_millicents_per_kwh
+            )
+        # Generation bought back at the buyback rate, and fees, as in
+        # calc_total_cost_microcents
+        energy_microcents -= (
+            portfolio.generation_wh * compiled_plan.buyback_rate_millicents_per_kwh
+        )
+        numerators[:, i] += energy_microcents * denominators
+        fee_microcents = Fraction(plan_config.base_monthly_fee) * MICROCENTS_PER_CENT
+        if fee_microcents.denominator == 1:
+            numerators[:, i] += (
+                int(fee_microcents) * portfolio.num_of_months * denominators
+            )
+        else:
+            fees_cents[:, i] = (
+                float(plan_config.base_monthly_fee) * portfolio.num_of_months
+            )
+    # Python ints (object arrays) are divided elementwise, rounding exactly
+    return (
+        numerators
+        / (MICROCENTS_PER_CENT * denominators[:, np.newaxis]).astype(numerators.dtype)
+    ).astype(np.float64) + fees_cents
+
+
+class PlanScenario(NamedTuple):
+    """A what-if change to the plan catalog, e.g.
+
+        {"name": "Cheaper flat rate", "plans": {"Flat": {"base_rate_per_kwh": 14}}}
+
+    Each entry in plans replaces those fields of the catalog plan with that
+    name, adds a new plan if there isn't one, or removes the plan if it's
+    null.
+    """
+
+    name: str
+    plans: dict[str, dict | None]
+
+    @classmethod
+    def from_json(cls, data: Any) -> "PlanScenario":
+        """
+        Raises:
+            ValueError: the scenario isn't in the format above
+        """
+        if (
+            not isinstance(data, dict)
+            or not isinstance(data.get("plans"), dict)
+            or not all(
+                changes is None or isinstance(changes, dict)
+                for changes in data["plans"].values()
+            )
+        ):
+            raise ValueError(
+                'A scenario must be a JSON object with a "plans" object of plan '
+                "changes by plan name."
+            )
+        return cls(name=str(data.get("name", "No Name")), plans=data["plans"])
+
+    def apply(self, plan_configs: Iterable[PlanConfig]) -> list[PlanConfig]:
+        """
+        Raises:
+            ValueError: a changed plan isn't a valid plan config
+        """
+        changed_plans = []
+        names = set()
+        for plan_config in plan_configs:
+            names.add(plan_config.name)
+            if plan_config.name not in self.plans:
+                changed_plans.append(plan_config)
+            elif self.plans[plan_config.name] is not None:
+                changed_plans.append(
+                    self._plan_config(
+                        {**plan_config.to_json(), **self.plans[plan_config.name]},
+                        plan_config.name,
+                    )
+                )
+        for name, changes in self.plans.items():
+            if name not in names and changes is not None:
+                changed_plans.append(self._plan_config(changes, name))
+        if not changed_plans:
+            raise ValueError(f"Scenario {self.name!r} removes every plan.")
+        return changed_plans
+
+    def _plan_config(self, plan_json: dict, name: str) -> PlanConfig:
+        try:
+            plan_config = PlanConfig.from_json({**plan_json, "name": name})
+            compile_plan_config(plan_config)
+        except (KeyError, TypeError, ValueError) as e:
+            raise ValueError(f"Invalid plan in scenario {self.name!r}: {e!r}") from e
+        return plan_config
+
+
+def summarize_choices(
+    portfolio: Portfolio, plan_configs: list[PlanConfig], total_costs: np.ndarray
+) -> tuple[dict, np.ndarray]:
+    """How many customers pick each plan (the cheapest for them) and the
+    revenue it brings in, along with each customer's pick"""
+    choices = np.argmin(total_costs, axis=1)
+    chosen_costs = total_costs[np.arange(len(choices)), choices]
+    customers = np.bincount(choices, minlength=len(plan_configs))
+    revenue = np.bincount(choices, weights=chosen_costs, minlength=len(plan_configs))
+    months = np.bincount(
+        choices, weights=portfolio.num_of_months, minlength=len(plan_configs)
+    )
+    num_of_customers = max(len(choices), 1)
+    return {
+        "revenue": format_currency(Cents(float(chosen_costs.sum()))),
+        "plans": [
+            {
+                "plan": plan_config.to_api_json(),
+                "customers": int(customers[i]),
+                "share": round(int(customers[i]) / num_of_customers, 4),
+                "revenue": format_currency(Cents(float(revenue[i]))),
+                "average_monthly_bill": format_currency(
+                    Cents(float(revenue[i] / months[i]) if months[i] else 0.0)
+                ),
+            }
+            for i, plan_config in enumerate(plan_configs)
+        ],
+    }, choices
+
+
+def analyze_portfolio(
+    portfolio: Portfolio,
+    compiled_plans: list[CompiledPlan],
+    scenarios: list[PlanScenario],
+) -> dict:
+    """The catalog's plan choices and revenue across the portfolio, then each
+    scenario's, with how many customers would switch plans and the change in
+    revenue. Plans a scenario leaves unchanged aren't priced again.
+
+    Raises:
+        ValueError: a scenario is invalid, or a plan can't be priced across a
+            portfolio (see price_portfolio)
+    """
+    plan_configs = [compiled_plan.plan_config for compiled_plan in compiled_plans]
+    scenario_plans = [scenario.apply(plan_configs) for scenario in scenarios]
+    base_costs = price_portfolio(portfolio, compiled_plans)
+    baseline, base_choices = summarize_choices(portfolio, plan_configs, base_costs)
+    base_chosen = np.array([plan_config.name for plan_config in plan_configs])[
+        base_choices
+    ]
+    base_revenue = float(base_costs[np.arange(len(base_choices)), base_choices].sum())
+
+    scenario_results = []
+    for scenario, changed_plans in zip(scenarios, scenario_plans):
+        columns = []
+        to_price = []
+        for plan_config in changed_plans:
+            if plan_config in plan_configs:
+                columns.append(base_costs[:, plan_configs.index(plan_config)])
+            else:
+                to_price.append(len(columns))
+                columns.append(None)
+        priced = price_portfolio(
+            portfolio,
+            [compile_plan_config(changed_plans[i]) for i in to_price],
+        )
+        for j, i in enumerate(to_price):
+            columns[i] = priced[:, j]
+        costs = np.column_stack(columns).reshape(len(portfolio.customers), -1)
+        summary, choices = summarize_choices(portfolio, changed_plans, costs)
+        chosen = np.array([plan_config.name for plan_config in changed_plans])[choices]
+        revenue = float(costs[np.arange(len(choices)), choices].sum())
+        scenario_results.append(
+            {
+                "name": scenario.name,
+                **summary,
+                "revenue_change": format_currency(Cents(revenue - base_revenue)),
+                "customers_switching": int((chosen != base_chosen).sum()),
+            }
+        )
+
+    return {
+        "customers": len(portfolio.customers),
+        "errors": portfolio.errors,
+        "baseline": baseline,
+        "scenarios": scenario_results,
+    }
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("directory", type=Path, help="directory of usage data CSVs")
+    parser.add_argument(
+        "--plans",
+        type=Path,
+        default=DEFAULT_PLAN_CONFIGS_PATH,
+        help="plan configs file (default plan_configs.json)",
+    )
+    parser.add_argument(
+        "--scenarios", type=Path, help="JSON list of what-if scenarios to compare"
+    )
+    parser.add_argument(
+        "--cache",
+        type=Path,
+        default=Path("portfolio_cache.sqlite"),
+        help="SQLite file customer summaries are cached in "
+        "(default portfolio_cache.sqlite)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="worker processes parsing new or changed CSVs "
+        "(default the number of CPUs)",
+    )
+    args = parser.parse_args(argv)
+
+    compiled_plans = list(load_plan_catalog(args.plans).compiled_plans)
+    scenarios = []
+    if args.scenarios is not None:
+        scenarios = [
+            PlanScenario.from_json(scenario)
+            for scenario in json.loads(args.scenarios.read_text())
+        ]
+    cache = SummaryCache(args.cache)
+    try:
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            portfolio = scan_portfolio(args.directory, cache, executor)
+    finally:
+        cache.close()
+    print(json.dumps(analyze_portfolio(portfolio, compiled_plans, scenarios), indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
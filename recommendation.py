@@ -0,0 +1,94 @@
+import io
+from typing import (
+    Any,
+    AsyncIterable,
+    AsyncIterator,
+    BinaryIO,
+    Callable,
+    Iterable,
+    Iterator,
+)
+
+import orjson
+
+from calc_plan_cost import calc_plan_costs
+from custom_types import CompiledPlan, CostData
+from parse_usage_data import iter_usage_data_csv
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+
+def encode_json(value: Any) -> bytes:
+    """Compact JSON, with orjson (several times faster than json on large
+    responses)"""
+    return orjson.dumps(value)
+
+
+def encode_ndjson_line(value: Any) -> bytes:
+    return encode_json(value) + b"\n"
+
+
+def build_recommendation(file_name: str | None, plan_costs: list[CostData]) -> dict:
+    """The /recommend response: the cheapest plan and every plan for comparison"""
+    plan_costs = sorted(plan_costs, key=lambda cost_data: cost_data.total_cost)
+    return {
+        "file_name": file_name,
+        "winner": plan_costs[0].to_api_json(),
+        "all_plan_costs": [cost_data.to_api_json() for cost_data in plan_costs],
+    }
+
+
+async def iter_recommendation_ndjson(
+    file_name: str | None,
+    plan_costs: AsyncIterable[CostData],
+    extra_fields: dict | None = None,
+    on_result: Callable[[dict], None] | None = None,
+) -> AsyncIterator[bytes]:
+    """The /recommend response as NDJSON: a line with each plan's cost as
+    soon as it's priced (plan_costs is typically priced on the pricing pool
+    while earlier lines are sent), then a final line with the winner,
+    file_name and extra_fields. on_result is called with the equivalent JSON
+    response once every plan is priced.
+    """
+    priced = []
+    async for cost_data in plan_costs:
+        priced.append(cost_data)
+        yield encode_ndjson_line(cost_data.to_api_json())
+    result = {**build_recommendation(file_name, priced), **(extra_fields or {})}
+    if on_result is not None:
+        on_result(result)
+    yield encode_ndjson_line(
+        {key: value for key, value in result.items() if key != "all_plan_costs"}
+    )
+
+
+def iter_recommendation_ndjson_from_result(result: dict) -> Iterator[bytes]:
+    """iter_recommendation_ndjson for an already built JSON response, e.g. a
+    cached one"""
+    for plan_cost in result["all_plan_costs"]:
+        yield encode_ndjson_line(plan_cost)
+    yield encode_ndjson_line(
+        {key: value for key, value in result.items() if key != "all_plan_costs"}
+    )
+
+
+def recommend_usage_csv(
+    file_name: str | None,
+    csv_file: BinaryIO,
+    compiled_plans: Iterable[CompiledPlan],
+) -> dict:
+    """Streams a usage data CSV and prices every plan in a single read of it"""
+    plan_costs = calc_plan_costs(
+        plan_configs=compiled_plans, usage_rows=iter_usage_data_csv(csv_file)
+    )
+    return build_recommendation(file_name, plan_costs)
+
+
+def recommend_usage_csv_bytes(
+    file_name: str | None,
+    csv_bytes: bytes,
+    compiled_plans: Iterable[CompiledPlan],
+) -> dict:
+    """recommend_usage_csv for an upload read into memory, so it can be sent to
+    a worker process"""
+    return recommend_usage_csv(file_name, io.BytesIO(csv_bytes), compiled_plans)
@@ -0,0 +1,144 @@
+import json
+import logging
+import queue
+import sqlite3
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+
+class ResultCache:
+    """Size-bounded LRU cache of /recommend/ responses, keyed by a hash of
+    the uploaded usage data CSV and the plan catalog version they were priced against.
+
+    Responses are stored as JSON so their size can be bounded in bytes. With a
+    sqlite_path the cache is written through to SQLite and reloaded from it on
+    startup, least recently used first, so it survives restarts; evicted
+    entries are removed from both. SQLite is written by a background thread,
+    so get and put never wait on the disk.
+    """
+
+    def __init__(self, max_bytes: int, sqlite_path: Path | None = None) -> None:
+        self.max_bytes = max_bytes
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, str] = OrderedDict()
+        self._lock = threading.Lock()
+        # Incremented on every get hit and put, and persisted with the entry,
+        # so recency survives restarts
+        self._last_used = 0
+        self._db: sqlite3.Connection | None = None
+        # (sql, parameters) for the writer thread, or None to stop it
+        self._writes: queue.SimpleQueue[tuple[str, tuple] | None] = queue.SimpleQueue()
+        self._writer: threading.Thread | None = None
+        if sqlite_path is not None:
+            self._db = sqlite3.connect(sqlite_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, "
+                "value TEXT NOT NULL, last_used INTEGER NOT NULL)"
+            )
+            # Least recently used first, so the most recently used entries
+            # survive eviction
+            for key, value, last_used in self._db.execute(
+                "SELECT key, value, last_used FROM results ORDER BY last_used, rowid"
+            ).fetchall():
+                self._insert(key, value)
+                self._last_used = max(self._last_used, last_used)
+            self._db.commit()
+            self._writer = threading.Thread(
+                target=self._write_loop, name="result-cache-writer", daemon=True
+            )
+            self._writer.start()
+
+    @staticmethod
+    def key(csv_sha256: str, catalog_version: str) -> str:
+        """csv_sha256 is the hex SHA-256 of the usage data CSV, which uploads
+        compute as they stream in"""
+        return f"{csv_sha256}:{catalog_version}"
+
+    def get(self, key: str) -> dict | None:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            self._last_used += 1
+            self._write(
+                "UPDATE results SET last_used = ? WHERE key = ?",
+                (self._last_used, key),
+            )
+        return json.loads(value)
+
+    def put(self, key: str, result: dict) -> None:
+        # json.dumps escapes non-ASCII, so len(value) is the size in bytes
+        value = json.dumps(result)
+        with self._lock:
+            self._insert(key, value)
+            if key in self._entries:
+                self._last_used += 1
+                self._write(
+                    "INSERT OR REPLACE INTO results (key, value, last_used) "
+                    "VALUES (?, ?, ?)",
+                    (key, value, self._last_used),
+                )
+
+    def _insert(self, key: str, value: str) -> None:
+        if len(value) > self.max_bytes:
+            return
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self.size_bytes -= len(previous)
+        self._entries[key] = value
+        self.size_bytes += len(value)
+        while self.size_bytes > self.max_bytes:
+            evicted_key, evicted_value = self._entries.popitem(last=False)
+            self.size_bytes -= len(evicted_value)
+            self._write("DELETE FROM results WHERE key = ?", (evicted_key,))
+
+    def _write(self, sql: str, parameters: tuple) -> None:
+        # Queued in the order the entries changed, under self._lock
+        if self._db is not None:
+            self._writes.put((sql, parameters))
+
+    def _write_loop(self) -> None:
+        # Commits whatever has queued up since the last commit in one go
+        assert self._db is not None
+        while True:
+            writes = [self._writes.get()]
+            while not self._writes.empty():
+                writes.append(self._writes.get())
+            try:
+                with self._db:
+                    for write in writes:
+                        if write is None:
+                            return
+                        self._db.execute(*write)
+            except sqlite3.Error:
+                # The in-memory cache is still right, only the copy on disk
+                # is behind
+                logger.exception("Writing the result cache to SQLite failed")
+                if None in writes:
+                    return
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self._entries),
+            "size_bytes": self.size_bytes,
+            "max_bytes": self.max_bytes,
+        }
+
+    def close(self) -> None:
+        """Waits for queued writes to be committed, then closes SQLite"""
+        if self._db is not None:
+            assert self._writer is not None
+            self._writes.put(None)
+            self._writer.join()
+            self._db.close()
+            self._db = None
@@ -0,0 +1,79 @@
+import os
+from pathlib import Path
+from typing import Any, Mapping, NamedTuple
+
+ENV_PREFIX = "PLAN_OPTIMIZER_"
+
+
+def _parse_setting(value: str, setting_type: Any) -> Any:
+    if setting_type in (int, int | None):
+        return int(value)
+    if setting_type in (float, float | None):
+        return float(value)
+    if setting_type is bool:
+        return value.strip().lower() in ("1", "true", "yes", "on")
+    if setting_type in (Path, Path | None):
+        return Path(value)
+    return value
+
+
+class Settings(NamedTuple):
+    """Service settings, read from PLAN_OPTIMIZER_* environment variables,
+    e.g. PLAN_OPTIMIZER_PRICING_WORKERS=4"""
+
+    # Worker processes used to price /recommend/ uploads, defaults to the CPU count
+    pricing_workers: int | None = None
+    # Uploads allowed to wait for a free worker before we respond with a 429
+    pricing_queue_depth: int = 32
+    # Seconds clients are told to wait in the Retry-After header of a 429
+    retry_after_seconds: int = 1
+    # Worker processes used to scan /portfolio directories, defaults to the CPU
+    # count
+    batch_workers: int | None = None
+    # Batch manifest CSVs larger than this are parsed in parallel byte ranges
+    parse_chunk_bytes: int = 16 * 1024 * 1024
+    # Local paths in batch NDJSON manifests must be inside this directory
+    batch_manifest_root: Path = Path(".")
+    # Memory for cached /recommend/ responses to repeated uploads
+    result_cache_max_bytes: int = 64 * 1024 * 1024
+    # Optional SQLite file that keeps the result cache across restarts
+    result_cache_path: Path | None = None
+    # SQLite file customer cost ledgers are kept in, in memory when not set
+    ledger_path: Path | None = None
+    # SQLite file /portfolio caches customer usage summaries in, in memory when
+    # not set
+    portfolio_cache_path: Path | None = None
+    # Largest /recommend/ (after decompression) or /optimize upload accepted,
+    # before a 413
+    max_upload_bytes: int = 256 * 1024 * 1024
+    # Most usage data rows accepted in one /recommend/ upload before a 413
+    max_upload_rows: int = 10_000_000
+    # Uploads are parsed in blocks of about this many bytes
+    upload_block_bytes: int = 1024 * 1024
+    # SQLite file /jobs are kept in, in memory when not set
+    job_store_path: Path | None = None
+    # Seconds finished /jobs are kept after they were last updated
+    job_ttl_seconds: int = 3600
+    # /jobs parsed and priced at once, the rest wait their turn queued
+    max_running_jobs: int = 4
+    # /jobs waiting for one of the max_running_jobs slots, beyond which new
+    # jobs are rejected with a 429
+    max_queued_jobs: int = 16
+    # Most candidate plans one /optimize request may price
+    max_optimize_candidates: int = 100_000
+    # Adds a Server-Timing header with per-stage durations to every response
+    server_timing: bool = False
+    # Requests with an X-Profile header are profiled with cProfile into this
+    # directory, profiling is off when it isn't set
+    profile_dir: Path | None = None
+    # Fraction of requests with an X-Profile header that are actually profiled
+    profile_sample_rate: float = 1.0
+
+    @classmethod
+    def from_env(cls, environ: Mapping[str, str] = os.environ) -> "Settings":
+        settings: dict[str, Any] = {}
+        for name, setting_type in cls.__annotations__.items():
+            value = environ.get(ENV_PREFIX + name.upper())
+            if value:
+                settings[name] = _parse_setting(value, setting_type)
+        return cls(**settings)
@@ -0,0 +1,109 @@
+import asyncio
+import io
+import json
+import tarfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from batch import BatchItem, iter_batch_items, run_batch
+from plan_catalog import load_plan_catalog
+from recommendation import recommend_usage_csv
+from usage_binary import convert_usage_csv_to_binary
+from worker_pool import WorkerPool
+
+DATA_DIR = Path(__file__).parent / "data"
+TEST_DATA_CSV = (DATA_DIR / "test_data.csv").read_bytes()
+COMPILED_PLANS = load_plan_catalog(
+    Path(__file__).parent / "plan_configs.json"
+).compiled_plans
+
+
+def collect_batch(items, max_workers, **kwargs):
+    async def collect():
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pricing_pool = WorkerPool(executor, max_workers, max_queue_depth=0)
+            return [
+                result
+                async for result in run_batch(
+                    items, COMPILED_PLANS, pricing_pool, **kwargs
+                )
+            ]
+
+    return asyncio.run(collect())
+
+
+def test_iter_batch_items_zip():
+    batch_file = io.BytesIO()
+    with zipfile.ZipFile(batch_file, "w") as archive:
+        archive.writestr("customers/a.csv", TEST_DATA_CSV)
+        archive.writestr("customers/README.txt", "not usage data")
+    batch_file.seek(0)
+
+    assert list(iter_batch_items(batch_file, DATA_DIR)) == [
+        BatchItem("customers/a.csv", csv_bytes=TEST_DATA_CSV)
+    ]
+
+
+def test_iter_batch_items_tar():
+    batch_file = io.BytesIO()
+    with tarfile.open(fileobj=batch_file, mode="w:gz") as archive:
+        member = tarfile.TarInfo("b.csv")
+        member.size = len(TEST_DATA_CSV)
+        archive.addfile(member, io.BytesIO(TEST_DATA_CSV))
+    batch_file.seek(0)
+
+    assert list(iter_batch_items(batch_file, DATA_DIR)) == [
+        BatchItem("b.csv", csv_bytes=TEST_DATA_CSV)
+    ]
+
+
+def test_iter_batch_items_manifest():
+    batch_file = io.BytesIO(
+        b'{"path": "test_data.csv"}\n'
+        b"\n"
+        b'{"path": "../plan_configs.json"}\n'
+        b'"test_data.csv"\n'
+    )
+
+    assert list(iter_batch_items(batch_file, DATA_DIR)) == [
+        BatchItem("test_data.csv", path=DATA_DIR.resolve() / "test_data.csv"),
+        BatchItem(
+            "../plan_configs.json",
+            error=f"Path is outside of the manifest root {DATA_DIR.resolve()}.",
+        ),
+        BatchItem("line 4", error='Manifest lines must be JSON objects with a "path".'),
+    ]
+
+
+def test_run_batch(tmp_path):
+    convert_usage_csv_to_binary(DATA_DIR / "test_data.csv", tmp_path / "e.usage")
+    items = [
+        BatchItem("a.csv", csv_bytes=TEST_DATA_CSV),
+        BatchItem("b.csv", path=DATA_DIR / "test_data.csv"),
+        BatchItem("c.csv", csv_bytes=b"datetime,duration\nnot a date,900\n"),
+        BatchItem("line 4", error="Bad manifest line"),
+        BatchItem("e.usage", path=tmp_path / "e.usage"),
+    ]
+    results = collect_batch(items, max_workers=2, max_in_flight=1)
+
+    results.sort(key=lambda result: result["file_name"])
+    with open(DATA_DIR / "test_data.csv", "rb") as csv_file:
+        expected = recommend_usage_csv("a.csv", csv_file, COMPILED_PLANS)
+    assert results[0] == expected
+    assert results[1] == {**expected, "file_name": "b.csv"}
+    assert results[2]["file_name"] == "c.csv" and "error" in results[2]
+    assert results[3] == {**expected, "file_name": "e.usage"}
+    assert results[4] == {"file_name": "line 4", "error": "Bad manifest line"}
+    # Results are JSON serializable as NDJSON lines
+    assert all("\n" not in json.dumps(result) for result in results)
+
+
+def test_run_batch_splits_large_manifest_files():
+    items = [BatchItem("solar.csv", path=DATA_DIR / "solar-interval-data.csv")]
+    with open(DATA_DIR / "solar-interval-data.csv", "rb") as csv_file:
+        expected = recommend_usage_csv("solar.csv", csv_file, COMPILED_PLANS)
+
+    results = collect_batch(items, max_workers=4, max_in_flight=4, chunk_bytes=100_000)
+
+    assert results == [expected]
@@ -0,0 +1,57 @@
+from benchmark import (
+    DATA_DIR,
+    find_regressions,
+    run_benchmarks,
+    write_synthetic_usage_csv,
+)
+from parse_usage_data import parse_usage_data_csv
+
+
+def test_synthetic_usage_csv_is_reproducible(tmp_path):
+    rows = write_synthetic_usage_csv(tmp_path / "a.csv", days=2, interval_seconds=60)
+    write_synthetic_usage_csv(tmp_path / "b.csv", days=2, interval_seconds=60)
+
+    assert rows == 2 * 24 * 60
+    assert (tmp_path / "a.csv").read_bytes() == (tmp_path / "b.csv").read_bytes()
+    with open(tmp_path / "a.csv", "rb") as csv_file:
+        usage_data = parse_usage_data_csv(csv_file)
+    assert len(usage_data) == rows
+    assert (usage_data[1].datetime - usage_data[0].datetime).total_seconds() == 60
+
+    write_synthetic_usage_csv(
+        tmp_path / "c.csv", days=2, interval_seconds=60, solar=False
+    )
+    with open(tmp_path / "c.csv", "rb") as csv_file:
+        no_solar = parse_usage_data_csv(csv_file)
+    assert any(row.generation for row in usage_data)
+    assert not any(row.generation for row in no_solar)
+    assert [row.consumption for row in no_solar] == [
+        row.consumption for row in usage_data
+    ]
+
+
+def test_run_benchmarks():
+    results = run_benchmarks(
+        {"test_data": DATA_DIR / "test_data.csv"}, repeat=2, include_endpoint=False
+    )
+
+    assert [result.name for result in results] == [
+        "parse_usage_data_csv",
+        "load_usage_data_binary",
+        "calc_plan_cost[Flat]",
+        "calc_plan_cost[Tiered]",
+        "calc_plan_cost[Free Nights]",
+        "calc_plan_cost[Free Nights, Net Metered]",
+    ]
+    assert all(result.repeat == 2 and result.rows == 3 for result in results)
+
+
+def test_find_regressions():
+    baseline = {"results": [{"name": "parse", "dataset": "a", "median_seconds": 1.0}]}
+    slower = {"results": [{"name": "parse", "dataset": "a", "median_seconds": 1.5}]}
+    noisy = {"results": [{"name": "parse", "dataset": "a", "median_seconds": 1.1}]}
+
+    assert find_regressions(baseline, slower, threshold=1.2) == [
+        "parse on a: 1000.0 ms -> 1500.0 ms"
+    ]
+    assert find_regressions(baseline, noisy, threshold=1.2) == []
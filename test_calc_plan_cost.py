@@ -1,11 +1,14 @@
 from datetime import time
 from dateutil.parser import parse as parse_date
 import pytest
-from calc_plan_cost import calc_plan_cost
+from calc_plan_cost import calc_plan_cost, calc_plan_costs, calc_plan_costs_by_row
 from custom_types import (
+    BandCost,
+    BuybackConfig,
     Cents,
     CentsPerKWh,
     CostData,
+    DailyCost,
     PlanConfig,
     Seconds,
     TieredRate,
@@ -299,3 +302,402 @@ def test_invalid_plan_config():
         match="Cannot mix tiered rates with time of day prices in the same plan.",
     ):
         calc_plan_cost(plan_config, UsageData([]))
+
+
+def test_calc_plan_costs_single_pass():
+    plan_configs = [
+        PlanConfig(name="Flat", base_rate_per_kwh=CentsPerKWh(15)),
+        PlanConfig(
+            name="Tiered",
+            base_rate_per_kwh=CentsPerKWh(20),
+            base_monthly_fee=Cents(500),
+            tiered_rates=[TieredRate(usage_kwh=1, rate_cents_per_kwh=CentsPerKWh(10))],
+        ),
+        PlanConfig(
+            name="Free Nights",
+            base_rate_per_kwh=CentsPerKWh(25),
+            time_of_day_prices=[
+                TimeOfDayPrice(
+                    start_time=time(22, 0),
+                    end_time=time(6, 0),
+                    rate_cents_per_kwh=CentsPerKWh(0),
+                )
+            ],
+        ),
+    ]
+    usage_data = UsageData(
+        [
+            UsageDataRow(
+                datetime=parse_date("2023-05-01T00:00:00-05:00"),
+                duration=Seconds(900),
+                unit="Wh",
+                consumption=1000,
+            ),
+            UsageDataRow(
+                datetime=parse_date("2023-05-01T12:00:00-05:00"),
+                duration=Seconds(900),
+                unit="Wh",
+                consumption=2000,
+                generation=500,
+            ),
+            UsageDataRow(
+                datetime=parse_date("2023-06-01T12:00:00-05:00"),
+                duration=Seconds(900),
+                unit="Wh",
+                consumption=1000,
+            ),
+        ]
+    )
+    # A generator can only be read once, so every plan must be priced in one pass
+    plan_costs = calc_plan_costs(plan_configs, (row for row in usage_data))
+    assert plan_costs == [
+        calc_plan_cost(plan_config, usage_data) for plan_config in plan_configs
+    ]
+
+
+def test_tiers_reset_by_calendar_month_on_unsorted_multi_year_data():
+    plan_config = PlanConfig(
+        name="Tiered",
+        base_rate_per_kwh=CentsPerKWh(20),
+        tiered_rates=[TieredRate(usage_kwh=500, rate_cents_per_kwh=CentsPerKWh(10))],
+    )
+    usage_data = UsageData(
+        UsageDataRow(
+            datetime=parse_date(timestamp),
+            duration=Seconds(900),
+            unit="kWh",
+            consumption=400,
+        )
+        for timestamp in [
+            "2023-05-01T00:00:00-05:00",
+            "2024-05-01T00:00:00-05:00",
+            "2023-05-02T00:00:00-05:00",
+        ]
+    )
+    # May 2023: 500 kWh at 10 cents/kWh and 300 kWh at 20 cents/kWh
+    # May 2024: 400 kWh at 10 cents/kWh
+    expected = CostData(
+        plan_config=plan_config,
+        total_cost=Cents(15_000),
+        monthly_average_cost=Cents(7_500),
+    )
+
+    assert calc_plan_cost(plan_config, usage_data) == expected
+    assert calc_plan_costs_by_row([plan_config], usage_data) == [expected]
+
+
+def test_time_of_day_windows():
+    plan_config = PlanConfig(
+        name="Multi-Band Plan",
+        base_rate_per_kwh=CentsPerKWh(20),
+        time_of_day_prices=[
+            # Non-wrapping peak window
+            TimeOfDayPrice(
+                start_time=time(16, 0),
+                end_time=time(21, 0),
+                rate_cents_per_kwh=CentsPerKWh(40),
+            ),
+            # Overlaps the peak window, which is listed first and so wins
+            TimeOfDayPrice(
+                start_time=time(20, 0),
+                end_time=time(6, 0),
+                rate_cents_per_kwh=CentsPerKWh(10),
+            ),
+        ],
+    )
+    usage_data = UsageData(
+        [
+            # Morning, outside both windows
+            UsageDataRow(
+                datetime=parse_date("2023-05-01T09:00:00-05:00"),
+                duration=Seconds(900),
+                unit="kWh",
+                consumption=1,
+            ),
+            # Peak, overlapped by the night window
+            UsageDataRow(
+                datetime=parse_date("2023-05-01T20:30:00-05:00"),
+                duration=Seconds(900),
+                unit="kWh",
+                consumption=1,
+            ),
+            # Night
+            UsageDataRow(
+                datetime=parse_date("2023-05-01T23:00:00-05:00"),
+                duration=Seconds(900),
+                unit="kWh",
+                consumption=1,
+            ),
+            # 30 minutes straddling 06:00, half at night and half at the base rate
+            UsageDataRow(
+                datetime=parse_date("2023-05-02T05:45:00-05:00"),
+                duration=Seconds(1800),
+                unit="kWh",
+                consumption=2,
+            ),
+        ]
+    )
+    # 1 kWh * 20 + 1 kWh * 40 + 1 kWh * 10 + (1 kWh * 10 + 1 kWh * 20) = 100 cents
+    assert calc_plan_cost(plan_config, usage_data) == CostData(
+        plan_config=plan_config,
+        total_cost=Cents(100),
+        monthly_average_cost=Cents(100),
+    )
+
+    cost_data = calc_plan_cost(plan_config, usage_data, breakdown="daily")
+    (monthly_cost,) = cost_data.monthly_costs
+    assert cost_data.total_cost == Cents(100)
+    assert monthly_cost.month == "2023-05"
+    assert monthly_cost.energy_cost == Cents(100)
+    assert monthly_cost.bands == (
+        BandCost(band="16:00-21:00", consumption_kwh=1, cost=Cents(40)),
+        # Half of the straddling interval falls at night
+        BandCost(band="20:00-06:00", consumption_kwh=2, cost=Cents(20)),
+        BandCost(band="Base rate", consumption_kwh=2, cost=Cents(40)),
+    )
+    # The month's energy cost is shared between days by consumption
+    assert cost_data.daily_costs == (
+        DailyCost(
+            date="2023-05-01",
+            consumption_kwh=3,
+            generation_kwh=0,
+            total_cost=Cents(60),
+        ),
+        DailyCost(
+            date="2023-05-02",
+            consumption_kwh=2,
+            generation_kwh=0,
+            total_cost=Cents(40),
+        ),
+    )
+
+
+def test_fractional_cent_rates():
+    plan_config = PlanConfig(
+        name="Tiered",
+        base_rate_per_kwh=CentsPerKWh(12.5),
+        tiered_rates=[TieredRate(usage_kwh=0.5, rate_cents_per_kwh=CentsPerKWh(9.999))],
+    )
+    usage_data = UsageData(
+        [
+            UsageDataRow(
+                datetime=parse_date("2023-05-01T00:00:00-05:00"),
+                duration=Seconds(900),
+                unit="Wh",
+                consumption=1000,
+            )
+        ]
+    )
+    # 500 Wh at 9.999 cents/kWh + 500 Wh at 12.5 cents/kWh = 11.2495 cents
+    assert calc_plan_cost(plan_config, usage_data) == CostData(
+        plan_config=plan_config,
+        total_cost=Cents(11.2495),
+        monthly_average_cost=Cents(11.2495),
+    )
+
+    # Rates are priced in whole milli-cents per kWh, and tiers in whole Wh
+    with pytest.raises(ValueError, match="whole number of milli-cents per kWh"):
+        calc_plan_cost(
+            plan_config._replace(base_rate_per_kwh=CentsPerKWh(12.3456)), usage_data
+        )
+    with pytest.raises(ValueError, match="whole number of Wh"):
+        calc_plan_cost(
+            plan_config._replace(
+                tiered_rates=[
+                    TieredRate(usage_kwh=0.0005, rate_cents_per_kwh=CentsPerKWh(10))
+                ]
+            ),
+            usage_data,
+        )
+
+
+def test_monthly_breakdown_adds_up_to_the_total():
+    plan_config = PlanConfig(
+        name="Tiered",
+        base_rate_per_kwh=CentsPerKWh(20),
+        base_monthly_fee=Cents(500),
+        tiered_rates=[TieredRate(usage_kwh=1, rate_cents_per_kwh=CentsPerKWh(10))],
+    )
+    usage_data = UsageData(
+        [
+            UsageDataRow(
+                datetime=parse_date("2023-05-31T23:45:00-05:00"),
+                duration=Seconds(900),
+                unit="Wh",
+                consumption=2500,
+                generation=1000,
+            ),
+            UsageDataRow(
+                datetime=parse_date("2023-06-01T00:00:00-05:00"),
+                duration=Seconds(900),
+                unit="Wh",
+                consumption=500,
+            ),
+            UsageDataRow(
+                datetime=parse_date("2023-06-02T00:00:00-05:00"),
+                duration=Seconds(900),
+                unit="Wh",
+                consumption=0,
+            ),
+        ]
+    )
+
+    cost_data = calc_plan_cost(plan_config, usage_data, breakdown="monthly")
+
+    assert cost_data._replace(monthly_costs=None) == calc_plan_cost(
+        plan_config, usage_data
+    )
+    may, june = cost_data.monthly_costs
+    # 1 kWh * 10 + 1.5 kWh * 20 + 500 fee - 1 kWh * 20 buyback
+    assert [band.cost for band in may.bands] == [10, 30]
+    assert (may.energy_cost, may.fees, may.buyback, may.total_cost) == (
+        40,
+        500,
+        20,
+        520,
+    )
+    assert [band.consumption_kwh for band in june.bands] == [0.5, 0]
+    assert june.total_cost == 505
+    assert cost_data.total_cost == may.total_cost + june.total_cost
+    assert cost_data.daily_costs is None
+    # June's fee is shared between the days with data, even without usage
+    daily_costs = calc_plan_cost(plan_config, usage_data, breakdown="daily").daily_costs
+    assert [daily_cost.total_cost for daily_cost in daily_costs] == [520, 255, 250]
+
+
+def test_buyback_rates_by_time_of_day():
+    plan_config = PlanConfig(
+        name="Solar",
+        base_rate_per_kwh=CentsPerKWh(20),
+        buyback=BuybackConfig(
+            rate_cents_per_kwh=CentsPerKWh(5),
+            time_of_day_rates=[
+                TimeOfDayPrice(
+                    start_time=time(16, 0),
+                    end_time=time(21, 0),
+                    rate_cents_per_kwh=CentsPerKWh(10),
+                )
+            ],
+        ),
+    )
+    usage_data = UsageData(
+        [
+            UsageDataRow(
+                datetime=parse_date("2023-05-01T12:00:00-05:00"),
+                duration=Seconds(900),
+                unit="kWh",
+                consumption=10,
+                generation=1,
+            ),
+            UsageDataRow(
+                datetime=parse_date("2023-05-01T16:45:00-05:00"),
+                duration=Seconds(900),
+                unit="kWh",
+                consumption=0,
+                generation=1,
+            ),
+            # 30 minutes straddling 21:00, half at each buyback rate
+            UsageDataRow(
+                datetime=parse_date("2023-05-01T20:45:00-05:00"),
+                duration=Seconds(1800),
+                unit="kWh",
+                consumption=0,
+                generation=2,
+            ),
+        ]
+    )
+    # 10 kWh * 20 - (1 kWh * 5 + 1 kWh * 10 + (1 kWh * 10 + 1 kWh * 5))
+    expected = CostData(
+        plan_config=plan_config,
+        total_cost=Cents(170),
+        monthly_average_cost=Cents(170),
+    )
+
+    assert calc_plan_cost(plan_config, usage_data) == expected
+    assert calc_plan_costs_by_row([plan_config], usage_data) == [expected]
+
+
+@pytest.mark.parametrize(
+    "monthly_netting, max_monthly_credit, total_cost",
+    [
+        # May: 20 energy - 50 credit, June: 50 energy - 10 credit
+        (False, None, 10),
+        # Netting alone changes nothing, only what a cap applies to
+        (True, None, 10),
+        (False, Cents(25), 35),
+        # Credit beyond May's energy cost is forfeited
+        (True, Cents(0), 40),
+        (True, Cents(5), 35),
+    ],
+)
+def test_monthly_netting_and_credit_caps(
+    monthly_netting, max_monthly_credit, total_cost
+):
+    plan_config = PlanConfig(
+        name="Net Metering",
+        base_rate_per_kwh=CentsPerKWh(10),
+        buyback=BuybackConfig(
+            monthly_netting=monthly_netting, max_monthly_credit=max_monthly_credit
+        ),
+    )
+    usage_data = UsageData(
+        [
+            UsageDataRow(
+                datetime=parse_date("2023-05-01T12:00:00-05:00"),
+                duration=Seconds(900),
+                unit="kWh",
+                consumption=2,
+                generation=5,
+            ),
+            UsageDataRow(
+                datetime=parse_date("2023-06-01T12:00:00-05:00"),
+                duration=Seconds(900),
+                unit="kWh",
+                consumption=5,
+                generation=1,
+            ),
+        ]
+    )
+
+    cost_data = calc_plan_cost(plan_config, usage_data, breakdown="monthly")
+
+    assert cost_data.total_cost == total_cost
+    assert calc_plan_costs_by_row([plan_config], usage_data)[0].total_cost == (
+        total_cost
+    )
+    assert sum(monthly_cost.total_cost for monthly_cost in cost_data.monthly_costs) == (
+        total_cost
+    )
+
+
+def test_buyback_config_json_round_trip():
+    plan_json = {
+        "name": "Solar",
+        "base_rate_per_kwh": 15,
+        "buyback": {
+            "time_of_day_rates": [
+                {"start_time": "16:00", "end_time": "21:00", "rate_cents_per_kwh": 8}
+            ],
+            "max_monthly_credit": 1000,
+        },
+    }
+
+    plan_config = PlanConfig.from_json(plan_json)
+
+    assert plan_config.buyback_rate_per_kwh == 15
+    assert PlanConfig.from_json(plan_config.to_json()) == plan_config
+    assert plan_config.to_api_json()["plan_buyback"]["max_monthly_credit"] == "$10.00"
+    assert (
+        "plan_buyback"
+        not in PlanConfig(name="Flat", base_rate_per_kwh=CentsPerKWh(15)).to_api_json()
+    )
+    with pytest.raises(ValueError, match="whole number of milli-cents per kWh"):
+        calc_plan_cost(
+            plan_config._replace(buyback=BuybackConfig(rate_cents_per_kwh=2.5005)),
+            UsageData(),
+        )
+    with pytest.raises(ValueError, match="can't be negative"):
+        calc_plan_cost(
+            plan_config._replace(buyback=BuybackConfig(max_monthly_credit=-1)),
+            UsageData(),
+        )
@@ -0,0 +1,148 @@
+import json
+from datetime import time
+from pathlib import Path
+
+import pytest
+
+from calc_plan_cost import (
+    calc_aggregate_plan_cost,
+    calc_plan_cost,
+    calc_plan_costs_by_row,
+)
+from calc_plan_cost_vectorized import calc_plan_cost_vectorized, parse_usage_columns_csv
+from custom_types import (
+    BuybackConfig,
+    Cents,
+    CentsPerKWh,
+    PlanConfig,
+    TieredRate,
+    TimeOfDayPrice,
+)
+from parse_usage_data import parse_usage_data_csv
+from usage_aggregate import UsageAggregate, UsageColumns
+
+DATA_DIR = Path(__file__).parent / "data"
+
+with open(Path(__file__).parent / "plan_configs.json", "r") as f:
+    PLAN_CONFIGS = [PlanConfig.from_json(plan_config) for plan_config in json.load(f)]
+PLAN_CONFIGS += [
+    PlanConfig(
+        name="Multi-Tiered Plan",
+        base_rate_per_kwh=CentsPerKWh(25),
+        base_monthly_fee=Cents(100),
+        tiered_rates=[
+            TieredRate(usage_kwh=500, rate_cents_per_kwh=CentsPerKWh(10)),
+            TieredRate(usage_kwh=500, rate_cents_per_kwh=CentsPerKWh(20)),
+        ],
+    ),
+    PlanConfig(
+        name="Overlapping Time of Day Plan",
+        base_rate_per_kwh=CentsPerKWh(20),
+        time_of_day_prices=[
+            TimeOfDayPrice(
+                start_time=time(23, 0),
+                end_time=time(5, 0),
+                rate_cents_per_kwh=CentsPerKWh(5),
+            ),
+            TimeOfDayPrice(
+                start_time=time(21, 0),
+                end_time=time(7, 0),
+                rate_cents_per_kwh=CentsPerKWh(10),
+            ),
+        ],
+    ),
+    PlanConfig(
+        name="Peak Plan",
+        base_rate_per_kwh=CentsPerKWh(12),
+        time_of_day_prices=[
+            # Starts part way through the 15 minute intervals, splitting them
+            TimeOfDayPrice(
+                start_time=time(16, 7),
+                end_time=time(20, 52),
+                rate_cents_per_kwh=CentsPerKWh(35),
+            ),
+        ],
+    ),
+    PlanConfig(
+        name="Solar Time of Day Buyback Plan",
+        base_rate_per_kwh=CentsPerKWh(18),
+        base_monthly_fee=Cents(500),
+        time_of_day_prices=[
+            TimeOfDayPrice(
+                start_time=time(16, 0),
+                end_time=time(21, 0),
+                rate_cents_per_kwh=CentsPerKWh(30),
+            ),
+        ],
+        buyback=BuybackConfig(
+            rate_cents_per_kwh=CentsPerKWh(4),
+            time_of_day_rates=[
+                TimeOfDayPrice(
+                    start_time=time(15, 7),
+                    end_time=time(21, 0),
+                    rate_cents_per_kwh=CentsPerKWh(12),
+                ),
+            ],
+            monthly_netting=True,
+            max_monthly_credit=Cents(1000),
+        ),
+    ),
+    PlanConfig(
+        name="Solar Tiered Capped Buyback Plan",
+        base_rate_per_kwh=CentsPerKWh(17),
+        tiered_rates=[TieredRate(usage_kwh=500, rate_cents_per_kwh=CentsPerKWh(11))],
+        buyback=BuybackConfig(
+            rate_cents_per_kwh=CentsPerKWh(8), max_monthly_credit=Cents(2000)
+        ),
+    ),
+]
+
+
+@pytest.fixture(
+    scope="module",
+    params=[
+        "test_data.csv",
+        "high-winter-interval-data.csv",
+        "low-winter-interval-data.csv",
+        "solar-interval-data.csv",
+    ],
+)
+def usage_data(request):
+    with open(DATA_DIR / request.param, "rb") as csv_file:
+        return parse_usage_data_csv(csv_file)
+
+
+@pytest.mark.parametrize(
+    "plan_config", PLAN_CONFIGS, ids=[plan.name for plan in PLAN_CONFIGS]
+)
+def test_backends_match_reference(plan_config, usage_data):
+    expected = calc_plan_costs_by_row([plan_config], usage_data)[0]
+    for actual in (
+        calc_plan_cost(plan_config, usage_data),
+        calc_plan_cost_vectorized(
+            plan_config, UsageColumns.from_usage_data(usage_data)
+        ),
+        calc_plan_cost_vectorized(
+            plan_config, UsageColumns.from_usage_rows(usage_data)
+        ),
+        calc_aggregate_plan_cost(
+            plan_config, UsageAggregate.from_usage_rows(usage_data)
+        ),
+    ):
+        # Pricing is exact until the final conversion to cents
+        assert actual == expected
+
+
+def test_empty_usage_data_is_rejected():
+    with pytest.raises(ValueError, match="Usage data is empty"):
+        calc_plan_cost_vectorized(PLAN_CONFIGS[0], UsageColumns.from_usage_rows([]))
+
+
+def test_parse_usage_columns_csv():
+    with open(DATA_DIR / "test_data.csv", "rb") as csv_file:
+        usage_columns = parse_usage_columns_csv(csv_file)
+
+    assert usage_columns.minute_of_day.tolist() == [0, 15, 30]
+    assert usage_columns.month_index.tolist() == [2023 * 12 + 4] * 3
+    assert usage_columns.consumption_wh.tolist() == [2000, 2, 0]
+    assert usage_columns.generation_wh.tolist() == [0, 500, 1000]
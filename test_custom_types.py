@@ -0,0 +1,95 @@
+from array import array
+
+from dateutil.parser import parse as parse_date
+
+from custom_types import MonthRange, Seconds, UsageData, UsageDataRow
+
+
+def test_usage_data_normalizes_rows_to_watt_hours():
+    usage_data = UsageData(
+        [
+            UsageDataRow(
+                datetime=parse_date("2023-05-01T00:00:00-05:00"),
+                duration=Seconds(900),
+                unit="kWh",
+                consumption=2,
+                generation=1,
+            ),
+            UsageDataRow(
+                datetime=parse_date("2023-05-01T00:15:00"),
+                duration=Seconds(900),
+                unit="Wh",
+                consumption=300,
+            ),
+        ]
+    )
+
+    assert len(usage_data) == 2
+    assert usage_data[0] == UsageDataRow(
+        datetime=parse_date("2023-05-01T00:00:00-05:00"),
+        duration=Seconds(900),
+        unit="Wh",
+        consumption=2000,
+        generation=1000,
+    )
+    assert usage_data[0].datetime.utcoffset().total_seconds() == -5 * 60 * 60
+    # Naive datetimes are stored as UTC
+    assert usage_data[-1].datetime == parse_date("2023-05-01T00:15:00+00:00")
+    assert usage_data[1:] == UsageData([usage_data[1]])
+    assert list(usage_data) == [usage_data[0], usage_data[1]]
+
+
+def test_usage_data_from_columns_wraps_buffers():
+    epoch_seconds = array("q", [1682917200, 1682918100])
+    usage_data = UsageData.from_columns(
+        epoch_seconds=memoryview(epoch_seconds),
+        utc_offset=array("i", [-18000, -18000]),
+        duration=array("i", [900, 900]),
+        consumption=array("q", [1000, 2000]),
+        generation=array("q", [0, 500]),
+    )
+
+    assert usage_data[1].datetime == parse_date("2023-05-01T00:15:00-05:00")
+    assert usage_data[1].generation == 500
+    # No copy is made of the underlying buffers
+    epoch_seconds[0] += 60
+    assert usage_data[0].datetime == parse_date("2023-05-01T00:01:00-05:00")
+
+
+def test_usage_data_month_ranges():
+    usage_data = UsageData(
+        UsageDataRow(datetime=parse_date(timestamp), duration=Seconds(900))
+        for timestamp in [
+            "2023-05-31T23:45:00-05:00",
+            # Still May locally, though June in UTC
+            "2023-05-31T23:59:00-05:00",
+            "2024-05-01T00:00:00-05:00",
+            "2023-05-02T00:00:00-05:00",
+        ]
+    )
+    from_columns = UsageData.from_columns(
+        *(getattr(usage_data, column) for column in UsageData.COLUMNS)
+    )
+
+    assert usage_data.month_ranges == [
+        MonthRange(0, 2, 2023 * 12 + 4),
+        MonthRange(2, 3, 2024 * 12 + 4),
+        MonthRange(3, 4, 2023 * 12 + 4),
+    ]
+    assert (usage_data.month_ranges[1].year, usage_data.month_ranges[1].month) == (
+        2024,
+        5,
+    )
+    assert from_columns.month_ranges == usage_data.month_ranges
+    assert usage_data[1:].month_ranges == [
+        MonthRange(0, 1, 2023 * 12 + 4),
+        MonthRange(1, 2, 2024 * 12 + 4),
+        MonthRange(2, 3, 2023 * 12 + 4),
+    ]
+    assert usage_data.months == {2023 * 12 + 4, 2024 * 12 + 4}
+    assert usage_data.row_month_indexes().tolist() == [
+        2023 * 12 + 4,
+        2023 * 12 + 4,
+        2024 * 12 + 4,
+        2023 * 12 + 4,
+    ]
@@ -0,0 +1,75 @@
+from job_store import JobStore
+
+RESULT = {"file_name": "a.csv", "winner": {"total_cost": "$1.00"}}
+
+
+def test_job_lifecycle():
+    job_store = JobStore()
+    job = job_store.create("a.csv", total_bytes=100)
+
+    assert job_store.get(job.job_id) == job
+    assert job.to_api_json() == {
+        "job_id": job.job_id,
+        "status": "queued",
+        "file_name": "a.csv",
+        "progress": {"bytes_read": 0, "total_bytes": 100, "rows_processed": 0},
+    }
+    job_store.update_progress(job.job_id, bytes_read=50, rows_processed=2)
+    assert job_store.get(job.job_id) == job._replace(
+        status="running", bytes_read=50, rows_processed=2
+    )
+    job_store.update_progress(job.job_id, bytes_read=100, rows_processed=4)
+    job_store.succeed(job.job_id, RESULT)
+    assert job_store.get(job.job_id).to_api_json()["result"] == RESULT
+    assert job_store.get(job.job_id).rows_processed == 4
+
+    failed = job_store.create(None, total_bytes=100)
+    job_store.fail(failed.job_id, 400, "Invalid usage data: ...")
+    assert job_store.get(failed.job_id).error == {
+        "status_code": 400,
+        "detail": "Invalid usage data: ...",
+    }
+    assert job_store.get("unknown") is None
+
+
+def test_finished_jobs_are_evicted_after_their_ttl():
+    now = [0.0]
+    job_store = JobStore(ttl_seconds=60, clock=lambda: now[0])
+    queued = job_store.create("queued.csv", total_bytes=100)
+    started = job_store.create("started.csv", total_bytes=100)
+    done = job_store.create("done.csv", total_bytes=100)
+    job_store.succeed(done.job_id, RESULT)
+
+    now[0] = 50
+    job_store.start(started.job_id)
+    finished = job_store.create("finished.csv", total_bytes=100)
+    job_store.fail(finished.job_id, 400, "Invalid usage data: ...")
+    now[0] = 100
+
+    # Only finished jobs that haven't been updated within the TTL are evicted,
+    # unfinished ones are kept however long they wait
+    assert job_store.get(done.job_id) is None
+    assert job_store.get(finished.job_id).status == "failed"
+    assert job_store.get(queued.job_id).status == "queued"
+    assert job_store.get(started.job_id) == started._replace(status="running")
+    now[0] = 1000
+    assert job_store.get(queued.job_id).status == "queued"
+    # Finishing an evicted job doesn't bring it back
+    job_store.succeed(done.job_id, RESULT)
+    assert job_store.get(done.job_id) is None
+
+
+def test_unfinished_jobs_fail_on_restart(tmp_path):
+    sqlite_path = tmp_path / "jobs.sqlite"
+    job_store = JobStore(sqlite_path)
+    running = job_store.create("a.csv", total_bytes=100)
+    succeeded = job_store.create("b.csv", total_bytes=100)
+    job_store.update_progress(running.job_id, bytes_read=50, rows_processed=2)
+    job_store.succeed(succeeded.job_id, RESULT)
+    job_store.close()
+
+    job_store = JobStore(sqlite_path)
+
+    assert job_store.get(running.job_id).status == "failed"
+    assert job_store.get(running.job_id).error["status_code"] == 503
+    assert job_store.get(succeeded.job_id).result == RESULT
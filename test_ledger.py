@@ -0,0 +1,119 @@
+import json
+import sqlite3
+from pathlib import Path
+
+import pytest
+
+from calc_plan_cost import calc_plan_costs, compile_plan_config
+from custom_types import PlanConfig
+from ledger import CustomerLedger, LedgerStore
+from parse_usage_data import parse_usage_data_csv
+
+DATA_DIR = Path(__file__).parent / "data"
+PLAN_CONFIGS_PATH = Path(__file__).parent / "plan_configs.json"
+
+
+@pytest.fixture(scope="module")
+def usage_data():
+    with open(DATA_DIR / "high-winter-interval-data.csv", "rb") as csv_file:
+        return parse_usage_data_csv(csv_file)
+
+
+@pytest.fixture(scope="module")
+def compiled_plans():
+    with open(PLAN_CONFIGS_PATH) as f:
+        return [
+            compile_plan_config(PlanConfig.from_json(plan)) for plan in json.load(f)
+        ]
+
+
+def total_costs(plan_costs):
+    return [cost_data.total_cost for cost_data in plan_costs]
+
+
+def test_appending_days_matches_pricing_everything(usage_data, compiled_plans):
+    ledger = CustomerLedger("customer", compiled_plans, "v1")
+    # A day of 15 minute intervals at a time, so months roll over mid-append
+    for start in range(0, len(usage_data), 96):
+        ledger.append(usage_data[start : start + 96])
+
+    assert ledger.rows == len(usage_data)
+    assert total_costs(ledger.plan_costs()) == total_costs(
+        calc_plan_costs(compiled_plans, usage_data)
+    )
+
+
+def test_buyback_rules_match_pricing_everything(compiled_plans):
+    with open(DATA_DIR / "solar-interval-data.csv", "rb") as csv_file:
+        usage_data = parse_usage_data_csv(csv_file)
+    solar_plan = compile_plan_config(
+        PlanConfig.from_json(
+            {
+                "name": "Solar",
+                "base_rate_per_kwh": 15,
+                "buyback": {
+                    "rate_cents_per_kwh": 5,
+                    "time_of_day_rates": [
+                        {
+                            "start_time": "10:00",
+                            "end_time": "14:00",
+                            "rate_cents_per_kwh": 2,
+                        }
+                    ],
+                    "monthly_netting": True,
+                    "max_monthly_credit": 0,
+                },
+            }
+        )
+    )
+    ledger = CustomerLedger("customer", [*compiled_plans, solar_plan], "v1")
+    ledger.append(usage_data[:5000])
+    ledger.append(usage_data[5000:])
+
+    assert total_costs(ledger.plan_costs()) == total_costs(
+        calc_plan_costs([*compiled_plans, solar_plan], usage_data)
+    )
+
+
+def test_resent_rows_are_skipped(usage_data, compiled_plans):
+    ledger = CustomerLedger("customer", compiled_plans, "v1")
+    ledger.append(usage_data[:200])
+
+    assert ledger.append(usage_data[100:300]) == (100, 100)
+    assert total_costs(ledger.plan_costs()) == total_costs(
+        calc_plan_costs(compiled_plans, usage_data[:300])
+    )
+
+
+def test_store_persists_and_reprices(tmp_path, usage_data, compiled_plans):
+    store = LedgerStore(tmp_path / "ledger.sqlite3")
+    store.append("customer", usage_data[:1000], compiled_plans, "v1")
+    store.close()
+
+    new_plans = compiled_plans[:2]
+    store = LedgerStore(tmp_path / "ledger.sqlite3")
+    ledger, appended, skipped = store.append(
+        "customer", usage_data[1000:2000], new_plans, "v2"
+    )
+
+    assert (ledger.rows, appended, skipped) == (2000, 1000, 0)
+    assert total_costs(ledger.plan_costs()) == total_costs(
+        calc_plan_costs(new_plans, usage_data[:2000])
+    )
+    assert store.get("someone else", new_plans, "v2") is None
+
+
+def test_store_saves_repriced_ledgers(tmp_path, usage_data, compiled_plans):
+    store = LedgerStore(tmp_path / "ledger.sqlite3")
+    store.append("customer", usage_data[:1000], compiled_plans, "v1")
+    assert store.append("new customer", [], compiled_plans, "v1")[1:] == (0, 0)
+
+    new_plans = compiled_plans[:2]
+    store.get("customer", new_plans, "v2")
+    store.close()
+
+    with sqlite3.connect(tmp_path / "ledger.sqlite3") as db:
+        saved = dict(db.execute("SELECT customer_id, state FROM ledgers"))
+    db.close()
+    assert list(saved) == ["customer"]
+    assert json.loads(saved["customer"])["catalog_version"] == "v2"
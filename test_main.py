@@ -0,0 +1,558 @@
+import gzip
+import io
+import json
+import time
+import zipfile
+from pathlib import Path
+
+import pytest
+from fastapi.testclient import TestClient
+
+import batch
+import main
+from calc_plan_cost import calc_plan_costs
+from main import app
+from metrics import timed_call
+
+DATA_DIR = Path(__file__).parent / "data"
+
+
+@pytest.fixture(scope="module")
+def client():
+    with TestClient(app) as client:
+        yield client
+
+
+def test_recommend(client):
+    with open(DATA_DIR / "test_data.csv", "rb") as csv_file:
+        response = client.post("/recommend/", files={"file": ("a.csv", csv_file)})
+
+    assert response.status_code == 200
+    body = response.json()
+    assert body["file_name"] == "a.csv"
+    assert body["winner"] == body["all_plan_costs"][0]
+    assert len(body["all_plan_costs"]) == 3
+
+
+def test_recommend_batch(client):
+    csv_bytes = (DATA_DIR / "test_data.csv").read_bytes()
+    batch_file = io.BytesIO()
+    with zipfile.ZipFile(batch_file, "w") as archive:
+        archive.writestr("a.csv", csv_bytes)
+        archive.writestr("b.csv", csv_bytes)
+
+    response = client.post(
+        "/recommend/batch", files={"file": ("batch.zip", batch_file.getvalue())}
+    )
+    single = client.post("/recommend/", files={"file": ("a.csv", csv_bytes)}).json()
+    # Batches are priced strictly, without a data quality report
+    del single["data_quality"]
+
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    results = sorted(
+        (json.loads(line) for line in response.text.splitlines()),
+        key=lambda result: result["file_name"],
+    )
+    assert results == [single, {**single, "file_name": "b.csv"}]
+
+
+def test_recommend_batch_is_limited(client, monkeypatch):
+    batch_file = io.BytesIO()
+    with zipfile.ZipFile(batch_file, "w") as archive:
+        archive.writestr("a.csv", (DATA_DIR / "test_data.csv").read_bytes())
+    pricing_pool = app.state.pricing_pool
+    pool_jobs = []
+    run = pricing_pool.run
+    monkeypatch.setattr(
+        pricing_pool,
+        "run",
+        lambda fn, *args, **kwargs: pool_jobs.append(fn) or run(fn, *args, **kwargs),
+    )
+
+    priced = client.post(
+        "/recommend/batch", files={"file": ("batch.zip", batch_file.getvalue())}
+    )
+    monkeypatch.setattr(main, "settings", main.settings._replace(max_upload_bytes=100))
+    too_large = client.post(
+        "/recommend/batch", files={"file": ("batch.zip", batch_file.getvalue())}
+    )
+    monkeypatch.setattr(
+        pricing_pool, "jobs", pricing_pool.max_workers + pricing_pool.max_queue_depth
+    )
+    pool_full = client.post(
+        "/recommend/batch", files={"file": ("batch.zip", batch_file.getvalue())}
+    )
+
+    # Each member is priced on the pricing pool
+    assert priced.status_code == 200
+    assert pool_jobs == [batch.recommend_batch_item]
+    assert too_large.status_code == 413
+    assert pool_full.status_code == 429
+
+
+def test_portfolio(client, monkeypatch, tmp_path):
+    (tmp_path / "customers").mkdir()
+    for name in ["solar-interval-data.csv", "test_data.csv"]:
+        (tmp_path / "customers" / name).write_bytes((DATA_DIR / name).read_bytes())
+    (tmp_path / "customers" / "short.csv").write_text(
+        "datetime,duration,unit,consumption,generation\n2023-05-01T00:00:00-05:00\n"
+    )
+    monkeypatch.setattr(
+        main, "settings", main.settings._replace(batch_manifest_root=tmp_path)
+    )
+
+    response = client.post(
+        "/portfolio",
+        json={
+            "directory": "customers",
+            "scenarios": [{"name": "No flat", "plans": {"Flat": None}}],
+        },
+    )
+    outside = client.post("/portfolio", json={"directory": ".."})
+
+    assert response.status_code == 200
+    body = response.json()
+    assert body["customers"] == 2
+    assert body["errors"] == [
+        {"customer": "short.csv", "error": "Row 1 is missing fields."}
+    ]
+    assert len(body["baseline"]["plans"]) == 3
+    assert len(body["scenarios"][0]["plans"]) == 2
+    assert outside.status_code == 400
+
+
+def test_health(client):
+    response = client.get("/health")
+
+    assert response.status_code == 200
+    body = response.json()
+    assert body["status"] == "ok"
+    assert body["pricing_pool"]["busy_workers"] == 0
+
+
+@pytest.mark.parametrize(
+    "url, headers",
+    [
+        ("/recommend/?stream=true", {}),
+        ("/recommend/", {"Accept": "application/x-ndjson"}),
+    ],
+)
+def test_recommend_streams_ndjson(client, monkeypatch, url, headers):
+    # Not uploaded by other tests, so it isn't already cached
+    csv_bytes = (DATA_DIR / "solar-interval-data.csv").read_bytes() + b"\n" * len(url)
+    pricing_pool = app.state.pricing_pool
+    pool_jobs = []
+    run = pricing_pool.run
+    monkeypatch.setattr(
+        pricing_pool,
+        "run",
+        lambda fn, *args, **kwargs: pool_jobs.append(fn) or run(fn, *args, **kwargs),
+    )
+
+    response = client.post(
+        url, content=csv_bytes, headers={"Content-Type": "text/csv", **headers}
+    )
+    # Priced on the pool, like the JSON response
+    assert calc_plan_costs in pool_jobs
+    # Cached by the streamed response
+    cached = client.post(
+        url, content=csv_bytes, headers={"Content-Type": "text/csv", **headers}
+    )
+    expected = client.post("/recommend/", files={"file": ("a.csv", csv_bytes)}).json()
+
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    *plan_costs, final = [json.loads(line) for line in response.text.splitlines()]
+    assert sorted(plan_costs, key=lambda plan_cost: plan_cost["plan"]["plan_name"]) == (
+        sorted(
+            expected["all_plan_costs"],
+            key=lambda plan_cost: plan_cost["plan"]["plan_name"],
+        )
+    )
+    assert final == {
+        "file_name": None,
+        "winner": expected["winner"],
+        "data_quality": expected["data_quality"],
+    }
+    # Replayed from the cache cheapest first, rather than in catalog order
+    assert sorted(cached.text.splitlines()) == sorted(response.text.splitlines())
+
+
+def test_recommend_caches_repeated_uploads(client, monkeypatch):
+    csv_bytes = (DATA_DIR / "test_data.csv").read_bytes() + b"\n"
+    # Several blocks, so some are parsed while the upload is arriving
+    monkeypatch.setattr(main, "settings", main.settings._replace(upload_block_bytes=40))
+    stats = client.get("/health").json()["result_cache"]
+    pricing_pool = app.state.pricing_pool
+    pool_jobs = []
+    run = pricing_pool.run
+    monkeypatch.setattr(
+        pricing_pool,
+        "run",
+        lambda fn, *args, **kwargs: pool_jobs.append(fn) or run(fn, *args, **kwargs),
+    )
+
+    first = client.post("/recommend/", files={"file": ("a.csv", csv_bytes)})
+    first_pool_jobs = len(pool_jobs)
+    second = client.post("/recommend/", files={"file": ("b.csv", csv_bytes)})
+
+    assert second.json() == {**first.json(), "file_name": "b.csv"}
+    # Parsed while it arrives both times, but only priced the first time
+    assert calc_plan_costs in pool_jobs[:first_pool_jobs]
+    assert calc_plan_costs not in pool_jobs[first_pool_jobs:]
+    assert set(pool_jobs[first_pool_jobs:]) == {timed_call}
+    new_stats = client.get("/health").json()["result_cache"]
+    assert new_stats["misses"] == stats["misses"] + 1
+    assert new_stats["hits"] == stats["hits"] + 1
+
+
+def test_recommend_streams_gzipped_csv_in_blocks(client, monkeypatch):
+    csv_bytes = (DATA_DIR / "solar-interval-data.csv").read_bytes()
+    expected = client.post("/recommend/", files={"file": ("a.csv", csv_bytes)})
+    monkeypatch.setattr(
+        main, "settings", main.settings._replace(upload_block_bytes=4096)
+    )
+
+    response = client.post(
+        "/recommend/",
+        content=gzip.compress(csv_bytes),
+        headers={"Content-Type": "text/csv", "Content-Encoding": "gzip"},
+    )
+
+    assert response.status_code == 200
+    assert response.json() == {**expected.json(), "file_name": None}
+
+
+def test_recommend_rejects_large_uploads(client, monkeypatch):
+    csv_bytes = (DATA_DIR / "test_data.csv").read_bytes()
+    monkeypatch.setattr(main, "settings", main.settings._replace(max_upload_bytes=100))
+
+    response = client.post("/recommend/", files={"file": ("a.csv", csv_bytes)})
+    gzipped = client.post(
+        "/recommend/",
+        content=gzip.compress(csv_bytes * 10),
+        headers={"Content-Type": "text/csv", "Content-Encoding": "gzip"},
+    )
+
+    assert response.status_code == 413
+    assert gzipped.status_code == 413
+
+
+def test_recommend_rejects_invalid_uploads(client):
+    assert (
+        client.post("/recommend/", files={"other": ("a.csv", b"")}).status_code == 400
+    )
+    assert (
+        client.post(
+            "/recommend/", content=b"x", headers={"Content-Type": "image/png"}
+        ).status_code
+        == 415
+    )
+    malformed = client.post(
+        "/recommend/",
+        content=b"x",
+        headers={"Content-Type": "text/csv", "Content-Length": "abc"},
+    )
+    assert malformed.status_code == 400
+    assert malformed.json()["detail"] == "Invalid Content-Length header."
+
+
+def test_recommend_reports_data_quality(client):
+    csv_bytes = (DATA_DIR / "test_data.csv").read_bytes() + (
+        b"\n2023-05-01T01:00:00-05:00,900,MWh,1,0\n"
+    )
+
+    strict = client.post("/recommend/", files={"file": ("a.csv", csv_bytes)})
+    skip = client.post("/recommend/?policy=skip", files={"file": ("a.csv", csv_bytes)})
+    unknown = client.post(
+        "/recommend/?policy=ignore", files={"file": ("a.csv", csv_bytes)}
+    )
+
+    assert strict.status_code == 400
+    assert strict.json()["detail"]["data_quality"]["issues"]["invalid_unit"] == {
+        "count": 1,
+        "samples": [{"line": 5, "row": "2023-05-01T01:00:00-05:00,900,MWh,1,0"}],
+    }
+    assert skip.status_code == 200
+    assert skip.json()["data_quality"]["rows_skipped"] == 1
+    assert unknown.status_code == 422
+
+
+def test_recommend_breakdown(client):
+    csv_bytes = (DATA_DIR / "test_data.csv").read_bytes() + b"\n" * 4
+
+    plain = client.post("/recommend/", files={"file": ("a.csv", csv_bytes)}).json()
+    monthly = client.post(
+        "/recommend/?breakdown=monthly", files={"file": ("a.csv", csv_bytes)}
+    ).json()
+    daily = client.post(
+        "/recommend/?breakdown=daily", files={"file": ("a.csv", csv_bytes)}
+    ).json()
+
+    assert "monthly_costs" not in plain["winner"]
+    winner = monthly["winner"]
+    assert winner["total_cost"] == plain["winner"]["total_cost"]
+    assert winner["monthly_costs"][0].keys() == {
+        "month",
+        "consumption_kwh",
+        "generation_kwh",
+        "energy_cost",
+        "fees",
+        "buyback",
+        "total_cost",
+        "bands",
+    }
+    assert "daily_costs" not in winner
+    assert daily["winner"]["daily_costs"][0]["date"].startswith(
+        winner["monthly_costs"][0]["month"]
+    )
+
+
+def wait_for_job(client, job_id):
+    for _ in range(300):
+        job = client.get(f"/jobs/{job_id}").json()
+        if job["status"] in ("succeeded", "failed"):
+            return job
+        time.sleep(0.1)
+    raise AssertionError(f"Job {job_id} didn't finish: {job}")
+
+
+def test_jobs(client, monkeypatch):
+    csv_bytes = (DATA_DIR / "solar-interval-data.csv").read_bytes()
+    expected = client.post("/recommend/", files={"file": ("a.csv", csv_bytes)}).json()
+    monkeypatch.setattr(
+        main, "settings", main.settings._replace(upload_block_bytes=4096)
+    )
+    csv_bytes += b"\n" * 5
+
+    response = client.post("/jobs", files={"file": ("b.csv", csv_bytes)})
+
+    assert response.status_code == 202
+    job_id = response.json()["job_id"]
+    assert response.headers["location"] == f"/jobs/{job_id}"
+    assert response.json()["progress"]["total_bytes"] == len(csv_bytes)
+    job = wait_for_job(client, job_id)
+    assert job["status"] == "succeeded"
+    assert job["file_name"] == "b.csv"
+    assert job["progress"] == {
+        "bytes_read": len(csv_bytes),
+        "total_bytes": len(csv_bytes),
+        "rows_processed": expected["data_quality"]["rows"],
+    }
+    assert job["result"]["all_plan_costs"] == expected["all_plan_costs"]
+
+    # Uploads that were already priced finish straight away, from the result cache
+    repeated = client.post(
+        "/jobs",
+        content=gzip.compress(csv_bytes),
+        headers={"Content-Type": "text/csv", "Content-Encoding": "gzip"},
+    )
+    assert repeated.status_code == 202
+    assert repeated.json()["status"] == "succeeded"
+    assert repeated.json()["result"] == {**job["result"], "file_name": None}
+
+
+def test_jobs_report_errors(client, monkeypatch):
+    csv_bytes = (DATA_DIR / "test_data.csv").read_bytes() + (
+        b"\n2023-05-01T01:00:00-05:00,900,MWh,1,0\n"
+    )
+
+    invalid = client.post("/jobs", files={"file": ("a.csv", csv_bytes)})
+    unknown = client.get("/jobs/unknown")
+    monkeypatch.setattr(main, "settings", main.settings._replace(max_upload_bytes=100))
+    too_large = client.post("/jobs", files={"file": ("a.csv", csv_bytes)})
+
+    assert invalid.status_code == 202
+    job = wait_for_job(client, invalid.json()["job_id"])
+    assert job["status"] == "failed"
+    assert job["error"]["status_code"] == 400
+    assert (
+        job["error"]["detail"]["data_quality"]["issues"]["invalid_unit"]["count"] == 1
+    )
+    assert "result" not in job
+    assert unknown.status_code == 404
+    assert too_large.status_code == 413
+
+
+def test_jobs_queue_is_limited(client, monkeypatch):
+    csv_bytes = (DATA_DIR / "test_data.csv").read_bytes() + b"\n" * 7
+    monkeypatch.setattr(main, "settings", main.settings._replace(max_queued_jobs=1))
+    # Every running slot is taken and one job is already queued
+    monkeypatch.setattr(
+        client.app.state, "job_tasks", set(range(main.settings.max_running_jobs + 1))
+    )
+
+    rejected = client.post("/jobs", files={"file": ("a.csv", csv_bytes)})
+
+    assert rejected.status_code == 429
+    assert rejected.headers["retry-after"] == str(main.settings.retry_after_seconds)
+    client.app.state.job_tasks.remove(0)
+    accepted = client.post("/jobs", files={"file": ("a.csv", csv_bytes)})
+    assert accepted.status_code == 202
+    assert wait_for_job(client, accepted.json()["job_id"])["status"] == "succeeded"
+
+
+def test_metrics(client):
+    csv_bytes = (DATA_DIR / "test_data.csv").read_bytes() + b"\n\n"
+    client.post("/recommend/", files={"file": ("a.csv", csv_bytes)})
+
+    response = client.get("/metrics")
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert 'plan_optimizer_rows_parsed_total{endpoint="/recommend/"}' in response.text
+    assert (
+        'plan_optimizer_stage_seconds_count{endpoint="/recommend/",stage="price"}'
+        in response.text
+    )
+    assert (
+        'plan_optimizer_request_seconds_count{endpoint="/recommend/",status="200"}'
+        in response.text
+    )
+
+
+def test_server_timing_and_profiling(client, monkeypatch, tmp_path):
+    csv_bytes = (DATA_DIR / "test_data.csv").read_bytes() + b"\n\n\n"
+    monkeypatch.setattr(
+        main,
+        "settings",
+        main.settings._replace(server_timing=True, profile_dir=tmp_path),
+    )
+
+    response = client.post(
+        "/recommend/",
+        files={"file": ("a.csv", csv_bytes)},
+        headers={"X-Profile": "1"},
+    )
+
+    assert response.status_code == 200
+    stages = [
+        timing.split(";")[0] for timing in response.headers["Server-Timing"].split(", ")
+    ]
+    assert stages == [
+        "upload",
+        "parse_wait",
+        "parse",
+        "merge",
+        "price",
+        "respond",
+        "total",
+    ]
+    assert (tmp_path / response.headers["X-Profile-File"]).exists()
+
+
+def test_optimize(client):
+    csv_bytes = (DATA_DIR / "solar-interval-data.csv").read_bytes()
+    plan_grids = [
+        {
+            "name": "Tiered",
+            "base_rate_per_kwh": 14,
+            "base_monthly_fee": [0, 500],
+            "tiered_rates": [{"usage_kwh": [300, 600, 900], "rate_cents_per_kwh": 9}],
+        }
+    ]
+
+    response = client.post(
+        "/optimize",
+        files={"file": ("a.csv", csv_bytes)},
+        data={"plan_grids": json.dumps(plan_grids), "top": "2"},
+    )
+    invalid = client.post(
+        "/optimize",
+        files={"file": ("a.csv", csv_bytes)},
+        data={"plan_grids": "not json"},
+    )
+
+    assert response.status_code == 200
+    body = response.json()
+    assert body["candidates"] == 6
+    assert len(body["best"]) == 2
+    assert body["best"][0]["parameters"]["base_monthly_fee"] == 0
+    assert invalid.status_code == 400
+    missing = client.post("/optimize", files={"file": ("a.csv", csv_bytes)})
+    assert missing.status_code == 400
+    assert missing.json()["detail"] == "plan_grids is required."
+    empty_axis = client.post(
+        "/optimize",
+        files={"file": ("a.csv", csv_bytes)},
+        data={"plan_grids": json.dumps([{**plan_grids[0], "base_monthly_fee": []}])},
+    )
+    assert empty_axis.status_code == 400
+    assert "base_monthly_fee" in empty_axis.json()["detail"]
+
+
+def optimize_form(csv_bytes, plan_grids):
+    return (
+        b"--boundary\r\n"
+        b'Content-Disposition: form-data; name="plan_grids"\r\n\r\n'
+        + json.dumps(plan_grids).encode()
+        + b"\r\n--boundary\r\n"
+        b'Content-Disposition: form-data; name="file"; filename="a.csv"\r\n\r\n'
+        + csv_bytes
+        + b"\r\n--boundary--\r\n"
+    )
+
+
+def test_optimize_rejects_large_uploads(client, monkeypatch):
+    csv_bytes = (DATA_DIR / "test_data.csv").read_bytes()
+    body = optimize_form(csv_bytes, [{"name": "Flat", "base_rate_per_kwh": [14, 15]}])
+    headers = {"Content-Type": "multipart/form-data; boundary=boundary"}
+
+    def chunked_body():
+        for i in range(0, len(body), 50):
+            yield body[i : i + 50]
+
+    accepted = client.post("/optimize", content=chunked_body(), headers=headers)
+    monkeypatch.setattr(
+        main, "settings", main.settings._replace(max_upload_bytes=len(body) - 1)
+    )
+    # Without a Content-Length, the body is checked as it arrives
+    chunked = client.post("/optimize", content=chunked_body(), headers=headers)
+    sized = client.post("/optimize", content=body, headers=headers)
+    malformed = client.post(
+        "/optimize", content=body, headers={**headers, "Content-Length": "abc"}
+    )
+
+    assert accepted.status_code == 200
+    assert accepted.json()["candidates"] == 2
+    assert chunked.status_code == 413
+    assert sized.status_code == 413
+    assert malformed.status_code == 400
+
+
+def test_customer_ledger(client):
+    lines = (DATA_DIR / "solar-interval-data.csv").read_bytes().splitlines(True)
+    header, rows = lines[0], lines[1:]
+
+    first = client.patch(
+        "/customers/abc/usage",
+        content=header + b"".join(rows[:1000]),
+        headers={"Content-Type": "text/csv"},
+    )
+    second = client.patch(
+        "/customers/abc/usage",
+        files={"file": ("day.csv", header + b"".join(rows[900:2000]))},
+    )
+    whole = client.post(
+        "/recommend/", files={"file": ("a.csv", header + b"".join(rows[:2000]))}
+    )
+
+    assert first.status_code == 200
+    assert first.json()["appended_rows"] == 1000
+    assert second.json()["appended_rows"] == 1000
+    assert second.json()["skipped_rows"] == 100
+    assert second.json()["all_plan_costs"] == whole.json()["all_plan_costs"]
+    assert client.get("/customers/abc").json()["rows"] == 2000
+    assert client.get("/customers/unknown").status_code == 404
+
+
+def test_customer_ledger_ignores_empty_usage(client):
+    header = (DATA_DIR / "solar-interval-data.csv").read_bytes().splitlines(True)[0]
+
+    empty = client.patch(
+        "/customers/empty/usage", content=header, headers={"Content-Type": "text/csv"}
+    )
+
+    assert empty.status_code == 400
+    assert client.get("/customers/empty").status_code == 404
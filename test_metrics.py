@@ -0,0 +1,36 @@
+from metrics import MetricsRegistry, StageTimer
+
+
+def test_render_prometheus_text():
+    registry = MetricsRegistry()
+    rows = registry.counter("rows_total", "Rows parsed", ["endpoint"])
+    seconds = registry.histogram("seconds", "Durations", buckets=(0.1, 1))
+    rows.inc(3, endpoint="/a")
+    rows.inc(endpoint="/a")
+    seconds.observe(0.05)
+    seconds.observe(0.5)
+    seconds.observe(5)
+
+    assert registry.render() == (
+        "# HELP rows_total Rows parsed\n"
+        "# TYPE rows_total counter\n"
+        'rows_total{endpoint="/a"} 4\n'
+        "# HELP seconds Durations\n"
+        "# TYPE seconds histogram\n"
+        'seconds_bucket{le="0.1"} 1\n'
+        'seconds_bucket{le="1"} 2\n'
+        'seconds_bucket{le="+Inf"} 3\n'
+        "seconds_sum 5.55\n"
+        "seconds_count 3\n"
+    )
+
+
+def test_stage_timer():
+    stage_timer = StageTimer()
+    stage_timer.add("parse", 0.25)
+    stage_timer.add("parse", 0.5)
+    with stage_timer.stage("price"):
+        pass
+
+    assert stage_timer.seconds["parse"] == 0.75
+    assert stage_timer.server_timing().startswith("parse;dur=750.0, price;dur=")
@@ -1,8 +1,17 @@
+import io
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Iterator
 from dateutil.parser import parse as parse_date
+import pytest
 
 from custom_types import Seconds, UsageData, UsageDataRow
-from parse_usage_data import parse_usage_data_csv
+from parse_usage_data import (
+    ParseStats,
+    aggregate_usage_csv_file,
+    iter_usage_data_csv,
+    parse_usage_data_csv,
+)
 
 
 def test_parse_usage_data():
@@ -35,3 +44,63 @@ def test_parse_usage_data():
             ),
         ]
     )
+
+
+def test_iter_usage_data_csv():
+    """Rows are yielded lazily and match the fully parsed UsageData."""
+    with open(Path(__file__).parent / "data/test_data.csv", "rb") as csv_file:
+        usage_rows = iter_usage_data_csv(csv_file)
+        assert isinstance(usage_rows, Iterator)
+        first_row = next(usage_rows)
+        assert first_row.consumption == 2000
+        assert len(list(usage_rows)) == 2
+
+
+def test_iter_usage_data_csv_rejects_short_rows():
+    csv_file = io.BytesIO(
+        b"datetime,duration,unit,consumption,generation\n"
+        b"2023-05-01T00:00:00-05:00,900,Wh\n"
+    )
+
+    with pytest.raises(ValueError, match="Row 1 is missing fields"):
+        list(iter_usage_data_csv(csv_file))
+
+
+def test_parse_usage_data_counts_slow_path_timestamps():
+    """Timestamps outside the fixed ISO 8601 format fall back to dateutil."""
+    csv_file = io.BytesIO(
+        b"datetime,duration,unit,consumption,generation\n"
+        b"2023-05-01T00:00:00-05:00,900,Wh,1,0\n"
+        b"2023-05-01 00:15:00 -0500,900,Wh,2,0\n"
+        b"May 1 2023 00:30 -05:00,900,Wh,3,0\n"
+    )
+    stats = ParseStats()
+    usage_data = parse_usage_data_csv(csv_file, stats)
+
+    assert [row.datetime for row in usage_data] == [
+        parse_date("2023-05-01T00:00:00-05:00"),
+        parse_date("2023-05-01T00:15:00-05:00"),
+        parse_date("2023-05-01T00:30:00-05:00"),
+    ]
+    assert stats.rows_parsed == 3
+    assert stats.slow_path_rows == 2
+
+
+@pytest.mark.parametrize(
+    "file_name, chunk_bytes",
+    [
+        ("test_data.csv", 7),
+        ("solar-interval-data.csv", 10_000),
+        ("solar-interval-data.csv", 123_457),
+    ],
+)
+def test_aggregate_usage_csv_file_in_chunks(file_name, chunk_bytes):
+    """Every line is parsed exactly once however the file is split, including
+    chunks smaller than a line or the header."""
+    csv_path = Path(__file__).parent / "data" / file_name
+    expected = aggregate_usage_csv_file(csv_path)
+
+    with ThreadPoolExecutor(4) as executor:
+        actual = aggregate_usage_csv_file(csv_path, executor, chunk_bytes)
+    for column, expected_column in zip(actual, expected):
+        assert column.tolist() == expected_column.tolist()
@@ -0,0 +1,75 @@
+import json
+import os
+
+import pytest
+
+from plan_catalog import PlanCatalog, load_plan_catalog
+
+FLAT_PLAN = {"name": "Flat", "base_rate_per_kwh": 15}
+FREE_NIGHTS_PLAN = {
+    "name": "Free Nights",
+    "base_rate_per_kwh": 19,
+    "base_monthly_fee": 995,
+    "time_of_day_prices": [
+        {"start_time": "22:00", "end_time": "06:00", "rate_cents_per_kwh": 0}
+    ],
+}
+
+
+def write_plan_configs(path, plan_configs, mtime_ns):
+    path.write_text(json.dumps(plan_configs))
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+def test_load_plan_catalog(tmp_path):
+    path = tmp_path / "plan_configs.json"
+    write_plan_configs(path, [FLAT_PLAN, FREE_NIGHTS_PLAN], mtime_ns=1_000)
+
+    catalog_version = load_plan_catalog(path)
+
+    assert catalog_version.mtime_ns == 1_000
+    flat, free_nights = catalog_version.compiled_plans
+    assert flat.plan_config.name == "Flat"
+    # Milli-cents per kWh
+    assert set(flat.rate_by_minute) == {15_000}
+    assert free_nights.rate_by_minute[22 * 60] == 0
+    assert free_nights.rate_by_minute[6 * 60] == 19_000
+
+
+def test_load_plan_catalog_rejects_invalid_plan(tmp_path):
+    path = tmp_path / "plan_configs.json"
+    write_plan_configs(
+        path,
+        [
+            {
+                **FREE_NIGHTS_PLAN,
+                "tiered_rates": [{"usage_kwh": 500, "rate_cents_per_kwh": 11}],
+            }
+        ],
+        mtime_ns=1_000,
+    )
+
+    with pytest.raises(ValueError, match="Cannot mix tiered rates"):
+        load_plan_catalog(path)
+
+
+def test_plan_catalog_hot_reload(tmp_path):
+    path = tmp_path / "plan_configs.json"
+    write_plan_configs(path, [FLAT_PLAN], mtime_ns=1_000)
+    plan_catalog = PlanCatalog(path)
+    first_version = plan_catalog.current
+
+    assert not plan_catalog.reload_if_changed()
+    assert plan_catalog.current is first_version
+
+    write_plan_configs(path, [FLAT_PLAN, FREE_NIGHTS_PLAN], mtime_ns=2_000)
+    assert plan_catalog.reload_if_changed()
+    assert plan_catalog.current.version != first_version.version
+    assert len(plan_catalog.current.compiled_plans) == 2
+
+    # A broken file is ignored and the last good version is kept
+    second_version = plan_catalog.current
+    path.write_text("[{")
+    os.utime(path, ns=(3_000, 3_000))
+    assert not plan_catalog.reload_if_changed()
+    assert plan_catalog.current is second_version
@@ -0,0 +1,142 @@
+import json
+from pathlib import Path
+
+import pytest
+
+from calc_plan_cost import calc_aggregate_plan_cost, compile_plan_config
+from custom_types import CentsPerKWh, PlanConfig
+from parse_usage_data import parse_usage_data_csv
+from plan_search import PlanGrid, calc_plan_costs_swept, optimize_plans
+from usage_aggregate import UsageAggregate
+
+DATA_DIR = Path(__file__).parent / "data"
+PLAN_CONFIGS_PATH = Path(__file__).parent / "plan_configs.json"
+
+GRID = {
+    "name": "Tiered",
+    "base_rate_per_kwh": 14,
+    "base_monthly_fee": [0, 500, 1000],
+    "tiered_rates": [{"usage_kwh": [300, 1000], "rate_cents_per_kwh": 9}],
+}
+
+
+@pytest.fixture(scope="module")
+def usage_aggregate():
+    with open(DATA_DIR / "solar-interval-data.csv", "rb") as csv_file:
+        return UsageAggregate.from_usage_data(parse_usage_data_csv(csv_file))
+
+
+def test_plan_grid_candidates():
+    plan_grid = PlanGrid.from_json(GRID)
+    candidates = list(plan_grid.iter_candidates())
+
+    assert len(plan_grid) == len(candidates) == 6
+    assert [axis.name for axis in plan_grid.axes] == [
+        "base_monthly_fee",
+        "tiered_rates[0].usage_kwh",
+    ]
+    plan_config, parameters = candidates[1]
+    assert plan_config.name == "Tiered #2"
+    assert plan_config.base_monthly_fee == 0
+    assert plan_config.tiered_rates[0].usage_kwh == 1000
+    assert parameters == {"base_monthly_fee": 0, "tiered_rates[0].usage_kwh": 1000}
+
+
+def test_plan_grid_rejects_empty_axes():
+    with pytest.raises(ValueError, match="base_monthly_fee has no values to try"):
+        PlanGrid.from_json({**GRID, "base_monthly_fee": []})
+    with pytest.raises(ValueError, match=r"tiered_rates\[0\].usage_kwh has no"):
+        PlanGrid.from_json(
+            {**GRID, "tiered_rates": [{"usage_kwh": [], "rate_cents_per_kwh": 9}]}
+        )
+    # Plans may have no tiers or time of day prices
+    assert len(PlanGrid.from_json({**GRID, "tiered_rates": []})) == 3
+
+
+def test_plan_grid_sweeps_time_of_day_windows():
+    plan_grid = PlanGrid.from_json(
+        {
+            "name": "Nights",
+            "base_rate_per_kwh": 15,
+            "time_of_day_prices": [
+                {
+                    "start_time": ["20:00", "21:00"],
+                    "end_time": "06:00",
+                    "rate_cents_per_kwh": [0, 5],
+                }
+            ],
+        }
+    )
+
+    assert len(plan_grid) == 4
+
+
+def test_swept_costs_match_reference(usage_aggregate):
+    with open(PLAN_CONFIGS_PATH) as f:
+        plan_configs = [PlanConfig.from_json(plan) for plan in json.load(f)]
+    plan_configs += [
+        plan_config for plan_config, _ in PlanGrid.from_json(GRID).iter_candidates()
+    ]
+    plan_configs.append(
+        PlanConfig.from_json(
+            {
+                "name": "Peak",
+                "base_rate_per_kwh": 12,
+                "time_of_day_prices": [
+                    {
+                        "start_time": "16:07",
+                        "end_time": "20:52",
+                        "rate_cents_per_kwh": 30,
+                    },
+                    {
+                        "start_time": "22:00",
+                        "end_time": "02:30",
+                        "rate_cents_per_kwh": 4,
+                    },
+                ],
+                "buyback": {
+                    "time_of_day_rates": [
+                        {
+                            "start_time": "12:00",
+                            "end_time": "18:00",
+                            "rate_cents_per_kwh": 20,
+                        }
+                    ],
+                    "monthly_netting": True,
+                    "max_monthly_credit": 0,
+                },
+            }
+        )
+    )
+    compiled_plans = [compile_plan_config(plan_config) for plan_config in plan_configs]
+
+    swept = calc_plan_costs_swept(compiled_plans, usage_aggregate)
+
+    expected = [
+        calc_aggregate_plan_cost(compiled_plan, usage_aggregate).total_cost
+        for compiled_plan in compiled_plans
+    ]
+    assert swept.tolist() == expected
+
+
+def test_optimize_plans_break_even(usage_aggregate):
+    flat = compile_plan_config(
+        PlanConfig(name="Flat", base_rate_per_kwh=CentsPerKWh(15))
+    )
+    grid = PlanGrid.from_json(
+        {"name": "Fee", "base_rate_per_kwh": 14, "base_monthly_fee": [0, 10000]}
+    )
+
+    result = optimize_plans([grid], usage_aggregate, [flat], top=1)
+
+    assert result["candidates"] == 2
+    assert result["best"][0]["parameters"] == {"base_monthly_fee": 0}
+    [break_even] = result["grids"][0]["break_even"]
+    assert break_even["parameter"] == "base_monthly_fee"
+    # 1 cent per kWh cheaper pays for this much fee each month
+    months = len(usage_aggregate.months)
+    consumption_kwh = usage_aggregate.monthly_consumption_kwh.sum()
+    generation_kwh = usage_aggregate.monthly_generation_kwh.sum()
+    assert break_even["value"] == pytest.approx(
+        (consumption_kwh - generation_kwh) / months, abs=1e-3
+    )
@@ -0,0 +1,246 @@
+import json
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+import portfolio
+from calc_plan_cost import calc_plan_costs, compile_plan_config
+from custom_types import PlanConfig
+from parse_usage_data import aggregate_usage_csv_file
+from plan_catalog import load_plan_catalog
+from portfolio import (
+    PlanScenario,
+    SummaryCache,
+    analyze_portfolio,
+    int_matmul,
+    price_portfolio,
+    scan_portfolio,
+)
+
+DATA_DIR = Path(__file__).parent / "data"
+PLAN_CONFIGS_PATH = Path(__file__).parent / "plan_configs.json"
+
+
+@pytest.fixture
+def customers_dir(tmp_path):
+    for path in DATA_DIR.glob("*-interval-data.csv"):
+        shutil.copy(path, tmp_path / path.name)
+    (tmp_path / "nested").mkdir()
+    shutil.copy(DATA_DIR / "test_data.csv", tmp_path / "nested" / "test_data.csv")
+    (tmp_path / "empty.csv").write_text(
+        "datetime,duration,unit,consumption,generation\n"
+    )
+    (tmp_path / "notes.txt").write_text("not usage data")
+    return tmp_path
+
+
+def test_portfolio_costs_match_calc_plan_costs(customers_dir):
+    compiled_plans = list(load_plan_catalog(PLAN_CONFIGS_PATH).compiled_plans)
+
+    customer_portfolio = scan_portfolio(customers_dir, SummaryCache())
+    total_costs = price_portfolio(customer_portfolio, compiled_plans)
+
+    assert customer_portfolio.customers == [
+        "high-winter-interval-data.csv",
+        "low-winter-interval-data.csv",
+        "nested/test_data.csv",
+        "solar-interval-data.csv",
+    ]
+    assert customer_portfolio.errors == [
+        {"customer": "empty.csv", "error": "Usage data is empty."}
+    ]
+    for customer, customer_costs in zip(customer_portfolio.customers, total_costs):
+        expected = calc_plan_costs(
+            compiled_plans, aggregate_usage_csv_file(customers_dir / customer)
+        )
+        assert customer_costs.tolist() == pytest.approx(
+            [cost_data.total_cost for cost_data in expected], rel=1e-6, abs=0.01
+        )
+
+
+def test_summaries_are_cached_until_files_change(customers_dir, monkeypatch):
+    cache_path = customers_dir / "cache.sqlite"
+    cache = SummaryCache(cache_path)
+    first = scan_portfolio(customers_dir, cache)
+    parsed = []
+    summarize_usage_csv = portfolio.summarize_usage_csv
+    monkeypatch.setattr(
+        portfolio,
+        "summarize_usage_csv",
+        lambda path: parsed.append(path.name) or summarize_usage_csv(path),
+    )
+
+    second = scan_portfolio(customers_dir, cache)
+    with open(customers_dir / "nested" / "test_data.csv", "a") as csv_file:
+        csv_file.write("\n2023-06-01T00:00:00-05:00,900,Wh,1000,0\n")
+    third = scan_portfolio(customers_dir, cache)
+
+    # Unchanged, the last portfolio is reused as it is. Once a file changes,
+    # only it and the files that failed before are parsed again
+    assert second is first
+    assert parsed == ["empty.csv", "test_data.csv"]
+    assert third.customers == first.customers
+    unchanged = [0, 1, 3]
+    assert (
+        third.wh_seconds_by_minute[unchanged] == first.wh_seconds_by_minute[unchanged]
+    ).all()
+    assert third.num_of_months.tolist() != first.num_of_months.tolist()
+    assert scan_portfolio(customers_dir, SummaryCache(cache_path)).customers == (
+        first.customers
+    )
+
+
+def test_malformed_files_are_reported_per_customer(customers_dir):
+    (customers_dir / "short.csv").write_text(
+        "datetime,duration,unit,consumption,generation\n"
+        "2023-05-01T00:00:00-05:00,900,Wh\n"
+    )
+
+    customer_portfolio = scan_portfolio(customers_dir, SummaryCache())
+
+    assert len(customer_portfolio.customers) == 4
+    assert {"customer": "short.csv", "error": "Row 1 is missing fields."} in (
+        customer_portfolio.errors
+    )
+
+
+def test_time_of_day_costs_are_exact(customers_dir):
+    compiled_plans = list(load_plan_catalog(PLAN_CONFIGS_PATH).compiled_plans)
+    customer_portfolio = scan_portfolio(customers_dir, SummaryCache())
+
+    total_costs = price_portfolio(customer_portfolio, compiled_plans)
+
+    for customer, customer_costs in zip(customer_portfolio.customers, total_costs):
+        expected = calc_plan_costs(
+            compiled_plans, aggregate_usage_csv_file(customers_dir / customer)
+        )
+        assert customer_costs.tolist() == [
+            cost_data.total_cost for cost_data in expected
+        ]
+
+
+def test_int_matmul_is_exact():
+    a = np.array([[2**40, 3], [5, 7]], dtype=np.int64)
+    b = np.array([[2**20 + 1], [11]], dtype=np.int64)
+    expected = [[2**60 + 2**40 + 33], [5 * (2**20 + 1) + 77]]
+
+    assert int_matmul(a, b).tolist() == expected
+    assert int_matmul(a, b * 2**10).tolist() == [
+        [value * 2**10 for value in row] for row in expected
+    ]
+
+
+def test_scenarios_change_remove_and_add_plans():
+    plan_configs = [
+        compiled_plan.plan_config
+        for compiled_plan in load_plan_catalog(PLAN_CONFIGS_PATH).compiled_plans
+    ]
+    scenario = PlanScenario.from_json(
+        {
+            "name": "Flat only",
+            "plans": {
+                "Flat": {"base_rate_per_kwh": 14},
+                "Tiered": None,
+                "Free Nights": None,
+                "Flat with fee": {"base_rate_per_kwh": 12, "base_monthly_fee": 500},
+            },
+        }
+    )
+
+    changed_plans = scenario.apply(plan_configs)
+
+    assert [plan_config.name for plan_config in changed_plans] == [
+        "Flat",
+        "Flat with fee",
+    ]
+    assert changed_plans[0].base_rate_per_kwh == 14
+    assert changed_plans[1].base_monthly_fee == 500
+    with pytest.raises(ValueError, match="Invalid plan"):
+        PlanScenario.from_json(
+            {"plans": {"Flat": {"base_rate_per_kwh": 14.5005}}}
+        ).apply(plan_configs)
+    with pytest.raises(ValueError, match="scenario"):
+        PlanScenario.from_json({"plans": []})
+
+
+def test_buyback_rules_are_rejected(customers_dir):
+    customer_portfolio = scan_portfolio(customers_dir, SummaryCache())
+    plan_config = PlanConfig.from_json(
+        {
+            "name": "Solar",
+            "base_rate_per_kwh": 15,
+            "buyback": {"rate_cents_per_kwh": 5, "max_monthly_credit": 0},
+        }
+    )
+
+    with pytest.raises(ValueError, match="only flat buyback rates"):
+        price_portfolio(customer_portfolio, [compile_plan_config(plan_config)])
+    flat_buyback = compile_plan_config(
+        plan_config._replace(
+            buyback=plan_config.buyback._replace(max_monthly_credit=None)
+        )
+    )
+    assert price_portfolio(customer_portfolio, [flat_buyback])[:, 0].tolist() == (
+        pytest.approx(
+            [
+                cost_data.total_cost
+                for customer in customer_portfolio.customers
+                for cost_data in calc_plan_costs(
+                    [flat_buyback], aggregate_usage_csv_file(customers_dir / customer)
+                )
+            ]
+        )
+    )
+
+
+def test_analyze_portfolio(customers_dir):
+    compiled_plans = list(load_plan_catalog(PLAN_CONFIGS_PATH).compiled_plans)
+    customer_portfolio = scan_portfolio(customers_dir, SummaryCache())
+    scenarios = [
+        PlanScenario.from_json({"name": "Unchanged", "plans": {}}),
+        PlanScenario.from_json(
+            {"name": "Cheap flat", "plans": {"Flat": {"base_rate_per_kwh": 1}}}
+        ),
+    ]
+
+    result = analyze_portfolio(customer_portfolio, compiled_plans, scenarios)
+
+    json.dumps(result)
+    assert result["customers"] == 4
+    baseline, unchanged, cheap_flat = (
+        result["baseline"],
+        *result["scenarios"],
+    )
+    assert sum(plan["customers"] for plan in baseline["plans"]) == 4
+    assert unchanged["plans"] == baseline["plans"]
+    assert unchanged["customers_switching"] == 0
+    assert unchanged["revenue_change"] == "$0.00"
+    assert cheap_flat["plans"][0]["customers"] == 4
+    assert cheap_flat["customers_switching"] == 4 - baseline["plans"][0]["customers"]
+    assert cheap_flat["revenue_change"].startswith("$-")
+
+
+def test_cli(customers_dir, tmp_path, capsys):
+    scenarios_path = tmp_path / "scenarios.json"
+    scenarios_path.write_text(json.dumps([{"name": "No change", "plans": {}}]))
+
+    assert (
+        portfolio.main(
+            [
+                str(customers_dir),
+                "--scenarios",
+                str(scenarios_path),
+                "--cache",
+                str(tmp_path / "cache.sqlite"),
+                "--workers",
+                "1",
+            ]
+        )
+        == 0
+    )
+
+    result = json.loads(capsys.readouterr().out)
+    assert result["customers"] == 4
+    assert [scenario["name"] for scenario in result["scenarios"]] == ["No change"]
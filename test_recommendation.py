@@ -0,0 +1,55 @@
+import asyncio
+import json
+from pathlib import Path
+
+from calc_plan_cost import calc_plan_costs, compile_plan_config
+from custom_types import CentsPerKWh, PlanConfig
+from parse_usage_data import iter_usage_data_csv
+from recommendation import (
+    build_recommendation,
+    encode_json,
+    iter_recommendation_ndjson,
+    recommend_usage_csv_bytes,
+)
+
+DATA_DIR = Path(__file__).parent / "data"
+
+
+def test_encode_json_is_compact_orjson():
+    value = {"file_name": "é.csv", "total_cost": 12.5, "plans": [1, None, True]}
+
+    assert encode_json(value) == json.dumps(
+        value, ensure_ascii=False, separators=(",", ":")
+    ).encode("utf-8")
+
+
+def test_ndjson_lines_match_the_json_response():
+    compiled_plans = [
+        compile_plan_config(PlanConfig(name=name, base_rate_per_kwh=rate))
+        for name, rate in [("Flat", CentsPerKWh(15)), ("Cheap", CentsPerKWh(12.5))]
+    ]
+    csv_bytes = (DATA_DIR / "test_data.csv").read_bytes()
+    with open(DATA_DIR / "test_data.csv", "rb") as csv_file:
+        plan_costs = calc_plan_costs(compiled_plans, iter_usage_data_csv(csv_file))
+    results = []
+
+    async def collect_lines():
+        async def priced():
+            for cost_data in plan_costs:
+                yield cost_data
+
+        return [
+            line
+            async for line in iter_recommendation_ndjson(
+                "test_data.csv", priced(), on_result=results.append
+            )
+        ]
+
+    lines = asyncio.run(collect_lines())
+
+    result = recommend_usage_csv_bytes("test_data.csv", csv_bytes, compiled_plans)
+    assert results == [result] == [build_recommendation("test_data.csv", plan_costs)]
+    *plan_lines, last_line = [json.loads(line) for line in lines]
+    assert plan_lines == [cost_data.to_api_json() for cost_data in plan_costs]
+    assert last_line == {"file_name": "test_data.csv", "winner": result["winner"]}
+    assert result["winner"]["plan"]["plan_name"] == "Cheap"
@@ -0,0 +1,60 @@
+import json
+
+from result_cache import ResultCache
+
+RESULT = {"file_name": "a.csv", "winner": {"total_cost": "$1.00"}}
+RESULT_SIZE = len(json.dumps(RESULT))
+
+
+def test_result_cache_key_includes_catalog_version():
+    assert ResultCache.key("usage", "v1") == ResultCache.key("usage", "v1")
+    assert ResultCache.key("usage", "v1") != ResultCache.key("usage", "v2")
+    assert ResultCache.key("usage", "v1") != ResultCache.key("other", "v1")
+
+
+def test_result_cache_lru_eviction():
+    result_cache = ResultCache(max_bytes=2 * RESULT_SIZE)
+    result_cache.put("a", RESULT)
+    result_cache.put("b", RESULT)
+    assert result_cache.get("a") == RESULT  # "a" is now the most recently used
+    result_cache.put("c", RESULT)
+
+    assert result_cache.get("b") is None
+    assert result_cache.get("a") == RESULT
+    assert result_cache.get("c") == RESULT
+    assert result_cache.stats() == {
+        "hits": 3,
+        "misses": 1,
+        "entries": 2,
+        "size_bytes": 2 * RESULT_SIZE,
+        "max_bytes": 2 * RESULT_SIZE,
+    }
+
+
+def test_result_cache_survives_restart(tmp_path):
+    sqlite_path = tmp_path / "results.sqlite"
+    result_cache = ResultCache(max_bytes=2 * RESULT_SIZE, sqlite_path=sqlite_path)
+    for key in ("a", "b", "c"):
+        result_cache.put(key, RESULT)
+    result_cache.close()
+
+    result_cache = ResultCache(max_bytes=2 * RESULT_SIZE, sqlite_path=sqlite_path)
+    assert result_cache.get("a") is None
+    assert result_cache.get("b") == RESULT
+    assert result_cache.get("c") == RESULT
+    result_cache.close()
+
+
+def test_result_cache_keeps_recency_across_restarts(tmp_path):
+    sqlite_path = tmp_path / "results.sqlite"
+    result_cache = ResultCache(max_bytes=3 * RESULT_SIZE, sqlite_path=sqlite_path)
+    for key in ("a", "b", "c"):
+        result_cache.put(key, RESULT)
+    assert result_cache.get("a") == RESULT  # "a" is now the most recently used
+    result_cache.close()
+
+    result_cache = ResultCache(max_bytes=2 * RESULT_SIZE, sqlite_path=sqlite_path)
+    assert result_cache.get("b") is None
+    assert result_cache.get("a") == RESULT
+    assert result_cache.get("c") == RESULT
+    result_cache.close()
@@ -0,0 +1,18 @@
+from pathlib import Path
+
+from settings import Settings
+
+
+def test_settings_from_env():
+    settings = Settings.from_env(
+        {
+            "PLAN_OPTIMIZER_PRICING_WORKERS": "4",
+            "PLAN_OPTIMIZER_BATCH_MANIFEST_ROOT": "/srv/usage",
+            "PLAN_OPTIMIZER_RETRY_AFTER_SECONDS": "",
+            "UNRELATED": "1",
+        }
+    )
+
+    assert settings == Settings(
+        pricing_workers=4, batch_manifest_root=Path("/srv/usage")
+    )
@@ -0,0 +1,91 @@
+import gzip
+
+import pytest
+
+from upload_ingestion import (
+    CsvBlockSplitter,
+    UploadFormatError,
+    UploadTooLargeError,
+    UsageUploadReader,
+)
+
+CSV = b"a,b\n1,2\n3,4\n5,6"
+BOUNDARY = "boundary"
+MULTIPART = (
+    b"--boundary\r\n"
+    b'Content-Disposition: form-data; name="note"\r\n\r\n'
+    b"not usage data\r\n"
+    b"--boundary\r\n"
+    b'Content-Disposition: form-data; name="file"; filename="usage.csv"\r\n'
+    b"Content-Type: text/csv\r\n\r\n" + CSV + b"\r\n--boundary--\r\n"
+)
+
+
+def read_upload(reader: UsageUploadReader, body: bytes, chunk_size: int) -> bytes:
+    csv_bytes = b"".join(
+        reader.feed(body[i : i + chunk_size]) for i in range(0, len(body), chunk_size)
+    )
+    return csv_bytes + reader.finish()
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 1000])
+def test_reads_multipart_file_field(chunk_size):
+    reader = UsageUploadReader(
+        f"multipart/form-data; boundary={BOUNDARY}", None, max_bytes=1000
+    )
+
+    assert read_upload(reader, MULTIPART, chunk_size) == CSV
+    assert reader.file_name == "usage.csv"
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 1000])
+def test_keeps_named_form_fields(chunk_size):
+    reader = UsageUploadReader(
+        f"multipart/form-data; boundary={BOUNDARY}",
+        None,
+        max_bytes=1000,
+        form_field_names=["note", "missing"],
+    )
+
+    assert read_upload(reader, MULTIPART, chunk_size) == CSV
+    assert reader.form_fields == {"note": "not usage data"}
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 1000])
+def test_reads_gzipped_multipart(chunk_size):
+    reader = UsageUploadReader(
+        f"multipart/form-data; boundary={BOUNDARY}", "gzip", max_bytes=1000
+    )
+
+    assert read_upload(reader, gzip.compress(MULTIPART), chunk_size) == CSV
+
+
+def test_limits_decompressed_size():
+    reader = UsageUploadReader("text/csv", "gzip", max_bytes=1000)
+
+    with pytest.raises(UploadTooLargeError):
+        read_upload(reader, gzip.compress(b"0" * 1_000_000), 1000)
+
+
+def test_rejects_uploads_without_usage_data():
+    with pytest.raises(UploadFormatError):
+        UsageUploadReader("image/png", None, max_bytes=1000)
+    with pytest.raises(UploadFormatError):
+        UsageUploadReader("text/csv", "br", max_bytes=1000)
+    reader = UsageUploadReader(
+        f"multipart/form-data; boundary={BOUNDARY}", None, max_bytes=1000
+    )
+    with pytest.raises(UploadFormatError):
+        read_upload(reader, MULTIPART.replace(b'name="file"', b'name="x"'), 1000)
+
+
+def test_csv_block_splitter():
+    splitter = CsvBlockSplitter(block_bytes=4)
+    blocks = []
+    for i in range(len(CSV)):
+        blocks += splitter.feed(CSV[i : i + 1])
+    blocks += splitter.finish()
+
+    assert splitter.header == b"a,b\n"
+    assert blocks == [b"1,2\n", b"3,4\n", b"5,6\n"]
+    assert splitter.rows == 3
@@ -0,0 +1,118 @@
+import json
+import random
+from pathlib import Path
+
+import pytest
+from dateutil.parser import parse as parse_date
+
+from calc_plan_cost import calc_plan_cost, calc_plan_costs
+from custom_types import CentsPerKWh, PlanConfig, Seconds, UsageData, UsageDataRow
+from parse_usage_data import parse_usage_data_csv
+from usage_aggregate import UsageAggregate
+
+USAGE_DATA = UsageData(
+    [
+        UsageDataRow(
+            datetime=parse_date("2023-05-01T00:00:00-05:00"),
+            duration=Seconds(900),
+            unit="Wh",
+            consumption=1000,
+        ),
+        UsageDataRow(
+            datetime=parse_date("2023-05-02T00:00:00-05:00"),
+            duration=Seconds(900),
+            unit="Wh",
+            consumption=2000,
+            generation=500,
+        ),
+        UsageDataRow(
+            datetime=parse_date("2023-05-02T00:15:00-05:00"),
+            duration=Seconds(900),
+            unit="Wh",
+            consumption=4000,
+        ),
+        UsageDataRow(
+            datetime=parse_date("2024-05-01T00:00:00-05:00"),
+            duration=Seconds(1800),
+            unit="kWh",
+            consumption=1,
+        ),
+    ]
+)
+
+
+@pytest.mark.parametrize(
+    "usage_aggregate",
+    [
+        UsageAggregate.from_usage_data(USAGE_DATA),
+        UsageAggregate.from_usage_rows(USAGE_DATA),
+        # Split through the middle of a group
+        UsageAggregate.merge(
+            [
+                UsageAggregate.from_usage_data(USAGE_DATA[:1]),
+                UsageAggregate.from_usage_rows(USAGE_DATA[1:]),
+            ]
+        ),
+    ],
+    ids=["vectorized", "streaming", "merged"],
+)
+def test_usage_aggregate_groups(usage_aggregate):
+    # May of two different years are separate months
+    assert usage_aggregate.months.tolist() == [2023 * 12 + 4, 2024 * 12 + 4]
+    assert usage_aggregate.monthly_consumption_wh.tolist() == [7000, 1000]
+    assert usage_aggregate.monthly_generation_wh.tolist() == [500, 0]
+    # Same month, duration and time of day are summed into one group
+    assert usage_aggregate.group_month.tolist() == [0, 0, 1]
+    assert usage_aggregate.duration.tolist() == [900, 900, 1800]
+    assert usage_aggregate.second_of_day.tolist() == [0, 900, 0]
+    assert usage_aggregate.consumption_wh.tolist() == [3000, 4000, 1000]
+    assert usage_aggregate.generation_wh.tolist() == [500, 0, 0]
+    # Daily totals by local day
+    assert usage_aggregate.days.astype("datetime64[D]").astype(str).tolist() == [
+        "2023-05-01",
+        "2023-05-02",
+        "2024-05-01",
+    ]
+    assert usage_aggregate.daily_consumption_wh.tolist() == [1000, 6000, 1000]
+    assert usage_aggregate.daily_generation_wh.tolist() == [0, 500, 0]
+
+
+def test_usage_aggregate_rejects_bad_durations():
+    usage_data = UsageData(
+        [USAGE_DATA[0]._replace(duration=Seconds(-900)), USAGE_DATA[1]]
+    )
+
+    with pytest.raises(ValueError, match="durations"):
+        UsageAggregate.from_usage_data(usage_data)
+
+
+def test_empty_usage_data():
+    with pytest.raises(ValueError, match="Usage data is empty."):
+        calc_plan_cost(
+            PlanConfig(name="Flat", base_rate_per_kwh=CentsPerKWh(15)), UsageData()
+        )
+
+
+def test_costs_do_not_depend_on_row_order():
+    with open(
+        Path(__file__).parent / "data" / "high-winter-interval-data.csv", "rb"
+    ) as f:
+        usage_data = parse_usage_data_csv(f)
+    shuffled = list(usage_data)
+    random.Random(17).shuffle(shuffled)
+    with open(Path(__file__).parent / "plan_configs.json") as f:
+        plan_configs = [PlanConfig.from_json(plan) for plan in json.load(f)]
+
+    expected = calc_plan_costs(plan_configs, usage_data)
+    assert calc_plan_costs(plan_configs, shuffled) == expected
+    # Blocks aggregated separately, e.g. in parallel, then merged
+    assert (
+        calc_plan_costs(
+            plan_configs,
+            UsageAggregate.merge(
+                UsageAggregate.from_usage_rows(shuffled[start : start + 1000])
+                for start in range(0, len(shuffled), 1000)
+            ),
+        )
+        == expected
+    )
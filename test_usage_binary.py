@@ -0,0 +1,41 @@
+from pathlib import Path
+
+import pytest
+
+from calc_plan_cost import calc_plan_costs
+from parse_usage_data import parse_usage_data_csv
+from plan_catalog import load_plan_catalog
+from usage_binary import convert_usage_csv_to_binary, load_usage_data_binary
+
+DATA_DIR = Path(__file__).parent / "data"
+COMPILED_PLANS = load_plan_catalog(
+    Path(__file__).parent / "plan_configs.json"
+).compiled_plans
+
+
+@pytest.mark.parametrize("file_name", ["test_data.csv", "solar-interval-data.csv"])
+def test_round_trip(tmp_path, file_name):
+    rows = convert_usage_csv_to_binary(DATA_DIR / file_name, tmp_path / "a.usage")
+
+    usage_data = load_usage_data_binary(tmp_path / "a.usage")
+
+    with open(DATA_DIR / file_name, "rb") as csv_file:
+        expected = parse_usage_data_csv(csv_file)
+    assert rows == len(usage_data) == len(expected)
+    assert usage_data == expected
+    # Columns are views of the mapped file, not copies
+    assert isinstance(usage_data.consumption, memoryview)
+    assert calc_plan_costs(COMPILED_PLANS, usage_data) == calc_plan_costs(
+        COMPILED_PLANS, expected
+    )
+
+
+def test_rejects_other_files(tmp_path):
+    convert_usage_csv_to_binary(DATA_DIR / "test_data.csv", tmp_path / "a.usage")
+    truncated = (tmp_path / "a.usage").read_bytes()[:-16]
+    (tmp_path / "truncated.usage").write_bytes(truncated)
+
+    with pytest.raises(ValueError, match="not a binary usage file"):
+        load_usage_data_binary(DATA_DIR / "test_data.csv")
+    with pytest.raises(ValueError, match="truncated"):
+        load_usage_data_binary(tmp_path / "truncated.usage")
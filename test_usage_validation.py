@@ -0,0 +1,109 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from parse_usage_data import aggregate_usage_csv_block
+from usage_aggregate import UsageAggregate
+from usage_validation import (
+    DataQualityError,
+    DataQualityReport,
+    check_data_quality,
+    last_line,
+    validate_usage_csv_block,
+)
+
+DATA_DIR = Path(__file__).parent / "data"
+HEADER = b"datetime,duration,unit,consumption,generation\n"
+BAD_CSV = (
+    b"2023-05-01T00:00:00-05:00,900,Wh,100,0\n"
+    b"2023-05-01T00:15:00-05:00,900,MWh,100,0\n"
+    b"2023-05-01T00:15:00-05:00,900,Wh,200,0\n"
+    b"2023-05-01T00:15:00-05:00,900,Wh,200,0\n"
+    b"2023-05-01T00:20:00-05:00,900,Wh,1,0\n"
+    b"\n"
+    b"2023-05-01T01:15:00-05:00,900,Wh,500,0\n"
+    b"2023-05-01T01:30:00-05:00,900,Wh,-1,0\n"
+)
+
+
+@pytest.mark.parametrize("file_name", ["test_data.csv", "solar-interval-data.csv"])
+def test_clean_files_match_the_row_parser(file_name):
+    header, block = (DATA_DIR / file_name).read_bytes().split(b"\n", 1)
+
+    usage_columns, report = validate_usage_csv_block(header + b"\n", block)
+
+    expected = aggregate_usage_csv_block(header + b"\n", block)
+    for actual_field, expected_field in zip(
+        UsageAggregate.from_usage_columns(usage_columns), expected
+    ):
+        np.testing.assert_array_equal(actual_field, expected_field)
+    assert not report.has_errors
+    assert report.rows_skipped == 0
+
+
+def test_report_counts_and_samples_issues():
+    _, report = validate_usage_csv_block(HEADER, BAD_CSV, "skip")
+
+    assert report.rows == 7
+    assert report.rows_skipped == 4
+    assert report.issues == {
+        "invalid_unit": 1,
+        "negative_energy": 1,
+        "duplicate": 1,
+        "overlap": 1,
+        "gap": 1,
+    }
+    assert report.samples["invalid_unit"] == [
+        {"line": 3, "row": "2023-05-01T00:15:00-05:00,900,MWh,100,0"}
+    ]
+    assert report.samples["gap"][0]["line"] == 8
+    # From the end of 00:15 to the start of 01:15
+    assert report.gap_seconds == 45 * 60
+
+
+def test_strict_policy_rejects_errors():
+    _, report = validate_usage_csv_block(HEADER, BAD_CSV, "strict")
+
+    with pytest.raises(DataQualityError, match="1 invalid unit rows") as e:
+        check_data_quality(report, "strict")
+    assert e.value.report == report
+    check_data_quality(report, "skip")
+
+
+def test_skip_policy_prices_the_remaining_rows():
+    usage_columns, _ = validate_usage_csv_block(HEADER, BAD_CSV, "skip")
+
+    assert usage_columns.consumption_wh.tolist() == [100, 200, 500]
+
+
+def test_interpolate_policy_fills_gaps():
+    usage_columns, report = validate_usage_csv_block(HEADER, BAD_CSV, "interpolate")
+
+    assert report.rows_interpolated == 3
+    assert usage_columns.consumption_wh.tolist() == [100, 200, 275, 350, 425, 500]
+    assert np.all(np.diff(usage_columns.epoch_seconds) == 900)
+
+
+def test_blocks_are_checked_against_the_previous_line():
+    split = BAD_CSV.index(b"2023-05-01T00:20")
+    first, second = BAD_CSV[:split], BAD_CSV[split:]
+
+    whole_columns, whole = validate_usage_csv_block(HEADER, BAD_CSV, "interpolate")
+    first_columns, first_report = validate_usage_csv_block(HEADER, first, "interpolate")
+    second_columns, second_report = validate_usage_csv_block(
+        HEADER, second, "interpolate", previous_line=last_line(first)
+    )
+
+    assert DataQualityReport.merge([first_report, second_report]) == whole
+    assert (
+        np.concatenate(
+            [first_columns.consumption_wh, second_columns.consumption_wh]
+        ).tolist()
+        == whole_columns.consumption_wh.tolist()
+    )
+
+
+def test_missing_columns_are_rejected():
+    with pytest.raises(ValueError, match="unit"):
+        validate_usage_csv_block(b"datetime,duration,consumption,generation\n", b"")
@@ -0,0 +1,34 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from worker_pool import WorkerPool, WorkerPoolFullError
+
+
+def test_worker_pool_sheds_load_when_queue_is_full():
+    release = threading.Event()
+
+    async def scenario():
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            pool = WorkerPool(executor, max_workers=1, max_queue_depth=1)
+            running = asyncio.ensure_future(pool.run(release.wait))
+            queued = asyncio.ensure_future(pool.run(lambda: "queued"))
+            await asyncio.sleep(0)
+
+            assert pool.usage() == {
+                "max_workers": 1,
+                "busy_workers": 1,
+                "queued_jobs": 1,
+                "max_queue_depth": 1,
+            }
+            with pytest.raises(WorkerPoolFullError):
+                await pool.run(lambda: "rejected")
+
+            release.set()
+            assert await running is True
+            assert await queued == "queued"
+            assert pool.jobs == 0
+
+    asyncio.run(scenario())
@@ -0,0 +1,245 @@
+import hashlib
+import zlib
+from typing import Iterable
+
+from python_multipart.multipart import MultipartParser, parse_options_header
+
+# Form field the usage data CSV is uploaded in, matching the /recommend/ form
+UPLOAD_FIELD_NAME = b"file"
+RAW_CSV_CONTENT_TYPES = {b"text/csv", b"text/plain", b"application/octet-stream"}
+# Largest other form field kept, e.g. /optimize's plan_grids
+MAX_FORM_FIELD_BYTES = 1024 * 1024
+
+
+class UploadTooLargeError(Exception):
+    """The upload is over the configured size or row limit"""
+
+
+class UploadFormatError(ValueError):
+    """The request body isn't a usage data upload we know how to read"""
+
+
+class UsageUploadReader:
+    """Extracts the usage data CSV from a request body as it arrives.
+
+    Accepts a multipart form with the CSV in its "file" field, or a raw CSV
+    body, either of which may be gzipped with Content-Encoding: gzip. Each
+    body chunk passed to feed returns the CSV bytes it contained, so the CSV
+    can be parsed while the rest of the body is still being received, and the
+    reader itself never holds more than a chunk of the body in memory.
+
+    The decompressed body is limited to max_bytes, which also protects against
+    gzip bombs. The multipart form fields named in form_field_names are kept
+    in form_fields, up to MAX_FORM_FIELD_BYTES each, and any others ignored.
+
+    Raises:
+        UploadFormatError: unsupported Content-Type or Content-Encoding
+    """
+
+    def __init__(
+        self,
+        content_type: str,
+        content_encoding: str | None,
+        max_bytes: int,
+        form_field_names: Iterable[str] = (),
+    ) -> None:
+        self.max_bytes = max_bytes
+        self.file_name: str | None = None
+        self.form_fields: dict[str, str] = {}
+        self._form_field_names = {name.encode() for name in form_field_names}
+        self._form_field: bytearray | None = None
+        self.body_bytes = 0  # as received, before decompression
+        self.decoded_bytes = 0
+        self.csv_sha256 = hashlib.sha256()
+
+        encoding = (content_encoding or "identity").strip().lower()
+        if encoding == "gzip":
+            self._decompressor = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+        elif encoding == "identity":
+            self._decompressor = None
+        else:
+            raise UploadFormatError(f"Unsupported Content-Encoding: {encoding}")
+
+        mime_type, options = parse_options_header(content_type)
+        self._csv_chunks: list[bytes] = []
+        self._found_file = False
+        self._in_file = False
+        if mime_type == b"multipart/form-data":
+            if b"boundary" not in options:
+                raise UploadFormatError("Multipart upload is missing its boundary.")
+            self._header_field = b""
+            self._header_value = b""
+            self._part_name: bytes | None = None
+            self._part_file_name: bytes | None = None
+            self._multipart_parser: MultipartParser | None = MultipartParser(
+                options[b"boundary"],
+                callbacks={
+                    "on_part_begin": self._on_part_begin,
+                    "on_header_field": self._on_header_field,
+                    "on_header_value": self._on_header_value,
+                    "on_header_end": self._on_header_end,
+                    "on_headers_finished": self._on_headers_finished,
+                    "on_part_data": self._on_part_data,
+                    "on_part_end": self._on_part_end,
+                },
+            )
+        elif mime_type in RAW_CSV_CONTENT_TYPES:
+            self._multipart_parser = None
+            self._found_file = True
+        else:
+            raise UploadFormatError(
+                f"Unsupported Content-Type: {mime_type.decode('latin-1')}"
+            )
+
+    def _on_part_begin(self) -> None:
+        self._part_name = None
+        self._part_file_name = None
+
+    def _on_header_field(self, data: bytes, start: int, end: int) -> None:
+        self._header_field += data[start:end]
+
+    def _on_header_value(self, data: bytes, start: int, end: int) -> None:
+        self._header_value += data[start:end]
+
+    def _on_header_end(self) -> None:
+        if self._header_field.lower() == b"content-disposition":
+            _, options = parse_options_header(self._header_value)
+            self._part_name = options.get(b"name")
+            self._part_file_name = options.get(b"filename")
+        self._header_field = b""
+        self._header_value = b""
+
+    def _on_headers_finished(self) -> None:
+        # Only the first file field is read
+        self._in_file = not self._found_file and self._part_name == UPLOAD_FIELD_NAME
+        if not self._in_file and self._part_name in self._form_field_names:
+            self._form_field = bytearray()
+        if self._in_file:
+            self._found_file = True
+            if self._part_file_name is not None:
+                self.file_name = self._part_file_name.decode("utf-8", "replace")
+
+    def _on_part_data(self, data: bytes, start: int, end: int) -> None:
+        if self._in_file:
+            self._csv_chunks.append(data[start:end])
+        elif self._form_field is not None:
+            self._form_field += data[start:end]
+            if len(self._form_field) > MAX_FORM_FIELD_BYTES:
+                raise UploadTooLargeError(
+                    f"Form fields are limited to {MAX_FORM_FIELD_BYTES:,} bytes."
+                )
+
+    def _on_part_end(self) -> None:
+        self._in_file = False
+        if self._form_field is not None:
+            assert self._part_name is not None
+            self.form_fields[self._part_name.decode()] = self._form_field.decode(
+                "utf-8", "replace"
+            )
+            self._form_field = None
+
+    def _decode(self, body_chunk: bytes) -> bytes:
+        if self._decompressor is None:
+            return self._count_decoded(body_chunk)
+        # Never inflate past the limit, however well the body compresses
+        return self._count_decoded(
+            self._decompressor.decompress(
+                body_chunk, self.max_bytes - self.decoded_bytes + 1
+            )
+        )
+
+    def _count_decoded(self, decoded: bytes) -> bytes:
+        self.decoded_bytes += len(decoded)
+        if self.decoded_bytes > self.max_bytes:
+            raise UploadTooLargeError(
+                f"Upload is larger than the {self.max_bytes:,} byte limit."
+            )
+        return decoded
+
+    def _extract_csv(self, decoded: bytes) -> bytes:
+        if self._multipart_parser is None:
+            csv_bytes = decoded
+        else:
+            self._multipart_parser.write(decoded)
+            csv_bytes = b"".join(self._csv_chunks)
+            self._csv_chunks.clear()
+        self.csv_sha256.update(csv_bytes)
+        return csv_bytes
+
+    def feed(self, body_chunk: bytes) -> bytes:
+        """Reads the next chunk of the request body, returning any usage CSV
+        bytes it contained
+
+        Raises:
+            UploadTooLargeError: the decompressed body is over max_bytes
+        """
+        self.body_bytes += len(body_chunk)
+        return self._extract_csv(self._decode(body_chunk))
+
+    def finish(self) -> bytes:
+        """Called once the whole body has been read, returning any remaining
+        usage CSV bytes
+
+        Raises:
+            UploadFormatError: the body was truncated or had no usage data file
+            UploadTooLargeError: the decompressed body is over max_bytes
+        """
+        csv_bytes = b""
+        if self._decompressor is not None:
+            if not self._decompressor.eof:
+                raise UploadFormatError("Gzipped upload is truncated.")
+            csv_bytes = self._extract_csv(
+                self._count_decoded(self._decompressor.flush())
+            )
+        if self._multipart_parser is not None:
+            self._multipart_parser.finalize()
+        if not self._found_file:
+            raise UploadFormatError('Upload has no "file" field.')
+        return csv_bytes
+
+
+class CsvBlockSplitter:
+    """Cuts a stream of CSV bytes into blocks of whole lines that can each be
+    parsed on their own along with the header line."""
+
+    def __init__(self, block_bytes: int) -> None:
+        self.block_bytes = block_bytes
+        self.header: bytes | None = None
+        self.rows = 0
+        self._buffer = bytearray()
+
+    def _take_block(self, end: int) -> bytes:
+        block = bytes(self._buffer[:end])
+        del self._buffer[:end]
+        self.rows += block.count(b"\n")
+        return block
+
+    def feed(self, csv_bytes: bytes) -> list[bytes]:
+        """Returns the blocks completed by csv_bytes, if any"""
+        self._buffer += csv_bytes
+        if self.header is None:
+            header_end = self._buffer.find(b"\n")
+            if header_end == -1:
+                return []
+            self.header = bytes(self._buffer[: header_end + 1])
+            del self._buffer[: header_end + 1]
+
+        blocks = []
+        while len(self._buffer) >= self.block_bytes:
+            block_end = self._buffer.rfind(b"\n") + 1
+            if not block_end:
+                break
+            blocks.append(self._take_block(block_end))
+        return blocks
+
+    def finish(self) -> list[bytes]:
+        """Returns the last, possibly unterminated, block"""
+        if self.header is None:
+            # A header without a trailing newline and no rows
+            self.header = bytes(self._buffer) + b"\n"
+            self._buffer.clear()
+        if not self._buffer.strip():
+            return []
+        if not self._buffer.endswith(b"\n"):
+            self._buffer += b"\n"
+        return [self._take_block(len(self._buffer))]
@@ -0,0 +1,490 @@
+from typing import Iterable, NamedTuple, Sequence
+
+import numpy as np
+
+from custom_types import (
+    EPOCH_ORDINAL,
+    MINUTES_PER_DAY,
+    SECONDS_PER_DAY,
+    WATT_HOURS_PER_UNIT,
+    UsageData,
+    UsageDataRow,
+)
+
+
+class UsageColumns(NamedTuple):
+    """Columnar usage data, with consumption and generation normalized to Wh.
+
+    second_of_day, minute_of_day, month_index and day are in the meter's local
+    time, so they line up with time of day prices and billing months.
+    """
+
+    epoch_seconds: np.ndarray  # int64
+    duration: np.ndarray  # int32 seconds
+    second_of_day: np.ndarray  # int32, 0 - 86399
+    minute_of_day: np.ndarray  # int16, 0 - 1439
+    month_index: np.ndarray  # int32, year * 12 + (month - 1)
+    day: np.ndarray  # int32 days since 1970-01-01
+    consumption_wh: np.ndarray  # int64
+    generation_wh: np.ndarray  # int64
+
+    @property
+    def consumption_kwh(self) -> np.ndarray:
+        return self.consumption_wh / 1000.0
+
+    @property
+    def generation_kwh(self) -> np.ndarray:
+        return self.generation_wh / 1000.0
+
+    @classmethod
+    def from_usage_data(cls, usage_data: UsageData) -> "UsageColumns":
+        """Builds columns straight from UsageData's buffers and month index
+        without touching individual rows."""
+        return cls.from_arrays(
+            epoch_seconds=usage_data.epoch_seconds,
+            utc_offset=usage_data.utc_offset,
+            duration=usage_data.duration,
+            consumption_wh=usage_data.consumption,
+            generation_wh=usage_data.generation,
+            month_index=usage_data.row_month_indexes(),
+        )
+
+    @classmethod
+    def from_arrays(
+        cls,
+        epoch_seconds: Sequence[int],
+        utc_offset: Sequence[int],
+        duration: Sequence[int],
+        consumption_wh: Sequence[int],
+        generation_wh: Sequence[int],
+        month_index: np.ndarray | None = None,
+    ) -> "UsageColumns":
+        """Builds columns from arrays or buffers laid out like UsageData's,
+        working out each row's month unless month_index is given"""
+        epoch_seconds = np.asarray(epoch_seconds, dtype=np.int64)
+        local_seconds = epoch_seconds + np.asarray(utc_offset, dtype=np.int64)
+        if month_index is None:
+            month_index = local_seconds.astype("datetime64[s]").astype(
+                "datetime64[M]"
+            ).astype(np.int32) + np.int32(1970 * 12)
+        second_of_day = (local_seconds % SECONDS_PER_DAY).astype(np.int32)
+        return cls(
+            epoch_seconds=epoch_seconds,
+            duration=np.asarray(duration, dtype=np.int32),
+            second_of_day=second_of_day,
+            minute_of_day=(second_of_day // 60).astype(np.int16),
+            month_index=np.asarray(month_index, dtype=np.int32),
+            day=(local_seconds // SECONDS_PER_DAY).astype(np.int32),
+            consumption_wh=np.asarray(consumption_wh, dtype=np.int64),
+            generation_wh=np.asarray(generation_wh, dtype=np.int64),
+        )
+
+    @classmethod
+    def from_usage_rows(cls, usage_rows: Iterable[UsageDataRow]) -> "UsageColumns":
+        epoch_seconds: list[int] = []
+        duration: list[int] = []
+        second_of_day: list[int] = []
+        month_index: list[int] = []
+        day: list[int] = []
+        consumption: list[int] = []
+        generation: list[int] = []
+        for row in usage_rows:
+            row_datetime = row.datetime
+            epoch_seconds.append(int(row_datetime.timestamp()))
+            duration.append(row.duration)
+            second_of_day.append(
+                row_datetime.hour * 3600
+                + row_datetime.minute * 60
+                + row_datetime.second
+            )
+            month_index.append(row_datetime.year * 12 + row_datetime.month - 1)
+            day.append(row_datetime.toordinal() - EPOCH_ORDINAL)
+            watt_hours_per_unit = WATT_HOURS_PER_UNIT[row.unit]
+            consumption.append(row.consumption * watt_hours_per_unit)
+            generation.append(row.generation * watt_hours_per_unit)
+        second_of_day_column = np.array(second_of_day, dtype=np.int32)
+        return cls(
+            epoch_seconds=np.array(epoch_seconds, dtype=np.int64),
+            duration=np.array(duration, dtype=np.int32),
+            second_of_day=second_of_day_column,
+            minute_of_day=(second_of_day_column // 60).astype(np.int16),
+            month_index=np.array(month_index, dtype=np.int32),
+            day=np.array(day, dtype=np.int32),
+            consumption_wh=np.array(consumption, dtype=np.int64),
+            generation_wh=np.array(generation, dtype=np.int64),
+        )
+
+
+def sum_by_group(group: np.ndarray, values: np.ndarray, groups: int) -> np.ndarray:
+    """Exact int64 sums of values by group index. Unlike np.bincount's float
+    weights, the result doesn't depend on the order of the values."""
+    sums = np.zeros(groups, dtype=np.int64)
+    np.add.at(sums, group, np.asarray(values, dtype=np.int64))
+    return sums
+
+
+# Bit layout used to pack a (month index, duration, second of day) group key
+# into a single int64 so groups can be found with one np.unique
+_SECOND_OF_DAY_BITS = 17  # 86400 < 2**17
+_DURATION_BITS = 23  # durations up to ~97 days
+MAX_DURATION_SECONDS = 2**_DURATION_BITS - 1
+
+_NO_DAYS = np.empty(0, dtype=np.int32)
+_NO_ENERGY = np.empty(0, dtype=np.int64)
+
+
+def sum_by_day(
+    day: np.ndarray, consumption_wh: np.ndarray, generation_wh: np.ndarray
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """The days present, sorted, and exact consumption and generation totals
+    for each. Days are offset from the first rather than found with np.unique,
+    so summing rows into days costs one linear pass."""
+    day = np.asarray(day, dtype=np.int64)
+    if not len(day):
+        return _NO_DAYS, _NO_ENERGY, _NO_ENERGY
+    first_day = int(day.min())
+    day_offset = day - first_day
+    span = int(day_offset.max()) + 1
+    present = np.bincount(day_offset, minlength=span) > 0
+    return (
+        (np.flatnonzero(present) + first_day).astype(np.int32),
+        sum_by_group(day_offset, consumption_wh, span)[present],
+        sum_by_group(day_offset, generation_wh, span)[present],
+    )
+
+
+class UsageAggregate(NamedTuple):
+    """Usage data collapsed once into everything pricing needs.
+
+    Intervals are grouped by billing month, duration and local start time of
+    day, with their consumption and generation summed. Flat and tiered plans
+    only need the monthly totals, while time of day plans price each group by
+    its average rate, so the cost of pricing a plan depends on the number of
+    groups (at most months * intervals per day) rather than the number of rows.
+
+    Daily totals, by the local day intervals start on, are collected in the
+    same pass for cost breakdowns (see calc_cost_breakdown). There are at most
+    a few hundred a year, so they add little to the size of an aggregate.
+
+    Energy is kept in integer Wh, so aggregates of the same rows are identical
+    however the rows were ordered, split or merged.
+    """
+
+    months: np.ndarray  # int32 month index (year * 12 + month - 1), sorted
+    monthly_consumption_wh: np.ndarray  # int64, per month
+    monthly_generation_wh: np.ndarray  # int64, per month
+    group_month: np.ndarray  # int32, index into months for each group
+    duration: np.ndarray  # int32 seconds, per group
+    second_of_day: np.ndarray  # int32 local start time of day, per group
+    consumption_wh: np.ndarray  # int64, per group
+    generation_wh: np.ndarray  # int64, per group
+    days: np.ndarray = _NO_DAYS  # int32 local days since 1970-01-01, sorted
+    daily_consumption_wh: np.ndarray = _NO_ENERGY  # int64, per day
+    daily_generation_wh: np.ndarray = _NO_ENERGY  # int64, per day
+
+    @property
+    def monthly_consumption_kwh(self) -> np.ndarray:
+        return self.monthly_consumption_wh / 1000.0
+
+    @property
+    def monthly_generation_kwh(self) -> np.ndarray:
+        return self.monthly_generation_wh / 1000.0
+
+    @property
+    def consumption_kwh(self) -> np.ndarray:
+        return self.consumption_wh / 1000.0
+
+    @property
+    def generation_kwh(self) -> np.ndarray:
+        return self.generation_wh / 1000.0
+
+    @classmethod
+    def from_groups(
+        cls,
+        month_index: np.ndarray,
+        duration: np.ndarray,
+        second_of_day: np.ndarray,
+        consumption_wh: np.ndarray,
+        generation_wh: np.ndarray,
+        days: np.ndarray = _NO_DAYS,
+        daily_consumption_wh: np.ndarray = _NO_ENERGY,
+        daily_generation_wh: np.ndarray = _NO_ENERGY,
+    ) -> "UsageAggregate":
+        """Builds an aggregate from already grouped intervals and daily
+        totals"""
+        months, group_month = np.unique(month_index, return_inverse=True)
+        return cls(
+            months=months.astype(np.int32),
+            monthly_consumption_wh=sum_by_group(
+                group_month, consumption_wh, len(months)
+            ),
+            monthly_generation_wh=sum_by_group(group_month, generation_wh, len(months)),
+            group_month=group_month.astype(np.int32),
+            duration=np.asarray(duration, dtype=np.int32),
+            second_of_day=np.asarray(second_of_day, dtype=np.int32),
+            consumption_wh=np.asarray(consumption_wh, dtype=np.int64),
+            generation_wh=np.asarray(generation_wh, dtype=np.int64),
+            days=np.asarray(days, dtype=np.int32),
+            daily_consumption_wh=np.asarray(daily_consumption_wh, dtype=np.int64),
+            daily_generation_wh=np.asarray(daily_generation_wh, dtype=np.int64),
+        )
+
+    @classmethod
+    def reduce(
+        cls,
+        month_index: np.ndarray,
+        duration: np.ndarray,
+        second_of_day: np.ndarray,
+        consumption_wh: np.ndarray,
+        generation_wh: np.ndarray,
+        day: np.ndarray | None = None,
+    ) -> "UsageAggregate":
+        """Groups intervals with array operations, summing them by day as
+        well when given the day each starts on
+
+        Raises:
+            ValueError: an interval's duration is negative or longer than ~97 days
+        """
+        duration = np.asarray(duration, dtype=np.int64)
+        if len(duration) and (
+            duration.min() < 0 or duration.max() > MAX_DURATION_SECONDS
+        ):
+            raise ValueError("Interval durations must be between 0 and 97 days.")
+        group_keys = (
+            (np.asarray(month_index, dtype=np.int64) << _DURATION_BITS | duration)
+            << _SECOND_OF_DAY_BITS
+        ) | np.asarray(second_of_day, dtype=np.int64)
+        group_keys, row_group = np.unique(group_keys, return_inverse=True)
+        days, daily_consumption_wh, daily_generation_wh = (
+            sum_by_day(day, consumption_wh, generation_wh)
+            if day is not None
+            else (_NO_DAYS, _NO_ENERGY, _NO_ENERGY)
+        )
+        return cls.from_groups(
+            month_index=group_keys >> (_DURATION_BITS + _SECOND_OF_DAY_BITS),
+            duration=(group_keys >> _SECOND_OF_DAY_BITS) & MAX_DURATION_SECONDS,
+            second_of_day=group_keys & (2**_SECOND_OF_DAY_BITS - 1),
+            consumption_wh=sum_by_group(row_group, consumption_wh, len(group_keys)),
+            generation_wh=sum_by_group(row_group, generation_wh, len(group_keys)),
+            days=days,
+            daily_consumption_wh=daily_consumption_wh,
+            daily_generation_wh=daily_generation_wh,
+        )
+
+    @classmethod
+    def from_usage_columns(cls, usage_columns: UsageColumns) -> "UsageAggregate":
+        return cls.reduce(
+            month_index=usage_columns.month_index,
+            duration=usage_columns.duration,
+            second_of_day=usage_columns.second_of_day,
+            consumption_wh=usage_columns.consumption_wh,
+            generation_wh=usage_columns.generation_wh,
+            day=usage_columns.day,
+        )
+
+    @classmethod
+    def merge(cls, usage_aggregates: Iterable["UsageAggregate"]) -> "UsageAggregate":
+        """Combines aggregates of different parts of the same usage data, e.g.
+        blocks of a file parsed separately. Groups from the same month, even if
+        the month was split between parts, are summed."""
+        usage_aggregates = list(usage_aggregates)
+        days, daily_consumption_wh, daily_generation_wh = sum_by_day(
+            np.concatenate(
+                [usage_aggregate.days for usage_aggregate in usage_aggregates]
+                or [_NO_DAYS]
+            ),
+            np.concatenate(
+                [
+                    usage_aggregate.daily_consumption_wh
+                    for usage_aggregate in usage_aggregates
+                ]
+                or [_NO_ENERGY]
+            ),
+            np.concatenate(
+                [
+                    usage_aggregate.daily_generation_wh
+                    for usage_aggregate in usage_aggregates
+                ]
+                or [_NO_ENERGY]
+            ),
+        )
+        return cls.reduce(
+            month_index=np.concatenate(
+                [
+                    usage_aggregate.months[usage_aggregate.group_month]
+                    for usage_aggregate in usage_aggregates
+                ]
+                or [np.empty(0, dtype=np.int32)]
+            ),
+            duration=np.concatenate(
+                [usage_aggregate.duration for usage_aggregate in usage_aggregates]
+                or [np.empty(0, dtype=np.int32)]
+            ),
+            second_of_day=np.concatenate(
+                [usage_aggregate.second_of_day for usage_aggregate in usage_aggregates]
+                or [np.empty(0, dtype=np.int32)]
+            ),
+            consumption_wh=np.concatenate(
+                [usage_aggregate.consumption_wh for usage_aggregate in usage_aggregates]
+                or [np.empty(0, dtype=np.int64)]
+            ),
+            generation_wh=np.concatenate(
+                [usage_aggregate.generation_wh for usage_aggregate in usage_aggregates]
+                or [np.empty(0, dtype=np.int64)]
+            ),
+        )._replace(
+            days=days,
+            daily_consumption_wh=daily_consumption_wh,
+            daily_generation_wh=daily_generation_wh,
+        )
+
+    @classmethod
+    def from_usage_data(cls, usage_data: UsageData) -> "UsageAggregate":
+        return cls.from_usage_columns(UsageColumns.from_usage_data(usage_data))
+
+    @classmethod
+    def from_usage_rows(cls, usage_rows: Iterable[UsageDataRow]) -> "UsageAggregate":
+        """Reduces usage rows one at a time, e.g. straight from
+        iter_usage_data_csv, without holding them in memory"""
+        usage_aggregator = UsageAggregator()
+        for row in usage_rows:
+            usage_aggregator.add_row(row)
+        return usage_aggregator.aggregate()
+
+    def consumption_wh_seconds_by_minute(
+        self, month: int | None = None
+    ) -> dict[int, np.ndarray]:
+        """Consumption spread over the local minute of day it happened in, by
+        interval duration: for each duration, Wh * seconds of that duration's
+        intervals falling in each minute (MINUTES_PER_DAY int64 entries). Only
+        the groups in months[month] are counted when month is given.
+
+        Pricing by time of day is linear in the rate table, so a plan's energy
+        cost in micro-cents is the sum over durations of
+        np.dot(rate_by_minute, wh_seconds) / duration, the same as pricing
+        every group by its average rate, but in a dot product per duration
+        however many plans are priced. Zero length intervals are priced at the
+        rate of the minute they're in, so are counted as lasting one second.
+        """
+        durations = self.duration
+        second_of_day = self.second_of_day
+        group_consumption_wh = self.consumption_wh
+        if month is not None:
+            in_month = self.group_month == month
+            durations = durations[in_month]
+            second_of_day = second_of_day[in_month]
+            group_consumption_wh = group_consumption_wh[in_month]
+        wh_seconds_by_minute = {}
+        for duration in np.unique(durations).tolist():
+            in_duration = durations == duration
+            start = second_of_day[in_duration].astype(np.int64)
+            consumption_wh = group_consumption_wh[in_duration]
+            if duration == 0:
+                wh_seconds = np.zeros(MINUTES_PER_DAY, dtype=np.int64)
+                np.add.at(wh_seconds, start // 60, consumption_wh)
+                wh_seconds_by_minute[1] = wh_seconds_by_minute.get(1, 0) + wh_seconds
+                continue
+            # Intervals of a day or more cover every second of the day evenly
+            full_days, remainder = divmod(duration, SECONDS_PER_DAY)
+            wh_by_second_change = np.zeros(SECONDS_PER_DAY + 1, dtype=np.int64)
+            wh_by_second_change[0] += full_days * int(consumption_wh.sum())
+            end = start + remainder
+            wraps = end > SECONDS_PER_DAY
+            np.add.at(wh_by_second_change, start, consumption_wh)
+            np.add.at(
+                wh_by_second_change,
+                np.where(wraps, SECONDS_PER_DAY, end),
+                -consumption_wh,
+            )
+            # The part of an interval running past midnight starts the next day
+            wh_by_second_change[0] += consumption_wh[wraps].sum()
+            np.add.at(
+                wh_by_second_change,
+                end[wraps] - SECONDS_PER_DAY,
+                -consumption_wh[wraps],
+            )
+            wh_seconds = (
+                np.cumsum(wh_by_second_change[:SECONDS_PER_DAY])
+                .reshape(-1, 60)
+                .sum(axis=1)
+            )
+            wh_seconds_by_minute[duration] = (
+                wh_seconds_by_minute.get(duration, 0) + wh_seconds
+            )
+        return wh_seconds_by_minute
+
+
+class UsageAggregator:
+    """Builds a UsageAggregate one row at a time in memory bounded by the
+    number of groups, not the number of rows."""
+
+    def __init__(self) -> None:
+        # (month index, duration, second of day) -> [consumption Wh, generation Wh]
+        self.groups: dict[tuple[int, int, int], list[int]] = {}
+        # local day -> [consumption Wh, generation Wh]
+        self.days: dict[int, list[int]] = {}
+
+    def add_row(self, row: UsageDataRow) -> None:
+        row_datetime = row.datetime
+        watt_hours_per_unit = WATT_HOURS_PER_UNIT[row.unit]
+        self.add(
+            month_index=row_datetime.year * 12 + row_datetime.month - 1,
+            duration=row.duration,
+            second_of_day=(
+                row_datetime.hour * 3600
+                + row_datetime.minute * 60
+                + row_datetime.second
+            ),
+            consumption_wh=row.consumption * watt_hours_per_unit,
+            generation_wh=row.generation * watt_hours_per_unit,
+            day=row_datetime.toordinal() - EPOCH_ORDINAL,
+        )
+
+    def add(
+        self,
+        month_index: int,
+        duration: int,
+        second_of_day: int,
+        consumption_wh: int,
+        generation_wh: int,
+        day: int | None = None,
+    ) -> None:
+        group = self.groups.get((month_index, duration, second_of_day))
+        if group is None:
+            self.groups[(month_index, duration, second_of_day)] = [
+                consumption_wh,
+                generation_wh,
+            ]
+        else:
+            group[0] += consumption_wh
+            group[1] += generation_wh
+        if day is None:
+            return
+        daily = self.days.get(day)
+        if daily is None:
+            self.days[day] = [consumption_wh, generation_wh]
+        else:
+            daily[0] += consumption_wh
+            daily[1] += generation_wh
+
+    def aggregate(self) -> UsageAggregate:
+        group_keys = sorted(self.groups)
+        days = sorted(self.days)
+        return UsageAggregate.from_groups(
+            month_index=np.array([key[0] for key in group_keys], dtype=np.int64),
+            duration=np.array([key[1] for key in group_keys], dtype=np.int32),
+            second_of_day=np.array([key[2] for key in group_keys], dtype=np.int32),
+            consumption_wh=np.array(
+                [self.groups[key][0] for key in group_keys], dtype=np.int64
+            ),
+            generation_wh=np.array(
+                [self.groups[key][1] for key in group_keys], dtype=np.int64
+            ),
+            days=np.array(days, dtype=np.int32),
+            daily_consumption_wh=np.array(
+                [self.days[day][0] for day in days], dtype=np.int64
+            ),
+            daily_generation_wh=np.array(
+                [self.days[day][1] for day in days], dtype=np.int64
+            ),
+        )
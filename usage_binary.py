@@ -0,0 +1,137 @@
+"""Compact binary columnar usage data files, for repeat analysis of large
+customers without re-parsing their CSVs.
+
+Layout, all little-endian:
+
+    header (64 bytes): magic b"USAGEBIN", format version (uint32), padding
+                       (uint32), row count (uint64), zero padding
+    epoch_seconds      int64 per row
+    utc_offset         int32 per row, seconds
+    duration           int32 per row, seconds
+    consumption        int64 per row, Wh
+    generation         int64 per row, Wh
+
+Each column starts on an 8 byte boundary. Convert a CSV with:
+
+    python usage_binary.py usage.csv usage.usage
+"""
+
+import mmap
+import struct
+import sys
+from array import array
+from pathlib import Path
+from typing import BinaryIO
+
+from custom_types import UsageData
+from parse_usage_data import parse_usage_data_csv
+
+# Batch manifests may point at binary usage files with this suffix
+BINARY_SUFFIX = ".usage"
+MAGIC = b"USAGEBIN"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("<8sIIQ")
+HEADER_SIZE = 64
+# (UsageData attribute, array typecode), in file order
+COLUMNS = (
+    ("epoch_seconds", "q"),
+    ("utc_offset", "i"),
+    ("duration", "i"),
+    ("consumption", "q"),
+    ("generation", "q"),
+)
+# The loader hands out views of the file, which needs the native byte order to
+# match the file's; other machines get a byte-swapped copy instead
+NATIVE_LITTLE_ENDIAN = sys.byteorder == "little"
+
+
+def _padded(size: int) -> int:
+    return -(-size // 8) * 8
+
+
+def _column_offsets(rows: int) -> list[tuple[str, str, int]]:
+    offsets = []
+    offset = HEADER_SIZE
+    for name, typecode in COLUMNS:
+        offsets.append((name, typecode, offset))
+        offset += _padded(rows * array(typecode).itemsize)
+    return offsets
+
+
+def _file_size(rows: int) -> int:
+    _, typecode, offset = _column_offsets(rows)[-1]
+    return offset + _padded(rows * array(typecode).itemsize)
+
+
+def write_usage_data_binary(usage_data: UsageData, binary_file: BinaryIO) -> None:
+    rows = len(usage_data)
+    binary_file.write(
+        HEADER.pack(MAGIC, FORMAT_VERSION, 0, rows).ljust(HEADER_SIZE, b"\0")
+    )
+    for name, typecode in COLUMNS:
+        column = array(typecode, getattr(usage_data, name))
+        if not NATIVE_LITTLE_ENDIAN:
+            column.byteswap()
+        column_bytes = column.tobytes()
+        binary_file.write(column_bytes)
+        binary_file.write(b"\0" * (_padded(len(column_bytes)) - len(column_bytes)))
+
+
+def convert_usage_csv_to_binary(csv_path: Path, binary_path: Path) -> int:
+    """Parses a usage data CSV once into a binary usage file, returning the
+    number of rows"""
+    with open(csv_path, "rb") as csv_file:
+        usage_data = parse_usage_data_csv(csv_file)
+    with open(binary_path, "wb") as binary_file:
+        write_usage_data_binary(usage_data, binary_file)
+    return len(usage_data)
+
+
+def load_usage_data_binary(binary_path: Path) -> UsageData:
+    """Memory-maps a binary usage file as UsageData whose columns are views of
+    the file, so nothing is parsed or copied up front and pages are only read
+    as the pricing code touches them.
+
+    Raises:
+        ValueError: the file isn't a binary usage file or is truncated
+    """
+    with open(binary_path, "rb") as binary_file:
+        header = binary_file.read(HEADER_SIZE)
+        if len(header) < HEADER_SIZE:
+            raise ValueError(f"{binary_path} is not a binary usage file.")
+        magic, version, _, rows = HEADER.unpack_from(header)
+        if magic != MAGIC:
+            raise ValueError(f"{binary_path} is not a binary usage file.")
+        if version != FORMAT_VERSION:
+            raise ValueError(f"{binary_path} has unsupported version {version}.")
+        if not rows:
+            return UsageData()
+        if binary_file.seek(0, 2) < _file_size(rows):
+            raise ValueError(f"{binary_path} is truncated.")
+        # The map outlives the file object, and is closed once no column views
+        # of it are left
+        mapped = memoryview(mmap.mmap(binary_file.fileno(), 0, access=mmap.ACCESS_READ))
+
+    columns = {}
+    for name, typecode, offset in _column_offsets(rows):
+        column_bytes = mapped[offset : offset + rows * array(typecode).itemsize]
+        if NATIVE_LITTLE_ENDIAN:
+            columns[name] = column_bytes.cast(typecode)
+        else:
+            column = array(typecode, column_bytes.tobytes())
+            column.byteswap()
+            columns[name] = column
+    return UsageData.from_columns(**columns)
+
+
+def main(argv: list[str]) -> int:
+    if len(argv) != 2:
+        print("usage: python usage_binary.py USAGE_CSV OUTPUT", file=sys.stderr)
+        return 2
+    rows = convert_usage_csv_to_binary(Path(argv[0]), Path(argv[1]))
+    print(f"Wrote {rows:,} rows to {argv[1]}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,531 @@
+import csv
+import itertools
+from datetime import timezone
+from typing import Iterable, Literal, NamedTuple
+
+import numpy as np
+
+from custom_types import SECONDS_PER_DAY
+from parse_usage_data import ISO_TIMESTAMP_LENGTH, parse_timestamp
+from usage_aggregate import MAX_DURATION_SECONDS, UsageAggregate, UsageColumns
+
+# What to do with rows that can't be priced as they are:
+#   strict: reject the whole file
+#   skip: leave them out
+#   interpolate: leave them out, then fill gaps from the neighbouring intervals
+ValidationPolicy = Literal["strict", "skip", "interpolate"]
+VALIDATION_POLICIES: tuple[ValidationPolicy, ...] = ("strict", "skip", "interpolate")
+
+# Issues that make a row unusable, so strict rejects the file and skip and
+# interpolate drop the row
+ROW_ERRORS = (
+    "wrong_field_count",
+    "invalid_timestamp",
+    "invalid_duration",
+    "invalid_unit",
+    "invalid_number",
+    "negative_energy",
+    # Starts at the same time, for as long, as the row before it
+    "duplicate",
+    # Starts before the row before it ends, which would count energy twice
+    "overlap",
+)
+# Worth knowing about, but the rows are still priced as they are
+WARNINGS = (
+    "nonstandard_timestamp",
+    "out_of_order",
+    # Time missing between the end of a row and the start of the next
+    "gap",
+    # The UTC offset changed between rows, e.g. a daylight saving transition
+    "utc_offset_change",
+)
+MAX_SAMPLES = 5
+# Longest gap the interpolate policy fills in
+MAX_INTERPOLATED_GAP_SECONDS = SECONDS_PER_DAY
+
+REQUIRED_COLUMNS = ("datetime", "duration", "unit", "consumption", "generation")
+
+
+class DataQualityError(ValueError):
+    """Usage data rejected by the strict policy"""
+
+    def __init__(self, report: "DataQualityReport") -> None:
+        super().__init__(
+            "; ".join(
+                f"{count} {issue.replace('_', ' ')} rows"
+                for issue, count in report.issues.items()
+                if issue in ROW_ERRORS
+            )
+        )
+        self.report = report
+
+
+class DataQualityReport(NamedTuple):
+    """What was found validating a usage data file: a count of rows with each
+    issue and, for each issue, the first few offending rows"""
+
+    rows: int = 0
+    # Lines of the file covered, including blank ones, to number the samples
+    # of consecutive blocks
+    lines: int = 0
+    rows_skipped: int = 0
+    rows_interpolated: int = 0
+    gap_seconds: int = 0
+    issues: dict[str, int] = {}
+    # issue -> [{"line": line number in the file, "row": the raw row}, ...],
+    # numbered from the start of the block until merged
+    samples: dict[str, list[dict]] = {}
+
+    @property
+    def has_errors(self) -> bool:
+        return any(issue in ROW_ERRORS for issue in self.issues)
+
+    @classmethod
+    def merge(cls, reports: Iterable["DataQualityReport"]) -> "DataQualityReport":
+        """Combines the reports of consecutive blocks of a file, in order,
+        renumbering each block's samples by the lines before it"""
+        rows = lines = rows_skipped = rows_interpolated = gap_seconds = 0
+        issues: dict[str, int] = {}
+        samples: dict[str, list[dict]] = {}
+        for report in reports:
+            for issue, issue_samples in report.samples.items():
+                kept = samples.setdefault(issue, [])
+                kept.extend(
+                    {**sample, "line": sample["line"] + lines}
+                    for sample in issue_samples[: MAX_SAMPLES - len(kept)]
+                )
+            rows += report.rows
+            lines += report.lines
+            rows_skipped += report.rows_skipped
+            rows_interpolated += report.rows_interpolated
+            gap_seconds += report.gap_seconds
+            for issue, count in report.issues.items():
+                issues[issue] = issues.get(issue, 0) + count
+        return cls(
+            rows, lines, rows_skipped, rows_interpolated, gap_seconds, issues, samples
+        )
+
+    def to_api_json(self) -> dict:
+        return {
+            "rows": self.rows,
+            "rows_skipped": self.rows_skipped,
+            "rows_interpolated": self.rows_interpolated,
+            "gap_seconds": self.gap_seconds,
+            "issues": {
+                issue: {"count": count, "samples": self.samples.get(issue, [])}
+                for issue, count in self.issues.items()
+            },
+        }
+
+
+def _parse_fixed_timestamps(
+    values: list[str],
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Parses "YYYY-MM-DDTHH:MM:SS±HH:MM" timestamps with array operations,
+    returning epoch seconds, UTC offsets and which values were in that format
+    and valid"""
+    n = len(values)
+    epoch_seconds = np.zeros(n, dtype=np.int64)
+    utc_offset = np.zeros(n, dtype=np.int64)
+    valid = np.fromiter(map(len, values), dtype=np.int64, count=n) == (
+        ISO_TIMESTAMP_LENGTH
+    )
+    fixed_length = np.flatnonzero(valid)
+    if not len(fixed_length):
+        return epoch_seconds, utc_offset, valid
+    fixed_values = (
+        values if len(fixed_length) == n else [values[i] for i in fixed_length]
+    )
+    chars = np.frombuffer(
+        "".join(fixed_values).encode("ascii", errors="replace"), dtype=np.uint8
+    ).reshape(-1, ISO_TIMESTAMP_LENGTH)
+    digits = chars.astype(np.int32) - ord("0")
+
+    def number(start: int, end: int) -> np.ndarray:
+        place_values = 10 ** np.arange(end - start - 1, -1, -1, dtype=np.int32)
+        return (digits[:, start:end] @ place_values).astype(np.int64)
+
+    digit_positions = [0, 1, 2, 3, 5, 6, 8, 9, 11, 12, 14, 15, 17, 18, 20, 21, 23, 24]
+    shape_ok = (
+        (digits[:, digit_positions] >= 0) & (digits[:, digit_positions] <= 9)
+    ).all(axis=1)
+    for position, separator in (
+        (4, "-"),
+        (7, "-"),
+        (10, "T"),
+        (13, ":"),
+        (16, ":"),
+        (22, ":"),
+    ):
+        shape_ok &= chars[:, position] == ord(separator)
+    shape_ok &= (chars[:, 19] == ord("+")) | (chars[:, 19] == ord("-"))
+
+    year, month, day = number(0, 4), number(5, 7), number(8, 10)
+    hour, minute, second = number(11, 13), number(14, 16), number(17, 19)
+    offset_hour, offset_minute = number(20, 22), number(23, 25)
+    month_index = (year - 1970) * 12 + np.clip(month, 1, 12) - 1
+    month_start_day = month_index.astype("datetime64[M]").astype("datetime64[D]")
+    days_in_month = (
+        (month_index + 1).astype("datetime64[M]").astype("datetime64[D]")
+        - month_start_day
+    ).astype(np.int64)
+    shape_ok &= (
+        (year >= 1)
+        & (month >= 1)
+        & (month <= 12)
+        & (day >= 1)
+        & (day <= days_in_month)
+        & (hour <= 23)
+        & (minute <= 59)
+        & (second <= 59)
+        & (offset_hour <= 23)
+        & (offset_minute <= 59)
+    )
+    offset = np.where(chars[:, 19] == ord("-"), -1, 1) * (
+        offset_hour * 3600 + offset_minute * 60
+    )
+    local_seconds = (
+        (month_start_day.astype(np.int64) + day - 1) * SECONDS_PER_DAY
+        + hour * 3600
+        + minute * 60
+        + second
+    )
+    epoch_seconds[fixed_length] = local_seconds - offset
+    utc_offset[fixed_length] = offset
+    valid[fixed_length] = shape_ok
+    return epoch_seconds, utc_offset, valid
+
+
+def _parse_int_column(values: list[str]) -> tuple[np.ndarray, np.ndarray]:
+    """Parses a column of integers in one go, only falling back to one row at
+    a time to find the bad values if there are any"""
+    try:
+        parsed = np.fromiter(map(int, values), dtype=np.int64, count=len(values))
+        return parsed, np.ones(len(values), dtype=bool)
+    except (ValueError, OverflowError):
+        pass
+    parsed = np.zeros(len(values), dtype=np.int64)
+    valid = np.ones(len(values), dtype=bool)
+    for i, value in enumerate(values):
+        try:
+            parsed[i] = int(value)
+        except (ValueError, OverflowError):
+            valid[i] = False
+    return parsed, valid
+
+
+class _Issues:
+    def __init__(self, lines: list[str], line_numbers: np.ndarray) -> None:
+        self.lines = lines
+        self.line_numbers = line_numbers
+        self.counts: dict[str, int] = {}
+        self.samples: dict[str, list[dict]] = {}
+
+    def add(self, issue: str, rows: np.ndarray) -> None:
+        """Records the rows (indexes into lines) flagged with an issue"""
+        if not len(rows):
+            return
+        self.counts[issue] = len(rows)
+        self.samples[issue] = [
+            {"line": int(self.line_numbers[row]), "row": self.lines[row]}
+            for row in rows[:MAX_SAMPLES].tolist()
+        ]
+
+
+def _split_fields(
+    lines: list[str], num_columns: int, quoted: bool
+) -> tuple[list[list[str]], np.ndarray]:
+    """Splits CSV lines into columns of fields, and flags the lines that
+    don't have num_columns fields (whose fields are all left blank)"""
+    if not quoted:
+        comma_counts = np.fromiter(
+            map(str.count, lines, itertools.repeat(",")),
+            dtype=np.int64,
+            count=len(lines),
+        )
+        if (comma_counts == num_columns - 1).all():
+            # Every line has the right number of fields, so the columns can be
+            # sliced out of one big split
+            fields = ",".join(lines).split(",") if lines else []
+            return [fields[i::num_columns] for i in range(num_columns)], np.zeros(
+                len(lines), dtype=bool
+            )
+        rows = [line.split(",") for line in lines]
+    else:
+        rows = list(csv.reader(lines))
+    wrong_field_count = (
+        np.fromiter(map(len, rows), dtype=np.int64, count=len(rows)) != num_columns
+    )
+    blank = [""] * num_columns
+    rows = [row if len(row) == num_columns else blank for row in rows]
+    if not rows:
+        return [[] for _ in range(num_columns)], wrong_field_count
+    return [list(column) for column in zip(*rows)], wrong_field_count
+
+
+def validate_usage_csv_block(
+    header: bytes,
+    block: bytes,
+    policy: ValidationPolicy = "strict",
+    previous_line: bytes = b"",
+) -> tuple[UsageColumns, DataQualityReport]:
+    """Parses and validates a block of whole lines of a usage data CSV with
+    array operations over each column, rather than raising on the first bad
+    row.
+
+    Rows are checked for unparseable or invalid values, and each row against
+    the one before it in the file for duplicates, overlaps, gaps and UTC offset
+    changes. previous_line, the last line of the previous block, lets blocks
+    of a file be validated independently without missing the issues at their
+    boundaries. Samples are numbered as if the block started on line 2, after
+    the header, until the reports are merged.
+
+    Rows that can't be priced are always left out; it's up to the caller to
+    reject the file under the strict policy, with check_data_quality, once
+    every block's report is in.
+
+    Raises:
+        ValueError: the header is missing a column, or the block isn't UTF-8
+    """
+    columns = next(csv.reader([header.decode("utf-8-sig")]), [])
+    missing = [name for name in REQUIRED_COLUMNS if name not in columns]
+    if missing:
+        raise ValueError(f"Usage data is missing the {', '.join(missing)} column(s).")
+    column_index = [columns.index(name) for name in REQUIRED_COLUMNS]
+
+    text = block.decode("utf-8")
+    num_lines = len(text.splitlines())
+    has_previous = bool(previous_line.strip())
+    if has_previous:
+        text = previous_line.decode("utf-8").rstrip("\r\n") + "\n" + text
+    lines = text.splitlines()
+    # Blank lines aren't rows, as with csv.DictReader
+    row_lines = np.arange(len(lines))
+    if not all(lines):
+        row_lines = row_lines[np.fromiter(map(bool, lines), dtype=bool)]
+        lines = [lines[i] for i in row_lines.tolist()]
+    issues = _Issues(lines, row_lines + (1 if has_previous else 2))
+    n = len(lines)
+    fields, wrong_field_count = _split_fields(lines, len(columns), quoted='"' in text)
+    timestamps, durations, units, consumption, generation = (
+        fields[i] for i in column_index
+    )
+
+    epoch_seconds, utc_offset, fixed = _parse_fixed_timestamps(timestamps)
+    invalid_timestamp = np.zeros(n, dtype=bool)
+    nonstandard_timestamp = np.zeros(n, dtype=bool)
+    for i in np.flatnonzero(~fixed & ~wrong_field_count).tolist():
+        try:
+            row_datetime = parse_timestamp(timestamps[i])
+        except (ValueError, OverflowError):
+            invalid_timestamp[i] = True
+            continue
+        nonstandard_timestamp[i] = True
+        offset = row_datetime.utcoffset()
+        if offset is None:
+            row_datetime = row_datetime.replace(tzinfo=timezone.utc)
+            offset = row_datetime.utcoffset()
+        epoch_seconds[i] = int(row_datetime.timestamp())
+        utc_offset[i] = int(offset.total_seconds())
+
+    duration, valid_duration = _parse_int_column(durations)
+    consumption_wh, valid_consumption = _parse_int_column(consumption)
+    generation_wh, valid_generation = _parse_int_column(generation)
+    if set(units) <= {"Wh"}:
+        is_kwh = np.zeros(n, dtype=bool)
+        valid_unit = np.ones(n, dtype=bool)
+    else:
+        is_kwh = np.fromiter((unit == "kWh" for unit in units), dtype=bool, count=n)
+        valid_unit = is_kwh | np.fromiter(
+            (unit == "Wh" for unit in units), dtype=bool, count=n
+        )
+    consumption_wh = np.where(is_kwh, consumption_wh * 1000, consumption_wh)
+    generation_wh = np.where(is_kwh, generation_wh * 1000, generation_wh)
+
+    errors = {
+        "wrong_field_count": wrong_field_count,
+        "invalid_timestamp": invalid_timestamp,
+        "invalid_duration": ~wrong_field_count
+        & ~(valid_duration & (duration >= 0) & (duration <= MAX_DURATION_SECONDS)),
+        "invalid_unit": ~wrong_field_count & ~valid_unit,
+        "invalid_number": ~wrong_field_count & ~(valid_consumption & valid_generation),
+    }
+    invalid = np.zeros(n, dtype=bool)
+    for mask in errors.values():
+        invalid |= mask
+    errors["negative_energy"] = ~invalid & ((consumption_wh < 0) | (generation_wh < 0))
+    invalid |= errors["negative_energy"]
+
+    # Each usable row against the usable row before it, in file order
+    usable = np.flatnonzero(~invalid)
+    start = epoch_seconds[usable]
+    end = start + duration[usable]
+    duplicate = np.zeros(n, dtype=bool)
+    overlap = np.zeros(n, dtype=bool)
+    out_of_order = np.zeros(n, dtype=bool)
+    if len(usable) > 1:
+        after = usable[1:]
+        same_start = start[1:] == start[:-1]
+        duplicate[after] = same_start & (end[1:] == end[:-1])
+        overlap[after] = ~same_start & (start[1:] > start[:-1]) & (start[1:] < end[:-1])
+        overlap[after] |= same_start & (end[1:] != end[:-1])
+        out_of_order[after] = start[1:] < start[:-1]
+    errors["duplicate"] = duplicate
+    errors["overlap"] = overlap
+    dropped = invalid | duplicate | overlap
+
+    # Gaps are between the rows that are kept, as interpolate fills them
+    kept = np.flatnonzero(~dropped)
+    gap = np.zeros(n, dtype=bool)
+    offset_change = np.zeros(n, dtype=bool)
+    gap_lengths = np.zeros(n, dtype=np.int64)
+    if len(kept) > 1:
+        after = kept[1:]
+        gap_lengths[after] = epoch_seconds[after] - (
+            epoch_seconds[kept[:-1]] + duration[kept[:-1]]
+        )
+        gap[after] = gap_lengths[after] > 0
+        offset_change[after] = utc_offset[after] != utc_offset[kept[:-1]]
+    warnings = {
+        "nonstandard_timestamp": nonstandard_timestamp,
+        "out_of_order": out_of_order,
+        "gap": gap,
+        "utc_offset_change": offset_change,
+    }
+
+    # The previous block's last line was only needed to check this block's
+    # first row against, it's counted and priced with its own block
+    counted = np.ones(n, dtype=bool)
+    if has_previous and n:
+        counted[0] = False
+    for issue, mask in (*errors.items(), *warnings.items()):
+        issues.add(issue, np.flatnonzero(mask & counted))
+    gap_seconds = int(gap_lengths[gap & counted].sum())
+    report = DataQualityReport(
+        rows=int(counted.sum()),
+        lines=num_lines,
+        rows_skipped=int((dropped & counted).sum()),
+        gap_seconds=gap_seconds,
+        issues=issues.counts,
+        samples=issues.samples,
+    )
+    keep = counted & ~dropped
+    usage_columns = (
+        epoch_seconds[keep],
+        utc_offset[keep],
+        duration[keep],
+        consumption_wh[keep],
+        generation_wh[keep],
+    )
+    if policy == "interpolate":
+        usage_columns, rows_interpolated = _interpolate_gaps(
+            *(
+                column[~dropped]
+                for column in (
+                    epoch_seconds,
+                    utc_offset,
+                    duration,
+                    consumption_wh,
+                    generation_wh,
+                )
+            )
+        )
+        if has_previous and n and not dropped[0]:
+            # Drop the previous block's last row, which the gap after it was
+            # interpolated from
+            usage_columns = tuple(column[1:] for column in usage_columns)
+        report = report._replace(rows_interpolated=rows_interpolated)
+    return UsageColumns.from_arrays(*usage_columns), report
+
+
+def _interpolate_gaps(
+    epoch_seconds: np.ndarray,
+    utc_offset: np.ndarray,
+    duration: np.ndarray,
+    consumption_wh: np.ndarray,
+    generation_wh: np.ndarray,
+) -> tuple[tuple[np.ndarray, ...], int]:
+    """Fills gaps of up to MAX_INTERPOLATED_GAP_SECONDS between consecutive
+    rows with intervals as long as the row before the gap, whose energy
+    steps linearly from the row before the gap to the row after it"""
+    columns = (epoch_seconds, utc_offset, duration, consumption_wh, generation_wh)
+    if len(epoch_seconds) < 2:
+        return columns, 0
+    end = epoch_seconds[:-1] + duration[:-1]
+    gap_seconds = epoch_seconds[1:] - end
+    fill = (
+        (gap_seconds > 0)
+        & (gap_seconds <= MAX_INTERPOLATED_GAP_SECONDS)
+        & (duration[:-1] > 0)
+    )
+    fill_counts = np.where(fill, gap_seconds // np.maximum(duration[:-1], 1), 0)
+    total = int(fill_counts.sum())
+    if not total:
+        return columns, 0
+
+    before = np.repeat(np.arange(len(fill_counts)), fill_counts)
+    # 1, 2, ... k within each gap of k intervals
+    step = (
+        np.arange(total)
+        - np.repeat(np.cumsum(fill_counts) - fill_counts, fill_counts)
+        + 1
+    )
+    steps = fill_counts[before] + 1
+    interval = duration[before]
+
+    def interpolate(energy_wh: np.ndarray) -> np.ndarray:
+        # The row after the gap, scaled to the length of the filled intervals
+        next_wh = (
+            energy_wh[before + 1] * interval // np.maximum(duration[before + 1], 1)
+        )
+        return energy_wh[before] + (next_wh - energy_wh[before]) * step // steps
+
+    filled = (
+        end[before] + (step - 1) * interval,
+        utc_offset[before],
+        interval,
+        interpolate(consumption_wh),
+        interpolate(generation_wh),
+    )
+    # Each filled interval goes straight after the row before its gap
+    order = np.argsort(
+        np.concatenate([np.arange(len(epoch_seconds)) * 2, before * 2 + 1]),
+        kind="stable",
+    )
+    return (
+        tuple(
+            np.concatenate([column, filled_column])[order]
+            for column, filled_column in zip(columns, filled)
+        ),
+        total,
+    )
+
+
+def aggregate_validated_usage_csv_block(
+    header: bytes,
+    block: bytes,
+    policy: ValidationPolicy = "strict",
+    previous_line: bytes = b"",
+) -> tuple[UsageAggregate, DataQualityReport]:
+    """validate_usage_csv_block, reduced straight into a UsageAggregate to be
+    merged with the other blocks'"""
+    usage_columns, report = validate_usage_csv_block(
+        header, block, policy, previous_line
+    )
+    return UsageAggregate.from_usage_columns(usage_columns), report
+
+
+def last_line(block: bytes) -> bytes:
+    """The last non-blank line of a block, to pass as the next block's
+    previous_line"""
+    lines = block.rstrip(b"\r\n").rsplit(b"\n", 1)
+    return lines[-1]
+
+
+def check_data_quality(report: DataQualityReport, policy: ValidationPolicy) -> None:
+    """
+    Raises:
+        DataQualityError: the strict policy found rows that can't be priced
+    """
+    if policy == "strict" and report.has_errors:
+        raise DataQualityError(report)
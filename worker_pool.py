@@ -0,0 +1,57 @@
+import asyncio
+from concurrent.futures import Executor
+from typing import Any, Callable, TypeVar
+
+T = TypeVar("T")
+
+
+class WorkerPoolFullError(Exception):
+    """Every worker is busy and the queue of waiting jobs is full"""
+
+
+class WorkerPool:
+    """Runs CPU-bound jobs on an executor without blocking the event loop.
+
+    At most max_workers jobs run at once and at most max_queue_depth more wait
+    for a free worker; beyond that, run raises WorkerPoolFullError so callers
+    can shed load instead of letting latency grow without bound.
+
+    The job count is only touched from the event loop thread, so it needs no
+    lock.
+    """
+
+    def __init__(self, executor: Executor, max_workers: int, max_queue_depth: int):
+        self.executor = executor
+        self.max_workers = max_workers
+        self.max_queue_depth = max_queue_depth
+        self.jobs = 0
+
+    @property
+    def is_full(self) -> bool:
+        return self.jobs >= self.max_workers + self.max_queue_depth
+
+    async def run(self, fn: Callable[..., T], *args: Any, admitted: bool = False) -> T:
+        """Runs fn(*args) on the executor and waits for the result
+
+        admitted skips the capacity check, for follow-up jobs of work that was
+        already let in (e.g. later blocks of an upload being parsed), which
+        still count towards the capacity seen by new work.
+
+        Raises:
+            WorkerPoolFullError: the pool is already at capacity
+        """
+        if self.is_full and not admitted:
+            raise WorkerPoolFullError()
+        self.jobs += 1
+        try:
+            return await asyncio.wrap_future(self.executor.submit(fn, *args))
+        finally:
+            self.jobs -= 1
+
+    def usage(self) -> dict:
+        return {
+            "max_workers": self.max_workers,
+            "busy_workers": min(self.jobs, self.max_workers),
+            "queued_jobs": max(0, self.jobs - self.max_workers),
+            "max_queue_depth": self.max_queue_depth,
+        }